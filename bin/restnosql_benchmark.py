@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+# pylint: disable=line-too-long
+"""
+benchmark of RestNoSql server and client
+
+starts the web application against a temporary storage directory,
+either in-process, calling the WSGI application directly, or on a
+localhost WSGI server, and drives it with RestNoSqlClient from several
+threads. reports ops/s and p50/p99 latency of get, set, delete and list
+for every combination of key count, value size and concurrency, results
+are stored as json to compare them across versions
+"""
+import os
+import io
+import sys
+import time
+import json
+import random
+import shutil
+import tempfile
+import platform
+import threading
+import subprocess
+import argparse
+import logging
+from urllib.parse import urlsplit
+import requests
+import requests.adapters
+import requests.structures
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("urllib3").setLevel(logging.WARNING)
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IDKEY = "benchmark-idkey"
+APIKEY = "benchmark-apikey"
+OPERATIONS = ("set", "get", "list", "delete")
+
+
+class WsgiAdapter(requests.adapters.BaseAdapter):
+    """
+    requests transport calling WSGI application in-process,
+    compressed responses are decoded by decompressor(encoding),
+    which returns None for identity, like the one of the server
+    """
+
+    def __init__(self, application, decompressor):
+        requests.adapters.BaseAdapter.__init__(self)
+        self._application = application
+        self._decompressor = decompressor
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        url = urlsplit(request.url)
+        body = request.body or b""
+        if hasattr(body, "__next__"): # streamed body
+            body = b"".join(chunk if isinstance(chunk, bytes) else chunk.encode("utf-8") for chunk in body)
+        elif isinstance(body, str):
+            body = body.encode("utf-8")
+        environ = {
+            "REQUEST_METHOD" : request.method,
+            "SCRIPT_NAME" : "",
+            "PATH_INFO" : url.path,
+            "QUERY_STRING" : url.query,
+            "SERVER_NAME" : "localhost",
+            "SERVER_PORT" : "80",
+            "SERVER_PROTOCOL" : "HTTP/1.1",
+            "CONTENT_LENGTH" : str(len(body)),
+            "CONTENT_TYPE" : request.headers.get("content-type", ""),
+            "wsgi.version" : (1, 0),
+            "wsgi.url_scheme" : "http",
+            "wsgi.input" : io.BytesIO(body),
+            "wsgi.errors" : sys.stderr,
+            "wsgi.multithread" : True,
+            "wsgi.multiprocess" : False,
+            "wsgi.run_once" : False,
+        }
+        for name, value in request.headers.items():
+            environ["HTTP_%s" % name.upper().replace("-", "_")] = value
+        response_start = {}
+        def start_response(status, headers, exc_info=None):
+            response_start["status"] = status
+            response_start["headers"] = headers
+        result = self._application(environ, start_response)
+        try:
+            content = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+        response = requests.Response()
+        response.status_code = int(response_start["status"].split()[0])
+        response.reason = response_start["status"].split(" ", 1)[-1]
+        response.headers = requests.structures.CaseInsensitiveDict(response_start["headers"])
+        decompress = self._decompressor(response.headers.get("content-encoding"))
+        if decompress is not None:
+            content = decompress.decompress(content)
+        response.raw = io.BytesIO(content)
+        response.url = request.url
+        response.request = request
+        response.encoding = "utf-8"
+        return response
+
+    def close(self):
+        pass
+
+
+class Benchmark(object):
+    """
+    runs server against temporary storage and measures client operations
+    """
+
+    def __init__(self, mode="inprocess"):
+        self._mode = mode
+        self._tempdir = tempfile.mkdtemp(prefix="restnosql_benchmark_")
+        config_file = os.path.join(self._tempdir, "RestNoSqlWebApp.json")
+        with open(config_file, "w") as outfile:
+            json.dump({IDKEY : {APIKEY : {"methods" : ["GET", "HEAD", "POST", "PUT", "DELETE", "OPTIONS", "PATCH"]}}}, outfile)
+        os.environ["RESTNOSQL_CONFIG"] = config_file
+        os.environ["RESTNOSQL_STORAGE_DIR"] = os.path.join(self._tempdir, "data")
+        sys.path.insert(0, os.path.join(BASEDIR, "server"))
+        sys.path.insert(0, os.path.join(BASEDIR, "client"))
+        import RestNoSqlWebApp
+        import RestNoSqlClient
+        self._webapp = RestNoSqlWebApp
+        self._client_class = RestNoSqlClient.RestNoSqlClient
+        self._server = None
+        if mode == "http":
+            from cheroot import wsgi
+            self._server = wsgi.Server(("127.0.0.1", 0), RestNoSqlWebApp.application, numthreads=32)
+            self._server.prepare()
+            threading.Thread(target=self._server.serve, daemon=True).start()
+            self._url = "http://127.0.0.1:%d" % self._server.bind_addr[1]
+        else:
+            self._url = "http://restnosql.inprocess"
+
+    def client(self):
+        """
+        return new client, with its own session
+        """
+        rnsc = self._client_class(url=self._url, apikey=APIKEY, idkey=IDKEY, cache=False)
+        if self._mode == "inprocess":
+            rnsc._session.mount(self._url, WsgiAdapter(self._webapp.application, self._webapp.decompressor))
+        return rnsc
+
+    def close(self):
+        if self._server is not None:
+            self._server.stop()
+        self._webapp.POOL.close()
+        shutil.rmtree(self._tempdir)
+
+    def _run_threads(self, target, partitions):
+        """
+        run target(rnsc, partition, latencies) in one thread per partition,
+        return wall time and list of latencies
+        """
+        latencies = []
+        threads = [threading.Thread(target=target, args=(self.client(), partition, latencies)) for partition in partitions]
+        starttime = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - starttime, latencies
+
+    def run(self, num_keys, value_size, concurrency, operations=OPERATIONS):
+        """
+        measure operations on num_keys keys with values of value_size bytes
+        from concurrency threads, return list of results
+        """
+        database = "benchmark_%d_%d_%d" % (num_keys, value_size, concurrency)
+        rnsc = self.client()
+        rnsc.create(database)
+        value = "x" * value_size
+        keys = ["key%08d" % index for index in range(num_keys)]
+        random.Random(num_keys).shuffle(keys) # reproducible order
+        partitions = [keys[index::concurrency] for index in range(concurrency)]
+
+        def do_set(rnsc, partition, latencies):
+            db = rnsc.open(database, mode="w")
+            for key in partition:
+                starttime = time.perf_counter()
+                db[key] = value
+                latencies.append(time.perf_counter() - starttime)
+
+        def do_get(rnsc, partition, latencies):
+            db = rnsc.open(database, mode="w")
+            for key in partition:
+                starttime = time.perf_counter()
+                db[key]
+                latencies.append(time.perf_counter() - starttime)
+
+        def do_list(rnsc, partition, latencies):
+            db = rnsc.open(database, mode="w")
+            starttime = time.perf_counter()
+            for key in db.keys():
+                pass
+            latencies.append(time.perf_counter() - starttime)
+
+        def do_delete(rnsc, partition, latencies):
+            db = rnsc.open(database, mode="w")
+            for key in partition:
+                starttime = time.perf_counter()
+                del db[key]
+                latencies.append(time.perf_counter() - starttime)
+
+        results = []
+        for operation in OPERATIONS: # order matters, set first and delete last
+            if operation not in operations and operation != "set":
+                continue
+            target = {"set" : do_set, "get" : do_get, "list" : do_list, "delete" : do_delete}[operation]
+            duration, latencies = self._run_threads(target, partitions)
+            if operation not in operations:
+                continue
+            latencies.sort()
+            results.append({
+                "operation" : operation,
+                "keys" : num_keys,
+                "value_size" : value_size,
+                "concurrency" : concurrency,
+                "ops" : len(latencies),
+                "seconds" : duration,
+                "ops_per_second" : len(latencies) / duration,
+                "p50_ms" : percentile(latencies, 0.5) * 1000,
+                "p99_ms" : percentile(latencies, 0.99) * 1000,
+            })
+            logging.info("%(operation)-6s keys=%(keys)-7d value_size=%(value_size)-7d concurrency=%(concurrency)-3d %(ops_per_second)10.1f ops/s p50 %(p50_ms)8.2f ms p99 %(p99_ms)8.2f ms", results[-1])
+        rnsc.delete(database)
+        return results
+
+
+def percentile(values, fraction):
+    """
+    return value at fraction of sorted values
+    """
+    if not values:
+        return 0.0
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+def version():
+    """
+    return git description of working tree, or unknown
+    """
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=BASEDIR, stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def int_list(text):
+    return [int(item) for item in text.split(",")]
+
+
+def main():
+    """
+    parse commandline and run benchmarks
+    """
+    parser = argparse.ArgumentParser(description="benchmark RestNoSql server and client against temporary storage")
+    parser.add_argument("--mode", choices=("inprocess", "http"), default="inprocess", help="call WSGI application in-process or thru localhost http server")
+    parser.add_argument("-k", "--keys", type=int_list, default=[1000], help="comma separated numbers of keys")
+    parser.add_argument("-s", "--value-sizes", type=int_list, default=[100, 10000], help="comma separated value sizes in bytes")
+    parser.add_argument("-c", "--concurrency", type=int_list, default=[1, 4], help="comma separated numbers of client threads")
+    parser.add_argument("--operations", default=",".join(OPERATIONS), help="comma separated operations to report, of %s" % ", ".join(OPERATIONS))
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="json file to store results")
+    args = parser.parse_args()
+    operations = args.operations.split(",")
+    benchmark = Benchmark(args.mode)
+    results = []
+    try:
+        for num_keys in args.keys:
+            for value_size in args.value_sizes:
+                for concurrency in args.concurrency:
+                    results.extend(benchmark.run(num_keys, value_size, concurrency, operations))
+    finally:
+        benchmark.close()
+    with open(args.output, "w") as outfile:
+        json.dump({
+            "version" : version(),
+            "timestamp" : time.time(),
+            "mode" : args.mode,
+            "python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "results" : results,
+        }, outfile, indent=4)
+    logging.info("results written to %s", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+# pylint: disable=line-too-long
+"""
+standalone RestNoSql server, without apache and mod_wsgi
+
+serves the web application with cheroot, with HTTP keep-alive, in one or
+more worker processes bound to the same port. every request, including
+streaming its response, runs in a bounded thread pool, so slow sqlite
+calls never block the server threads, which parse requests and send
+responses. if the pool and its queue are full, requests are answered
+with 429 and Retry-After, which the clients retry.
+
+SIGTERM or SIGINT stop accepting connections, requests in flight are
+finished within --shutdown-timeout seconds
+
+every worker process has its own pool of open databases, catalog and
+rate limits, so limits apply per process, and databases dropped by one
+process may be served by the others from still open files until they
+are restarted. drop databases with --workers 1, or restart afterwards
+"""
+import os
+import sys
+import queue
+import signal
+import threading
+import concurrent.futures
+import argparse
+import logging
+logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(asctime)s %(process)d %(message)s')
+
+BASEDIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# number of response chunks buffered between pool and server thread
+CHUNK_QUEUE_SIZE = 16
+
+
+class ExecutorApplication(object):
+    """
+    WSGI middleware running application in a thread pool of max_workers
+    threads, with at most max_pending requests running or waiting
+
+    the whole request runs in one thread of the pool, because web.py
+    keeps the request context per thread, chunks of the response are
+    handed over to the server thread thru a queue
+    """
+
+    def __init__(self, application, max_workers, max_pending):
+        self._application = application
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix="restnosql")
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def __call__(self, environ, start_response):
+        if not self._pending.acquire(blocking=False):
+            start_response("429 Too Many Requests", [("Retry-After", "1"), ("Content-Length", "0")])
+            return [b""]
+        chunks = queue.Queue(CHUNK_QUEUE_SIZE)
+        closed = threading.Event()
+        self._executor.submit(self._run, environ, chunks, closed)
+        first = chunks.get()
+        if isinstance(first, Exception):
+            closed.set()
+            raise first
+        status, headers = first
+        start_response(status, headers)
+        return self._iter_chunks(chunks, closed)
+
+    def _run(self, environ, chunks, closed):
+        """
+        call application and put (status, headers), every chunk of the
+        response and None at the end on chunks, or the exception raised
+        """
+        def put(item):
+            while not closed.is_set():
+                try:
+                    chunks.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    pass
+            return False # client went away
+        try:
+            started = []
+            def run_start_response(status, headers, exc_info=None):
+                started.append((status, headers))
+                put((status, headers))
+                return lambda data: put(data)
+            result = self._application(environ, run_start_response)
+            try:
+                for chunk in result:
+                    if not started: # application calls start_response lazily
+                        raise RuntimeError("start_response was not called")
+                    if chunk and not put(chunk):
+                        break
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+            put(None)
+        except Exception as exc:
+            logging.exception(exc)
+            put(exc)
+        finally:
+            self._pending.release()
+
+    def _iter_chunks(self, chunks, closed):
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        finally:
+            closed.set()
+
+    def shutdown(self):
+        """
+        wait until every request in the pool is finished
+        """
+        self._executor.shutdown(wait=True)
+
+
+def stop(signum, frame):
+    """
+    signal handler, the server is stopped gracefully by safe_start()
+    """
+    raise SystemExit(0)
+
+
+def serve(args, reuse_port=False):
+    """
+    serve application until SIGTERM or SIGINT
+    """
+    from cheroot import wsgi
+    import RestNoSqlWebApp
+    application = ExecutorApplication(RestNoSqlWebApp.application, args.executor_threads, args.max_pending)
+    server = wsgi.Server((args.host, args.port), application, numthreads=args.threads, timeout=args.keepalive_timeout, shutdown_timeout=args.shutdown_timeout, reuse_port=reuse_port)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logging.info("serving on http://%s:%d with %d threads and %d executor threads", args.host, args.port, args.threads, args.executor_threads)
+    try:
+        server.safe_start()
+    except SystemExit:
+        pass
+    finally:
+        application.shutdown()
+        RestNoSqlWebApp.POOL.close()
+        logging.info("stopped")
+
+
+def main():
+    """
+    parse commandline, start worker processes and wait for them
+    """
+    parser = argparse.ArgumentParser(description="standalone RestNoSql server")
+    parser.add_argument("--host", default="127.0.0.1", help="address to bind to")
+    parser.add_argument("-p", "--port", type=int, default=8080, help="port to bind to")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("-t", "--threads", type=int, default=32, help="server threads per worker, parsing requests and sending responses")
+    parser.add_argument("-e", "--executor-threads", type=int, default=16, help="threads per worker running requests against sqlite")
+    parser.add_argument("--max-pending", type=int, default=256, help="requests per worker running or waiting for executor, more are answered with 429")
+    parser.add_argument("--keepalive-timeout", type=int, default=10, help="seconds an idle keep-alive connection is kept open")
+    parser.add_argument("--shutdown-timeout", type=int, default=30, help="seconds to finish requests in flight on shutdown")
+    parser.add_argument("-c", "--config", help="config file of tenants and apikeys, default ~/RestNoSqlWebApp.json or RESTNOSQL_CONFIG")
+    parser.add_argument("-s", "--storage-dir", help="directory of databases, default /var/www/data or RESTNOSQL_STORAGE_DIR")
+    args = parser.parse_args()
+    # read by RestNoSqlWebApp at import
+    if args.config is not None:
+        os.environ["RESTNOSQL_CONFIG"] = os.path.abspath(args.config)
+    if args.storage_dir is not None:
+        os.environ["RESTNOSQL_STORAGE_DIR"] = os.path.abspath(args.storage_dir)
+    sys.path.insert(0, os.path.join(BASEDIR, "server"))
+    if args.workers == 1:
+        serve(args)
+        return
+    children = []
+    for _ in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(args, reuse_port=True)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def forward(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for pid in children:
+        while True:
+            try:
+                os.waitpid(pid, 0)
+                break
+            except InterruptedError:
+                pass
+    logging.info("all workers stopped")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,15 +11,15 @@ import sys
 import socket
 import json
 import threading
-import queue
+import concurrent.futures
 import argparse
 import logging
 logging.basicConfig(stream=sys.stdout, level=logging.INFO, format='%(message)s')
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 # own modules
-from webstorage import WebStorageArchiveClient as WebStorageArchiveClient
 from RestNoSqlClient import RestNoSqlClient as RestNoSqlClient
+from RestNoSqlClient import RestNoSqlDatabase as RestNoSqlDatabase
 
 def search_checksum(directory, checksum):
     """
@@ -47,69 +47,103 @@ def search_absfile(directory, absfile):
         except KeyError:
             print("\t not found")
 
-def create_nosql():
+class Progress(object):
     """
-    update or create local webstorage index database
+    thread safe counters of indexed files and operations sent,
+    throughput is logged every interval seconds
+    """
+
+    def __init__(self, interval=10):
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._starttime = time.time()
+        self._last_report = self._starttime
+        self.files = 0
+        self.operations = 0
+        self.new_files = 0
+
+    def add(self, files, operations, new_files):
+        with self._lock:
+            self.files += files
+            self.operations += operations
+            self.new_files += new_files
+            now = time.time()
+            if now - self._last_report < self._interval:
+                return
+            self._last_report = now
+        self.report()
+
+    def report(self):
+        duration = max(time.time() - self._starttime, 0.001)
+        logging.info("%d files (%d new) in %0.1f s, %0.1f files/s, %0.1f operations/s", self.files, self.new_files, duration, self.files / duration, self.operations / duration)
+
+
+def create_nosql(wsa, num_workers=4, batch_size=1000):
     """
-    num_worker_thread = 4
+    update or create local webstorage index database from backupsets
+    of this host in WebStorageArchiveClient wsa
+
+    num_workers backupsets are fetched and indexed concurrently,
+    see index_backupset(), batch_size is at most the batch size of
+    the client, so every batch is sent in one request
+    """
+    batch_size = min(batch_size, RestNoSqlDatabase.BATCH_SIZE)
     #rnsc.delete("absfilename_checksums")
     #rnsc.delete("checksum_backupset")
     #rnsc.delete("backupset_log")
-    # prepare queue and threads
-    q = queue.Queue()
-    threads = []
-    for i in range(num_worker_thread):
-        t = threading.Thread(target=checksum_thread, args=[q, ])
-        t.start()
-        threads.append(t)
     myhostname = socket.gethostname()
-    wsa = WebStorageArchiveClient()
     backupsets = wsa.get_backupsets(myhostname)
-    for backupset in backupsets:
-        print("working on backupset ", backupset["basename"])
-        if backupset["basename"] in db_backupsets.keys():
-            print("this backupset was already done on ", db_backupsets[backupset["basename"]])
-            continue
-        hostname, tag, isoformat_ext = backupset["basename"].split("_")
-        print(hostname, tag, backupset["date"], backupset["time"])
-        data = wsa.get(backupset["basename"])
-        for absfile in sorted(data["filedata"].keys()):
-            checksum = data["filedata"][absfile]["checksum"]
-            q.put([backupset, absfile, checksum]) # put in queue
-        logging.info("main thread is waiting")
-        q.join() # wait until queue is empty
-        logging.info("backupset finished")
-        if backupset["basename"] not in db_backupsets.keys():
-            db_backupsets[backupset["basename"]] = datetime.datetime.now().isoformat()
-    for i in range(num_worker_thread):
-        q.put(None)
-    for t in threads:
-        t.join()
+    progress = Progress()
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        futures = {executor.submit(index_backupset, wsa, backupset, batch_size, progress) : backupset for backupset in backupsets}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as exc:
+                logging.error("backupset %s failed, will resume on next run: %s", futures[future]["basename"], exc)
+    progress.report()
 
-def checksum_thread(myqueue):
-    # one session per thread
-    # until que is empty
-    while True:
-        item = myqueue.get()
-        if item is None:
-            break
-        backupset, absfilename, checksum = item
-        try:
-            # build absfilename to checksum KV
-            if absfilename in db_absfilename:
-                db_absfilename[absfilename].append(checksum)
-            else:
-                print("%s first appeared with checksum %s" % (absfilename, checksum))
-                db_absfilename[absfilename] = [checksum, ]
-            # build checksum to backupset KV
-            if backupset["datetime"] in db_checksum and backupset["datetime"] > db_checksum[checksum]["datetime"]:
-                db_checksum[checksum] = backupset
-            else:
-                print("%s first appeared in %s" % (checksum, backupset["basename"]))
-                db_checksum[checksum] = backupset
-        except Exception as exc:
-            logging.error(exc)
-        myqueue.task_done()
+def index_backupset(wsa, backupset, batch_size, progress):
+    """
+    fetch backupset and send its absfile/checksum pairs in batches of
+    batch_size absfiles, every batch is one atomic request per database
+
+    backupsets_log stores {"offset" : <number of absfiles done>} after every
+    batch and the datetime when finished, an interrupted run continues at
+    offset, merges are idempotent so a batch sent twice does no harm
+    """
+    basename = backupset["basename"]
+    try:
+        state = db_backupsets[basename]
+    except KeyError:
+        state = {"offset" : 0}
+    if not isinstance(state, dict):
+        logging.info("backupset %s was already done on %s", basename, state)
+        return
+    hostname, tag, isoformat_ext = basename.split("_")
+    logging.info("working on backupset %s %s %s %s from offset %d", hostname, tag, backupset["date"], backupset["time"], state["offset"])
+    data = wsa.get(basename)
+    absfiles = sorted(data["filedata"].keys())
+    # newest backupset of checksum is set once per backupset, also before offset
+    checksums_done = set(data["filedata"][absfile]["checksum"] for absfile in absfiles[:state["offset"]])
+    for offset in range(state["offset"], len(absfiles), batch_size):
+        pairs = [(absfile, data["filedata"][absfile]["checksum"]) for absfile in absfiles[offset:offset + batch_size]]
+        new_files = 0
+        # build absfilename to checksum KV, merged on server
+        results = db_absfilename.batch(["merge", absfile, "union", [checksum]] for absfile, checksum in pairs)
+        for (absfile, checksum), (status, value) in zip(pairs, results):
+            if value == [checksum]:
+                logging.debug("%s first appeared with checksum %s", absfile, checksum)
+                new_files += 1
+        # build checksum to backupset KV, keep newest backupset
+        checksums = sorted(set(checksum for absfile, checksum in pairs) - checksums_done)
+        if checksums:
+            db_checksum.batch(["merge", checksum, "max", backupset, "datetime"] for checksum in checksums)
+        checksums_done.update(checksums)
+        db_backupsets[basename] = {"offset" : offset + len(pairs)}
+        progress.add(len(pairs), len(pairs) + len(checksums), new_files)
+    db_backupsets[basename] = datetime.datetime.now().isoformat()
+    logging.info("backupset %s finished", basename)
 
 
 def main1():
@@ -143,12 +177,17 @@ def main1():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="update index of webstorage backupsets in RestNoSql")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="number of backupsets fetched and indexed concurrently")
+    parser.add_argument("-b", "--batch-size", type=int, default=1000, help="number of absfiles sent in one batch, at most %d" % RestNoSqlDatabase.BATCH_SIZE)
+    args = parser.parse_args()
+    from webstorage import WebStorageArchiveClient
     config = json.load(open(os.path.expanduser("~/.restnosql/config.json")))
-    rnsc = RestNoSqlClient(url=config["url"], apikey=config["apikey"], idkey=config["idkey"], proxies=config["proxies"])
+    rnsc = RestNoSqlClient(url=config["url"], apikey=config["apikey"], idkey=config["idkey"], proxies=config["proxies"], cache=False)
     with rnsc.open("backupsets_log") as db_backupsets:
         with rnsc.open("absfilename_checksums") as db_absfilename:
             with rnsc.open("checksum_backupset") as db_checksum:
-                create_nosql()
+                create_nosql(WebStorageArchiveClient(), args.workers, args.batch_size)
                 file_to_search = "/home/mesznera/Dokumente/Patidok_performance/videobenchmark/auswertung.ods"
                 checksums = search_absfile(tmpdir, file_to_search)
                 if checksums:
@@ -0,0 +1,426 @@
+#!/usr/bin/python3
+# pylint: disable=line-too-long
+"""
+asyncio RestFUL Webclient of RestNoSql, needs aiohttp
+
+all requests of one client share a connection pool bounded by
+concurrency, so one process can keep many requests in flight,
+run_many() and the *_many methods run operations concurrently
+"""
+import logging
+import json
+import asyncio
+from urllib.parse import urlsplit
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+from .RestNoSqlClient import range_params, compress_body, PreconditionFailed, ChangesIncomplete, STREAM_CHUNK_SIZE
+
+
+async def send_request(session, method, url, retries=5, **kwds):
+    """
+    async counterpart of RestNoSqlClient.send_request, if the server
+    answers 429 Too Many Requests wait as told by Retry-After, or
+    exponentially longer, and try again up to retries times
+
+    return response, which has to be released by the caller
+    """
+    for attempt in range(retries + 1):
+        res = await session.request(method, url, **kwds)
+        if res.status != 429 or attempt == retries:
+            return res
+        res.release()
+        try:
+            wait = float(res.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            wait = 0.1 * 2 ** attempt
+        logging.getLogger("AsyncRestNoSqlClient").info("server busy, retrying %s %s in %0.1f s", method, url, wait)
+        await asyncio.sleep(wait)
+
+
+async def run_many(function, arguments, concurrency=100):
+    """
+    await coroutine function with every argument, with at most
+    concurrency calls running at once, return list of results
+    in order of arguments
+    """
+    arguments = list(arguments)
+    results = [None] * len(arguments)
+    pending = iter(enumerate(arguments)) # shared by all workers
+
+    async def worker():
+        for index, argument in pending:
+            results[index] = await function(argument)
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(arguments)))))
+    return results
+
+
+class AsyncRestNoSqlClient(object):
+    """
+    asyncio counterpart of RestNoSqlClient
+
+        async with AsyncRestNoSqlClient(url, apikey, idkey) as rnsc:
+            db = await rnsc.open("name_of_database")
+            await db.set("somekey", "somevalue")
+    """
+
+    def __init__(self, url=None, apikey=None, idkey=None, proxies=None, concurrency=100, retries=5, compression="gzip"):
+        """
+        at most concurrency connections are opened to the server,
+        requests rejected by rate limits of the server are retried
+        up to retries times, large request bodies are compressed
+        with compression, see RestNoSqlClient
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncRestNoSqlClient needs aiohttp")
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._version = "0.1"
+        self._url = url
+        self._apikey = apikey
+        self._idkey = idkey
+        self._proxy = proxies.get(urlsplit(url).scheme) if proxies else None
+        self._headers = {
+            "user-agent": "%s-%s" % (self.__class__.__name__, self._version),
+            "x-apikey" : self._apikey,
+            "x-idkey" : self._idkey
+        }
+        self._concurrency = concurrency
+        self._retries = retries
+        self._compression = compression
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        """
+        close connection pool
+        """
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _send(self, method, url, data=None, params=None, headers=None, stream=False, etag=False):
+        """
+        single point of request, return body of response, with etag=True
+        (body, etag), or the response itself with stream=True
+        """
+        if self._session is None: # must be created inside the running loop
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self._concurrency), headers=self._headers)
+        res = await send_request(self._session, method, url, self._retries, data=data, params=params, headers=headers, proxy=self._proxy)
+        if not 199 < res.status < 300:
+            res.release()
+            if res.status == 412:
+                raise PreconditionFailed("HTTP_STATUS %s received" % res.status)
+            if res.status == 410:
+                raise ChangesIncomplete("HTTP_STATUS %s received" % res.status)
+            if 399 < res.status < 500:
+                raise KeyError("HTTP_STATUS %s received" % res.status)
+            raise IOError("HTTP_STATUS %s received" % res.status)
+        if stream:
+            return res
+        try:
+            if etag:
+                return await res.read(), res.headers.get("etag")
+            return await res.read()
+        finally:
+            res.release()
+
+    async def _request(self, method, path="", data=None, params=None, headers=None, stream=False):
+        return await self._send(method, "/".join((self._url, "manager", path)), data, params, headers, stream)
+
+    async def create(self, database, format=None, shards=None, indexes=None, type=None, max_entries=None, max_bytes=None, default_ttl=None):
+        """
+        create database if not existing, see RestNoSqlClient.create()
+        """
+        params = {}
+        if format is not None:
+            params["format"] = format
+        if shards is not None:
+            params["shards"] = shards
+        if indexes:
+            params["indexes"] = ",".join(indexes)
+        for name, value in (("type", type), ("max_entries", max_entries), ("max_bytes", max_bytes), ("default_ttl", default_ttl)):
+            if value is not None:
+                params[name] = value
+        await self._request("POST", database, params=params)
+
+    async def open(self, database, mode="c"):
+        """
+        return AsyncRestNoSqlDatabase object of database
+        """
+        if mode == "c" and not await self.exists(database): # HEAD only, see RestNoSqlClient.open()
+            await self.create(database)
+        return AsyncRestNoSqlDatabase(self, self._url + "/database/" + database)
+
+    async def delete(self, database):
+        await self._request("DELETE", database)
+
+    async def exists(self, database):
+        try:
+            await self._request("HEAD", database)
+            return True
+        except KeyError:
+            return False
+
+    async def list(self):
+        return json.loads(await self._request("OPTIONS"))
+
+    async def stats(self):
+        """
+        return statistics of every database, see RestNoSqlClient.stats()
+        """
+        return json.loads(await self._request("GET", params={"stats" : 1}))
+
+    async def metrics(self):
+        """
+        return metrics of tenant in prometheus text format
+        """
+        content = await self._send("GET", self._url + "/metrics")
+        return content.decode("utf-8")
+
+
+class AsyncRestNoSqlDatabase(object):
+    """
+    asyncio counterpart of RestNoSqlDatabase, with get, set, delete
+    and contains coroutines in place of item access
+
+    get_many, set_many and delete_many send BATCH_SIZE operations
+    per request, with up to concurrency requests in flight
+    """
+
+    # maximum number of operations sent in one batch request
+    BATCH_SIZE = 1000
+
+    def __init__(self, client, url):
+        self._client = client
+        self._url = url
+
+    async def _request(self, method, path="", data=None, params=None, stream=False, headers=None, etag=False):
+        """
+        single point of request
+        """
+        body, body_headers = compress_body(json.dumps(data), self._client._compression)
+        if headers is not None:
+            body_headers.update(headers)
+        return await self._client._send(method, "/".join((self._url, path)), body, params, body_headers, stream, etag)
+
+    async def get(self, key):
+        """
+        return value of key, raise KeyError if key does not exist
+        """
+        return json.loads(await self._request("GET", data=key))
+
+    async def set(self, key, value, ttl=None):
+        """
+        set key to value, in cache databases key expires after ttl seconds
+        """
+        await self._request("POST", data=[key, value], params=None if ttl is None else {"ttl" : ttl})
+
+    async def delete(self, key):
+        await self._request("DELETE", data=key)
+
+    async def get_version(self, key):
+        """
+        return (value, version) of key, see RestNoSqlDatabase.get_version()
+        """
+        content, version = await self._request("GET", data=key, etag=True)
+        return json.loads(content), version
+
+    async def set_if(self, key, value, version):
+        """
+        set key to value, only if key still has version, or does not exist
+        with version None, raise PreconditionFailed otherwise, return new version
+        """
+        headers = {"if-none-match" : "*"} if version is None else {"if-match" : version}
+        return (await self._request("POST", data=[key, value], headers=headers, etag=True))[1]
+
+    async def delete_if(self, key, version):
+        await self._request("DELETE", data=key, headers={"if-match" : version})
+
+    async def update(self, key, function, default=None, retries=10):
+        """
+        set key to function(value) with compare and swap,
+        see RestNoSqlDatabase.update()
+        """
+        for attempt in range(retries + 1):
+            try:
+                value, version = await self.get_version(key)
+            except KeyError:
+                value, version = default, None
+            value = function(value)
+            try:
+                await self.set_if(key, value, version)
+                return value
+            except PreconditionFailed:
+                if attempt == retries:
+                    raise
+
+    async def merge(self, key, operator, argument, field=None):
+        """
+        update value of key atomically on server, return new value,
+        see RestNoSqlDatabase.merge()
+        """
+        operation = [key, operator, argument] if field is None else [key, operator, argument, field]
+        return json.loads(await self._request("POST", "_merge", data=operation))
+
+    async def contains(self, key):
+        try:
+            await self._request("HEAD", params={"key" : key})
+            return True
+        except KeyError:
+            return False
+
+    async def keys(self, prefix=None, start=None, end=None, reverse=False, limit=None):
+        """
+        yield keys in order, or descending with reverse, read page by page,
+        optionally limited to prefix, start <= key < end and limit keys
+        """
+        params = range_params(prefix, start, end, reverse)
+        remaining = limit
+        while remaining is None or remaining > 0:
+            params["limit"] = self.BATCH_SIZE if remaining is None else min(self.BATCH_SIZE, remaining)
+            page = json.loads(await self._request("OPTIONS", params=params))
+            for key in page["keys"]:
+                yield key
+            if page["next"] is None:
+                break
+            params["before" if reverse else "after"] = page["next"]
+            if remaining is not None:
+                remaining -= len(page["keys"])
+
+    async def scan(self, prefix=None, start=None, end=None, reverse=False, limit=None):
+        """
+        yield (key, value) in key order, streamed from the server
+        in one response, same arguments as keys()
+        """
+        res = await self._request("GET", "_scan", params=range_params(prefix, start, end, reverse, limit), stream=True)
+        try:
+            rest = b""
+            async for chunk in res.content.iter_chunked(STREAM_CHUNK_SIZE):
+                lines = (rest + chunk).split(b"\n")
+                rest = lines.pop()
+                for line in lines:
+                    if line:
+                        key, value = json.loads(line.decode("utf-8"))
+                        yield key, value
+            if rest:
+                key, value = json.loads(rest.decode("utf-8"))
+                yield key, value
+        finally:
+            res.release()
+
+    async def query(self, field, eq=None, start=None, end=None, reverse=False, limit=None, keys_only=False):
+        """
+        yield (key, value), or keys only, of values by indexed field,
+        see RestNoSqlDatabase.query()
+        """
+        params = {"field" : field}
+        for name, bound in (("eq", eq), ("start", start), ("end", end)):
+            if bound is not None:
+                params[name] = json.dumps(bound)
+        params.update(range_params(reverse=reverse, limit=limit))
+        if keys_only:
+            params["keys_only"] = 1
+        res = await self._request("GET", "_query", params=params, stream=True)
+        try:
+            rest = b""
+            async for chunk in res.content.iter_chunked(STREAM_CHUNK_SIZE):
+                lines = (rest + chunk).split(b"\n")
+                rest = lines.pop()
+                for line in lines:
+                    if line:
+                        item = json.loads(line.decode("utf-8"))
+                        yield item if keys_only else tuple(item)
+            if rest:
+                item = json.loads(rest.decode("utf-8"))
+                yield item if keys_only else tuple(item)
+        finally:
+            res.release()
+
+    async def changes(self, cursor=None, limit=None, wait=None):
+        """
+        return cursor and async iterator of changes after cursor,
+        see RestNoSqlDatabase.changes()
+        """
+        params = {}
+        if cursor is not None:
+            params["since"] = json.dumps(cursor["since"])
+            params["created"] = json.dumps(cursor["created"])
+        if limit is not None:
+            params["limit"] = limit
+        if wait is not None:
+            params["wait"] = wait
+        res = await self._request("GET", "_changes", params=params, stream=True)
+        cursor = {"since" : json.loads(res.headers["x-changes-since"]), "created" : json.loads(res.headers["x-changes-created"])}
+
+        async def iter_changes():
+            try:
+                async for line in res.content:
+                    if line.strip():
+                        change = json.loads(line.decode("utf-8"))
+                        cursor["since"][change["shard"]] = change["seq"]
+                        yield change
+            finally:
+                res.release()
+        return cursor, iter_changes()
+
+    def items(self, prefix=None):
+        return self.scan(prefix)
+
+    async def batch(self, operations):
+        """
+        run list of operations like ["get", key], ["set", key, value]
+        or ["delete", key] on server, return list of [status, value]
+
+        operations are sent one chunk of BATCH_SIZE after the other,
+        every chunk is one transaction on server side
+        """
+        operations = list(operations)
+        results = []
+        for index in range(0, len(operations), self.BATCH_SIZE):
+            results.extend(json.loads(await self._request("POST", "_batch", data=operations[index:index + self.BATCH_SIZE])))
+        return results
+
+    async def _batch_many(self, operations, concurrency):
+        """
+        send chunks of operations concurrently, return list of [status, value]
+        """
+        chunks = [operations[index:index + self.BATCH_SIZE] for index in range(0, len(operations), self.BATCH_SIZE)]
+        results = await run_many(self.batch, chunks, concurrency)
+        return [result for chunk in results for result in chunk]
+
+    async def _get_chunk(self, keys):
+        """
+        return list of [status, value] of keys, needs GET permission only
+        """
+        return json.loads(await self._request("GET", "_batch", data=keys))
+
+    async def get_many(self, keys, default=None, concurrency=10):
+        """
+        return list of values of keys, default for not existing keys
+        """
+        keys = list(keys)
+        chunks = [keys[index:index + self.BATCH_SIZE] for index in range(0, len(keys), self.BATCH_SIZE)]
+        results = await run_many(self._get_chunk, chunks, concurrency)
+        results = [result for chunk in results for result in chunk]
+        return [value if status == 200 else default for status, value in results]
+
+    async def set_many(self, items, concurrency=10):
+        """
+        set multiple keys, items is dict or iterable of (key, value),
+        of repeated keys the last value is set
+        """
+        items = dict(items) # chunks run concurrently, keys must be unique
+        await self._batch_many([["set", key, value] for key, value in items.items()], concurrency)
+
+    async def delete_many(self, keys, concurrency=10):
+        """
+        delete multiple keys, not existing keys are ignored
+        """
+        await self._batch_many([["delete", key] for key in dict.fromkeys(keys)], concurrency)
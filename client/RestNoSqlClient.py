@@ -5,13 +5,224 @@ RestFUL Webclient to use BlockStorage WebApps
 """
 import logging
 import json
+import time
+import collections
+import threading
+import zlib
+import hashlib
+import base64
+import sqlite3
 import requests
+import urllib3
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# bytes read at once from streamed responses
+STREAM_CHUNK_SIZE = 64 * 1024
+# request bodies smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+# response encodings requests is able to decode
+ACCEPT_ENCODING = ", ".join(encoding for encoding in ("zstd", "gzip", "deflate") if encoding in urllib3.response.HTTPResponse.CONTENT_DECODERS)
+
+
+def compress_chunks(chunks, encoding="gzip"):
+    """
+    yield chunks of bytes compressed with gzip or zstd
+    """
+    if encoding == "zstd":
+        compress = zstandard.ZstdCompressor().compressobj()
+    else:
+        compress = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compress.compress(chunk)
+        if data:
+            yield data
+    yield compress.flush()
+
+
+def compress_body(body, encoding):
+    """
+    return body as bytes and headers, body is compressed with encoding
+    if it is at least COMPRESS_MIN_SIZE long and encoding is not None
+    """
+    body = body.encode("utf-8")
+    if encoding is None or len(body) < COMPRESS_MIN_SIZE:
+        return body, {}
+    return b"".join(compress_chunks((body, ), encoding)), {"content-encoding" : encoding}
+
+
+def send_request(session, method, url, retries=5, **kwds):
+    """
+    send request, if the server answers 429 Too Many Requests, wait as
+    long as told by Retry-After, or exponentially longer, and try again
+    up to retries times. streamed request bodies cannot be sent twice
+    """
+    replayable = not hasattr(kwds.get("data"), "__next__") and not hasattr(kwds.get("data"), "read")
+    for attempt in range(retries + 1):
+        res = session.request(method, url, **kwds)
+        if res.status_code != 429 or attempt == retries or not replayable:
+            return res
+        try:
+            wait = float(res.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            wait = 0.1 * 2 ** attempt
+        logging.getLogger("RestNoSqlClient").info("server busy, retrying %s %s in %0.1f s", method, url, wait)
+        time.sleep(wait)
+
+
+class PreconditionFailed(KeyError):
+    """
+    conditional write failed, because the version of the key changed
+    """
+    pass
+
+
+class ChangesIncomplete(KeyError):
+    """
+    changes since cursor are not available anymore, because they
+    were trimmed or the database was created again, copy it again
+    """
+    pass
+
+
+class BloomFilter(object):
+    """
+    bloom filter of keys downloaded from server, with the same
+    hashing as BloomFilter of RestNoSqlWebApp
+    """
+
+    def __init__(self, bits, hashes, data):
+        self.bits = bits
+        self.hashes = hashes
+        self.filter = bytearray(data)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(str(key).encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + index * second) % self.bits for index in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.filter[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.filter[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class LruCache(object):
+    """
+    thread safe LRU cache of json encoded values, bounded by
+    number of entries and sum of bytes, entries expire after ttl seconds
+
+    counters of hits, misses and evictions are returned by stats()
+
+    expired entries with etag are kept until evicted, to be revalidated
+    with the server, see stale()
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # key : (expires, data, etag)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        return cached data of key or None
+        """
+        with self._lock:
+            if key in self._entries:
+                expires, data, etag = self._entries[key]
+                if expires > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return data
+                if etag is None:
+                    self._remove(key)
+            self.misses += 1
+            return None
+
+    def stale(self, key):
+        """
+        return (data, etag) of expired entry with etag, or None
+        """
+        with self._lock:
+            if key in self._entries:
+                expires, data, etag = self._entries[key]
+                if etag is not None:
+                    return data, etag
+            return None
+
+    def put(self, key, data, ttl, etag=None):
+        """
+        cache data for ttl seconds, evict least recently used entries
+        """
+        if len(data) > self._max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + ttl, data, etag)
+            self._bytes += len(data)
+            while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        """
+        must be called with self._lock held
+        """
+        self._bytes -= len(self._entries.pop(key)[1])
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """
+        return dict of counters and size
+        """
+        with self._lock:
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "entries" : len(self._entries),
+                "bytes" : self._bytes,
+            }
+
 
 class RestNoSqlClient(object):
     """stores chunks of data into BlockStorage"""
 
-    def __init__(self, url=None, apikey=None, idkey=None, cache=True, proxies=None):
-        """__init__"""
+    def __init__(self, url=None, apikey=None, idkey=None, cache=True, proxies=None, cache_entries=10000, cache_bytes=64 * 1024 * 1024, cache_ttl=60, retries=5, compression="gzip"):
+        """
+        with cache=True values read are cached for cache_ttl seconds,
+        own writes invalidate cached values, the cache is shared by all
+        opened databases and bounded by cache_entries and cache_bytes
+
+        requests rejected by rate limits of the server are retried
+        up to retries times
+
+        request bodies of at least COMPRESS_MIN_SIZE bytes are sent
+        compressed with compression, gzip or zstd, None to disable,
+        responses are compressed by the server as advertised
+        """
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("compression zstd needs zstandard")
         self._logger = logging.getLogger(self.__class__.__name__)
         self._version = "0.1"
         self._url = url
@@ -21,20 +232,29 @@ class RestNoSqlClient(object):
         self._headers = {
             "user-agent": "%s-%s" % (self.__class__.__name__, self._version),
             "x-apikey" : self._apikey,
-            "x-idkey" : self._idkey
+            "x-idkey" : self._idkey,
+            "accept-encoding" : ACCEPT_ENCODING
         }
         #self._proxies = {
         #    "http" : "ubuntu.tilak.cc:3128",
         #    "https" : "ubuntu.tilak.cc:3128"
         #    }
         self._session = requests.session()
+        self._retries = retries
+        self._compression = compression
+        self._cache_ttl = cache_ttl
+        self.cache = LruCache(cache_entries, cache_bytes) if cache else None
 
-    def _request(self, method, path="", data=None):
+    def _request(self, method, path="", data=None, params=None, headers=None, stream=False):
         """
         single point of request
         """
         url = "/".join((self._url, "manager", path))
-        res = self._session.request(method, url, data=data, headers=self._headers, proxies=self._proxies)
+        if headers is not None:
+            headers = dict(self._headers, **headers)
+        else:
+            headers = self._headers
+        res = send_request(self._session, method, url, self._retries, data=data, params=params, headers=headers, proxies=self._proxies, stream=stream)
         if 199 < res.status_code < 300:
             return res
         elif 399 < res.status_code < 500:
@@ -42,29 +262,161 @@ class RestNoSqlClient(object):
         elif 499 < res.status_code < 600:
             raise IOError("HTTP_STATUS %s received" % res.status_code)
 
-    def create(self, database):
-        self._request("POST", database)
+    def create(self, database, format=None, shards=None, indexes=None, type=None, max_entries=None, max_bytes=None, default_ttl=None):
+        """
+        create database if not existing, format selects the storage
+        format json or pickle, default is up to the server, shards
+        splits the database into files written in parallel, indexes
+        is a list of fields of values to query by, see query(),
+        settings of existing databases are not changed
+
+        type="cache" creates a cache, keys expire after default_ttl
+        seconds or ttl given to set(), least recently used keys are
+        evicted if there are more than max_entries keys or max_bytes
 
-    def open(self, database, mode="c"):
-        if mode == "c": # create if not exists
-            if database not in self.list():
-                self.create(database)
-        return RestNoSqlDatabase(self._url + "/database/" + database, self._session, self._apikey, self._headers, self._proxies)
+        return True if database was created
+        """
+        params = {}
+        if format is not None:
+            params["format"] = format
+        if shards is not None:
+            params["shards"] = shards
+        if indexes:
+            params["indexes"] = ",".join(indexes)
+        for name, value in (("type", type), ("max_entries", max_entries), ("max_bytes", max_bytes), ("default_ttl", default_ttl)):
+            if value is not None:
+                params[name] = value
+        return self._request("POST", database, params=params).status_code == 201
+
+    def migrate(self, database):
+        """
+        convert database to json storage format,
+        return number of converted values
+        """
+        return self._request("PATCH", database).json()["converted"]
+
+    def configure(self, database, **settings):
+        """
+        change settings of database, like journal_mode="WAL",
+        synchronous="NORMAL" or indexes=["datetime"], return all settings
+        """
+        return self._request("PATCH", database, data=json.dumps(settings)).json()
+
+    def open(self, database, mode="c", buffered=False, max_pending=1000, flush_interval=None, cache_ttl=None, bloom_ttl=None):
+        """
+        return RestNoSqlDatabase object of database
+
+        with buffered=True writes and deletes are collected and sent
+        in batches, see RestNoSqlDatabase
+
+        cache_ttl overrides the cache ttl of the client for this database
+
+        with bloom_ttl "key in db" is answered by a bloom filter of keys,
+        refreshed after bloom_ttl seconds, see RestNoSqlDatabase
+        """
+        if mode == "c" and not self.exists(database): # HEAD only, apikeys without POST can open existing databases
+            self.create(database)
+        if cache_ttl is None:
+            cache_ttl = self._cache_ttl
+        return RestNoSqlDatabase(self._url + "/database/" + database, self._session, self._apikey, self._headers, self._proxies, buffered=buffered, max_pending=max_pending, flush_interval=flush_interval, cache=self.cache, cache_ttl=cache_ttl, retries=self._retries, compression=self._compression, bloom_ttl=bloom_ttl)
+
+    def cache_stats(self):
+        """
+        return counters of value cache, or None if caching is disabled
+        """
+        if self.cache is not None:
+            return self.cache.stats()
 
     def delete(self, database):
         self._request("DELETE", database)
 
+    def import_data(self, database, source, format="ndjson", truncate=False):
+        """
+        load data into database in one transaction on the server,
+        database is created if necessary, return number of keys loaded
+
+        source is a file opened in binary mode, containing newline
+        delimited json [key, value] or one json object with format="json",
+        or any iterable of (key, value), which is streamed as ndjson,
+        with truncate=True the database is emptied first
+        """
+        if not hasattr(source, "read"):
+            source = ("%s\n" % json.dumps([key, value]) for key, value in source)
+            source = (line.encode("utf-8") for line in source)
+            format = "ndjson"
+        headers = {"content-type" : "application/x-ndjson" if format == "ndjson" else "application/json"}
+        if self._compression is not None:
+            if hasattr(source, "read"):
+                infile = source
+                source = iter(lambda: infile.read(STREAM_CHUNK_SIZE), b"")
+            source = compress_chunks(source, self._compression)
+            headers["content-encoding"] = self._compression
+        params = {"truncate" : 1} if truncate else None
+        res = self._request("PUT", database, data=source, params=params, headers=headers)
+        return res.json()["loaded"]
+
+    def export_data(self, database, outfile=None):
+        """
+        stream all (key, value) of database, consistent at start of export
+
+        with outfile, opened in binary mode, the newline delimited json is
+        written to outfile, otherwise an iterator of (key, value) is returned
+        """
+        res = self._request("GET", database, stream=True)
+        if outfile is not None:
+            for chunk in res.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                outfile.write(chunk)
+            return None
+        return (tuple(json.loads(line.decode("utf-8"))) for line in res.iter_lines(chunk_size=STREAM_CHUNK_SIZE) if line)
+
     def exists(self, database):
-        return database in self.list()
+        try:
+            self._request("HEAD", database)
+            return True
+        except KeyError:
+            return False
 
     def list(self):
         res = self._request("OPTIONS")
         return res.json()
 
+    def stats(self):
+        """
+        return dict of database : {"keys", "size", "modified", "created",
+        "shards", "format"} of every database, size in bytes, modified
+        and created in seconds since epoch
+        """
+        return self._request("GET", params={"stats" : 1}).json()
+
+    def metrics(self):
+        """
+        return metrics of tenant in prometheus text format
+        """
+        res = send_request(self._session, "GET", self._url + "/metrics", self._retries, headers=self._headers, proxies=self._proxies)
+        res.raise_for_status()
+        return res.text
+
 class RestNoSqlDatabase(object):
+    """
+    dict like access to one database
 
+    in buffered mode, writes and deletes are kept in memory, repeated
+    writes to the same key are merged, and everything is sent in batches
+    if max_pending keys are pending, flush_interval seconds passed since
+    the first pending change, on flush() or when leaving the with block.
+    reads of pending keys are answered from the buffer, deleting a not
+    existing key does not raise KeyError in buffered mode.
 
-    def __init__(self, url, session, apikey, headers, proxies):
+    with bloom_ttl "key in db" is answered False without request, if
+    key is not in the bloom filter of the database, which is refreshed
+    with keys written since after bloom_ttl seconds, keys written by
+    other clients may be missed until then. own writes are added at once
+    """
+
+    # maximum number of operations sent in one batch request
+    BATCH_SIZE = 1000
+
+    def __init__(self, url, session, apikey, headers, proxies, buffered=False, max_pending=1000, flush_interval=None, cache=None, cache_ttl=60, retries=5, compression=None, bloom_ttl=None):
         """__init__"""
         self._logger = logging.getLogger(self.__class__.__name__)
         self._version = "0.1"
@@ -73,17 +425,37 @@ class RestNoSqlDatabase(object):
         self._headers = headers
         self._proxies = proxies
         self._session = session
-        self._keys = None
         self._data = {}
+        self._buffered = buffered
+        self._max_pending = max_pending
+        self._flush_interval = flush_interval
+        self._pending = collections.OrderedDict() # key : ["set", key, value] or ["delete", key]
+        self._pending_since = None
+        self._cache = cache
+        self._cache_ttl = cache_ttl
+        self._retries = retries
+        self._compression = compression
+        self._bloom_ttl = bloom_ttl
+        self._bloom = None
+        self._bloom_state = None # (created, sequence) of last response
+        self._bloom_loaded = 0
 
-    def _request(self, method, path="", data=None):
+    def _request(self, method, path="", data=None, params=None, stream=False, headers=None):
         """
         single point of request
         """
         url = "/".join((self._url, path))
-        res = self._session.request(method, url, data=json.dumps(data), headers=self._headers, proxies=self._proxies)
-        if 199 < res.status_code < 300:
+        body, body_headers = compress_body(json.dumps(data), self._compression)
+        request_headers = dict(self._headers, **body_headers)
+        if headers is not None:
+            request_headers.update(headers)
+        res = send_request(self._session, method, url, self._retries, data=body, params=params, headers=request_headers, proxies=self._proxies, stream=stream)
+        if 199 < res.status_code < 300 or res.status_code == 304:
             return res
+        elif res.status_code == 412:
+            raise PreconditionFailed("HTTP_STATUS %s received" % res.status_code)
+        elif res.status_code == 410:
+            raise ChangesIncomplete("HTTP_STATUS %s received" % res.status_code)
         elif 399 < res.status_code < 500:
             raise KeyError("HTTP_STATUS %s received" % res.status_code)
         elif 499 < res.status_code < 600:
@@ -93,38 +465,557 @@ class RestNoSqlDatabase(object):
         return self
 
     def __exit__(self, *args):
-        pass
+        self.flush()
+
+    def _buffer(self, key, operation):
+        """
+        put operation on pending changes, flush if thresholds are reached
+        """
+        self._pending.pop(key, None)
+        self._pending[key] = operation
+        if self._pending_since is None:
+            self._pending_since = time.time()
+        if len(self._pending) >= self._max_pending:
+            self.flush()
+        elif self._flush_interval is not None and time.time() - self._pending_since >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        send pending changes to server
+        """
+        if self._pending:
+            operations = list(self._pending.values())
+            self._pending.clear()
+            self._pending_since = None
+            self.batch(operations)
 
     def __contains__(self, item):
         """ mimic x in y behaviour """
         # print("contains %s" % item)
-        return item in self.keys()
+        if item in self._pending:
+            return self._pending[item][0] == "set"
+        if self._bloom_ttl is not None:
+            if time.time() - self._bloom_loaded >= self._bloom_ttl:
+                self.refresh_bloom()
+            if item not in self._bloom:
+                return False
+        try:
+            self._request("HEAD", params={"key" : item})
+            return True
+        except KeyError:
+            return False
 
-    def keys(self):
-        if self._keys is None:
-            self._keys = self._request("OPTIONS").json()
-        return self._keys
+    def refresh_bloom(self):
+        """
+        download bloom filter of keys, or only keys written since last refresh
+        """
+        params = None
+        if self._bloom is not None:
+            params = {"since" : json.dumps(self._bloom_state[1]), "created" : json.dumps(self._bloom_state[0])}
+        data = self._request("GET", "_bloom", params=params).json()
+        if "filter" in data:
+            self._bloom = BloomFilter(data["bits"], data["hashes"], base64.b64decode(data["filter"]))
+        elif data["bits"] != self._bloom.bits: # rebuilt on server
+            self._bloom = None
+            return self.refresh_bloom()
+        else:
+            for key in data["keys"]:
+                self._bloom.add(key)
+        self._bloom_state = (data["created"], data["sequence"])
+        self._bloom_loaded = time.time()
+
+    def keys(self, prefix=None, stream=False, start=None, end=None, reverse=False, limit=None):
+        """
+        return lazy iterable of keys in order, starting with prefix,
+        read page by page or streamed as one response with stream=True
+
+        start <= key < end limits the range of keys, reverse
+        returns keys in descending order, limit the number of keys
+        """
+        self.flush()
+        return RestNoSqlKeys(self, prefix, stream, start, end, reverse, limit)
 
     def __getitem__(self, key):
+        if key in self._pending:
+            if self._pending[key][0] == "delete":
+                raise KeyError(key)
+            return self._pending[key][2]
+        if self._cache is None:
+            return self._request("GET", data=key).json()
+        data = self._cache.get((self._url, key))
+        if data is not None:
+            return json.loads(data.decode("utf-8"))
+        stale = self._cache.stale((self._url, key))
+        if stale is not None: # revalidate expired value
+            res = self._request("GET", data=key, headers={"if-none-match" : stale[1]})
+            data = stale[0] if res.status_code == 304 else res.content
+        else:
+            res = self._request("GET", data=key)
+            data = res.content
+        self._cache.put((self._url, key), data, self._cache_ttl, res.headers.get("etag"))
+        return json.loads(data.decode("utf-8"))
+
+    def get_version(self, key):
+        """
+        return (value, version) of key, raise KeyError if key does not exist,
+        version is used for conditional writes with set_if() and delete_if()
+        """
+        self.flush()
         res = self._request("GET", data=key)
-        return res.json()
+        return res.json(), res.headers["etag"]
+
+    def set_if(self, key, value, version):
+        """
+        set key to value, only if key still has version, or does not exist
+        with version None, raise PreconditionFailed otherwise, return new version
+        """
+        self.flush()
+        self._invalidate((key, ))
+        if version is None:
+            headers = {"if-none-match" : "*"}
+        else:
+            headers = {"if-match" : version}
+        return self._request("POST", data=[key, value], headers=headers).headers["etag"]
+
+    def delete_if(self, key, version):
+        """
+        delete key, only if key still has version, raise PreconditionFailed otherwise
+        """
+        self.flush()
+        self._invalidate((key, ))
+        self._request("DELETE", data=key, headers={"if-match" : version})
+
+    def update(self, key, function, default=None, retries=10):
+        """
+        set key to function(value) with compare and swap, read value again and
+        retry if key was changed meanwhile, default is passed to function if key
+        does not exist, raise PreconditionFailed after retries, return new value
+        """
+        for attempt in range(retries + 1):
+            try:
+                value, version = self.get_version(key)
+            except KeyError:
+                value, version = default, None
+            value = function(value)
+            try:
+                self.set_if(key, value, version)
+                return value
+            except PreconditionFailed:
+                if attempt == retries:
+                    raise
+                self._logger.debug("key %s changed, retrying update", key)
+
+    def _invalidate(self, keys):
+        """
+        drop cached values of keys written or deleted by this client,
+        written keys are added to the bloom filter
+        """
+        for key in keys:
+            if self._cache is not None:
+                self._cache.invalidate((self._url, key))
+            if self._bloom is not None:
+                self._bloom.add(key)
 
     def __setitem__(self, key, value):
-        res = self._request("POST", data=[key, value])
-        self._keys.append(key)
+        self._invalidate((key, ))
+        if self._buffered:
+            self._buffer(key, ["set", key, value])
+        else:
+            res = self._request("POST", data=[key, value])
+
+    def set(self, key, value, ttl=None):
+        """
+        set key to value, in cache databases key expires after ttl seconds
+        """
+        self._invalidate((key, ))
+        if self._buffered:
+            self._buffer(key, ["set", key, value] if ttl is None else ["set", key, value, ttl])
+        elif ttl is None:
+            self._request("POST", data=[key, value])
+        else:
+            self._request("POST", data=[key, value], params={"ttl" : ttl})
 
     def __delitem__(self, key):
-        res = self._request("DELETE", data=key)
-        self._keys.remove(key)
+        self._invalidate((key, ))
+        if self._buffered:
+            self._buffer(key, ["delete", key])
+        else:
+            res = self._request("DELETE", data=key)
 
-    def items(self):
-        for key in self.keys():
-            yield (key, self[key])
+    def merge(self, key, operator, argument, field=None):
+        """
+        update value of key atomically on server, return new value
+
+        operator is append, union (of lists), increment, max or min,
+        max and min compare field of values, if field is given
+        """
+        self.flush()
+        self._invalidate((key, ))
+        operation = [key, operator, argument] if field is None else [key, operator, argument, field]
+        return self._request("POST", "_merge", data=operation).json()
+
+    def batch(self, operations):
+        """
+        run list of operations like ["get", key], ["set", key, value],
+        ["delete", key] or ["merge", key, operator, argument] on server,
+        return list of [status, value]
+
+        operations are sent in chunks of BATCH_SIZE,
+        every chunk is one transaction on server side,
+        pending changes of buffered mode are sent before
+        """
+        self.flush()
+        operations = list(operations)
+        self._invalidate(operation[1] for operation in operations if operation[0] != "get")
+        results = []
+        for index in range(0, len(operations), self.BATCH_SIZE):
+            res = self._request("POST", "_batch", data=operations[index:index + self.BATCH_SIZE])
+            results.extend(res.json())
+        return results
+
+    def get_many(self, keys, default=None):
+        """
+        return list of values of keys, default for not existing keys,
+        only keys not found in cache are requested, in chunks of
+        BATCH_SIZE, which needs GET permission only
+        """
+        keys = list(keys)
+        values = {}
+        missing = []
+        for key in keys:
+            if key in self._pending or self._cache is None:
+                missing.append(key)
+                continue
+            data = self._cache.get((self._url, key))
+            if data is not None:
+                values[key] = json.loads(data.decode("utf-8"))
+            else:
+                missing.append(key)
+        self.flush()
+        results = []
+        for index in range(0, len(missing), self.BATCH_SIZE):
+            results.extend(self._request("GET", "_batch", data=missing[index:index + self.BATCH_SIZE]).json())
+        for key, (status, value) in zip(missing, results):
+            if status == 200:
+                values[key] = value
+                if self._cache is not None:
+                    self._cache.put((self._url, key), json.dumps(value).encode("utf-8"), self._cache_ttl)
+        return [values.get(key, default) for key in keys]
 
-    def values(self):
-        for key in self.keys():
-            yield self[key]
+    def set_many(self, items):
+        """
+        set multiple keys, items is dict or iterable of (key, value)
+        """
+        if isinstance(items, dict):
+            items = items.items()
+        self.batch(["set", key, value] for key, value in items)
+
+    def delete_many(self, keys):
+        """
+        delete multiple keys, not existing keys are ignored
+        """
+        self.batch(["delete", key] for key in keys)
+
+    def scan(self, prefix=None, start=None, end=None, batch=None, reverse=False, limit=None):
+        """
+        yield (key, value) in key order, or descending with reverse,
+        streamed from the server in one response, optionally limited
+        to prefix, start <= key < end and limit pairs
+        """
+        self.flush()
+        params = range_params(prefix, start, end, reverse, limit)
+        if batch is not None:
+            params["batch"] = batch
+        res = self._request("GET", "_scan", params=params, stream=True)
+        for line in res.iter_lines(chunk_size=STREAM_CHUNK_SIZE):
+            if line:
+                key, value = json.loads(line.decode("utf-8"))
+                yield key, value
+
+    def query(self, field, eq=None, start=None, end=None, reverse=False, limit=None, keys_only=False):
+        """
+        yield (key, value), or keys only, of values with indexed field
+        equal eq, or start <= field < end, in order of field value and key,
+        answered by the index of field on the server, KeyError if field
+        is not indexed, see RestNoSqlClient.create()
+        """
+        self.flush()
+        params = {"field" : field}
+        for name, bound in (("eq", eq), ("start", start), ("end", end)):
+            if bound is not None:
+                params[name] = json.dumps(bound)
+        params.update(range_params(reverse=reverse, limit=limit))
+        if keys_only:
+            params["keys_only"] = 1
+        res = self._request("GET", "_query", params=params, stream=True)
+        for line in res.iter_lines(chunk_size=STREAM_CHUNK_SIZE):
+            if line:
+                item = json.loads(line.decode("utf-8"))
+                yield item if keys_only else tuple(item)
+
+    def range(self, start=None, end=None, prefix=None, reverse=False, limit=None, keys_only=False):
+        """
+        iterator of (key, value), or keys only, with start <= key < end
+        and starting with prefix in key order, answered by a range scan
+        of the primary key index on the server
+        """
+        if keys_only:
+            return iter(self.keys(prefix, True, start, end, reverse, limit))
+        return self.scan(prefix, start, end, None, reverse, limit)
+
+    def maintenance(self, operations=None, wait=False, interval=1):
+        """
+        start maintenance of database on server, operations is list of
+        vacuum, incremental_vacuum, analyze and checkpoint, default all,
+        and trim of the change log
+
+        return status of maintenance, with wait=True after it finished
+        """
+        res = self._request("PATCH", data=operations)
+        status = res.json()
+        while wait and status["state"] == "running":
+            time.sleep(interval)
+            status = self.maintenance_status()
+        return status
+
+    def changes(self, cursor=None, limit=None, wait=None):
+        """
+        return cursor and iterator of changes after cursor, every change
+        is a dict {"shard", "seq", "key", "value"}, deleted keys have
+        "deleted" instead of value. without cursor only changes from now
+        on are returned
+
+        the cursor is updated while iterating, pass it to the next call
+        to continue. with wait the server waits up to wait seconds for
+        the first change. raise ChangesIncomplete if changes since cursor
+        are not available anymore
+        """
+        self.flush()
+        params = {}
+        if cursor is not None:
+            params["since"] = json.dumps(cursor["since"])
+            params["created"] = json.dumps(cursor["created"])
+        if limit is not None:
+            params["limit"] = limit
+        if wait is not None:
+            params["wait"] = wait
+        res = self._request("GET", "_changes", params=params, stream=True)
+        cursor = {"since" : json.loads(res.headers["x-changes-since"]), "created" : json.loads(res.headers["x-changes-created"])}
+        def iter_changes():
+            for line in res.iter_lines(chunk_size=STREAM_CHUNK_SIZE):
+                if line:
+                    change = json.loads(line.decode("utf-8"))
+                    cursor["since"][change["shard"]] = change["seq"]
+                    yield change
+        return cursor, iter_changes()
+
+    def mirror(self, filename):
+        """
+        return RestNoSqlMirror of database in local sqlite file filename
+        """
+        return RestNoSqlMirror(self, filename)
+
+    def maintenance_status(self):
+        """
+        return status of last maintenance
+        """
+        return self._request("GET", "_maintenance").json()
+
+    def items(self, prefix=None):
+        return self.scan(prefix)
+
+    def values(self, prefix=None):
+        for key, value in self.scan(prefix):
+            yield value
 
     #def __getattribute__(self, attr):
     #    print("requesting %s" % attr)
     #    return object.__getattribute__(self, attr)
+
+
+class RestNoSqlMirror(object):
+    """
+    local copy of a database in a sqlite file, read only dict like access,
+    kept up to date by sync(), which reads changes since the last sync
+    or copies the whole database, if the changes are not available
+
+        with db.mirror("copy.sqlite") as mirror:
+            mirror.sync()
+            value = mirror["somekey"]
+            mirror.sync(wait=30) # wait for changes
+
+    the copy is consistent with the database at the time of the last sync,
+    the file may be opened by other processes to read it
+    """
+
+    def __init__(self, database, filename):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._database = database
+        self._conn = sqlite3.connect(filename, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS data (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cursor (url TEXT PRIMARY KEY, cursor TEXT NOT NULL)")
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._conn.close()
+
+    def _cursor(self):
+        """
+        return cursor of last sync, or None if the file is no copy of database
+        """
+        row = self._conn.execute("SELECT cursor FROM cursor WHERE url = ?", (self._database._url, )).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def _store_cursor(self, cursor):
+        self._conn.execute("DELETE FROM cursor")
+        self._conn.execute("INSERT INTO cursor (url, cursor) VALUES (?, ?)", (self._database._url, json.dumps(cursor)))
+
+    def sync(self, wait=None):
+        """
+        apply changes since last sync, wait up to wait seconds for them,
+        or copy the whole database, return number of keys written or deleted
+        """
+        cursor = self._cursor()
+        if cursor is not None:
+            try:
+                return self._apply(cursor, wait)
+            except ChangesIncomplete:
+                self._logger.info("changes since last sync are not available, copying database")
+        return self._copy()
+
+    def _apply(self, cursor, wait=None):
+        cursor, changes = self._database.changes(cursor, wait=wait)
+        applied = 0
+        with self._conn: # one transaction, rolled back on error
+            for change in changes:
+                if change.get("deleted"):
+                    self._conn.execute("DELETE FROM data WHERE key = ?", (change["key"], ))
+                else:
+                    self._conn.execute("INSERT OR REPLACE INTO data (key, value) VALUES (?, ?)", (change["key"], json.dumps(change["value"])))
+                applied += 1
+            self._store_cursor(cursor)
+        return applied
+
+    def _copy(self):
+        """
+        copy all keys, changes during the copy are applied afterwards
+        """
+        cursor, _ = self._database.changes(limit=0)
+        copied = 0
+        with self._conn:
+            self._conn.execute("DELETE FROM data")
+            for key, value in self._database.scan():
+                self._conn.execute("INSERT INTO data (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+                copied += 1
+            self._store_cursor(cursor)
+        return copied + self._apply(cursor)
+
+    def __getitem__(self, key):
+        row = self._conn.execute("SELECT value FROM data WHERE key = ?", (key, )).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json.loads(row[0])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self._conn.execute("SELECT 1 FROM data WHERE key = ?", (key, )).fetchone() is not None
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM data").fetchone()[0]
+
+    def keys(self):
+        return [row[0] for row in self._conn.execute("SELECT key FROM data ORDER BY key")]
+
+    def items(self):
+        for key, value in self._conn.execute("SELECT key, value FROM data ORDER BY key"):
+            yield key, json.loads(value)
+
+
+def range_params(prefix=None, start=None, end=None, reverse=False, limit=None):
+    """
+    return query parameters of key range
+    """
+    params = {}
+    for name, value in (("prefix", prefix), ("start", start), ("end", end), ("limit", limit)):
+        if value is not None:
+            params[name] = value
+    if reverse:
+        params["reverse"] = 1
+    return params
+
+
+class RestNoSqlKeys(object):
+    """
+    lazy view of keys in database, nothing is cached
+
+    iteration reads PAGE_SIZE keys per request, or streams all keys
+    in one response, len() and in are answered by the server
+    """
+
+    # number of keys per request
+    PAGE_SIZE = 1000
+
+    def __init__(self, database, prefix=None, stream=False, start=None, end=None, reverse=False, limit=None):
+        self._database = database
+        self._prefix = prefix
+        self._stream = stream
+        self._start = start
+        self._end = end
+        self._reverse = reverse
+        self._limit = limit
+
+    def __iter__(self):
+        params = range_params(self._prefix, self._start, self._end, self._reverse)
+        if self._stream:
+            params["format"] = "ndjson"
+            if self._limit is not None:
+                params["limit"] = self._limit
+            res = self._database._request("OPTIONS", params=params, stream=True)
+            for line in res.iter_lines(chunk_size=STREAM_CHUNK_SIZE):
+                if line:
+                    yield json.loads(line.decode("utf-8"))
+            return
+        remaining = self._limit
+        while remaining is None or remaining > 0:
+            params["limit"] = self.PAGE_SIZE if remaining is None else min(self.PAGE_SIZE, remaining)
+            page = self._database._request("OPTIONS", params=params).json()
+            for key in page["keys"]:
+                yield key
+            if page["next"] is None:
+                break
+            params["before" if self._reverse else "after"] = page["next"]
+            if remaining is not None:
+                remaining -= len(page["keys"])
+
+    def __len__(self):
+        params = range_params(self._prefix, self._start, self._end)
+        params["format"] = "count"
+        count = self._database._request("OPTIONS", params=params).json()
+        if self._limit is not None:
+            return min(count, self._limit)
+        return count
+
+    def __contains__(self, key):
+        """
+        key is the smallest key starting with key, if it exists
+        """
+        if self._prefix is not None and not key.startswith(self._prefix):
+            return False
+        if self._start is not None and key < self._start:
+            return False
+        if self._end is not None and key >= self._end:
+            return False
+        page = self._database._request("OPTIONS", params={"prefix" : key, "limit" : 1}).json()
+        return page["keys"] == [key]
@@ -2,3 +2,9 @@
 
 from RestNoSqlClient.RestNoSqlClient import RestNoSqlClient as RestNoSqlClient
 from RestNoSqlClient.RestNoSqlClient import RestNoSqlDatabase as RestNoSqlDatabase
+from RestNoSqlClient.RestNoSqlClient import PreconditionFailed as PreconditionFailed
+from RestNoSqlClient.RestNoSqlClient import ChangesIncomplete as ChangesIncomplete
+from RestNoSqlClient.RestNoSqlClient import RestNoSqlMirror as RestNoSqlMirror
+# importable without aiohttp, AsyncRestNoSqlClient() raises ImportError then
+from RestNoSqlClient.AsyncRestNoSqlClient import AsyncRestNoSqlClient as AsyncRestNoSqlClient
+from RestNoSqlClient.AsyncRestNoSqlClient import AsyncRestNoSqlDatabase as AsyncRestNoSqlDatabase
@@ -7,20 +7,288 @@ import web
 import os
 import sys
 import time
+import threading
+import collections
+import contextlib
+import atexit
+import sqlite3
+import types
+import shutil
+import pickle
+import codecs
+import math
+import bisect
+import heapq
+import itertools
+import zlib
+import hashlib
+import base64
+import re
+import urllib.parse
+import sqlitedict
 from sqlitedict import SqliteDict
 import json
 import logging
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 FORMAT = '%(module)s.%(funcName)s:%(lineno)s %(levelname)s : %(message)s'
 logging.basicConfig(level=logging.INFO, format=FORMAT)
 logging.getLogger("sqlitedict").setLevel(logging.ERROR)
 
 urls = (
+    "/metrics", "RestNoSqlMetrics", # metrics in prometheus text format
     "/manager/(.*)", "RestNoSqlManager", # to create or drop database
+    "/database/([^/]+)/_batch", "RestNoSqlBatch", # multiple operations in one transaction
+    "/database/([^/]+)/_scan", "RestNoSqlScan", # stream key/value pairs
+    "/database/([^/]+)/_merge", "RestNoSqlMerge", # atomic update of value
+    "/database/([^/]+)/_maintenance", "RestNoSqlMaintenance", # status of maintenance
+    "/database/([^/]+)/_bloom", "RestNoSqlBloom", # bloom filter of keys
+    "/database/([^/]+)/_query", "RestNoSqlQuery", # keys by indexed field of value
+    "/database/([^/]+)/_changes", "RestNoSqlChanges", # change feed
     "/database/(.*)", "RestNoSql", # to use pre-created databases
 )
 
 # in PROD this will be put in config file
-CONFIG = json.load(open(os.path.expanduser("~/RestNoSqlWebApp.json")))
+# path of config file and storage directory may be set in environment,
+# or replaced by configure()
+CONFIG_FILE = os.environ.get("RESTNOSQL_CONFIG", os.path.expanduser("~/RestNoSqlWebApp.json"))
+CONFIG = json.load(open(CONFIG_FILE))
+
+
+class TokenBucket(object):
+    """
+    thread safe token bucket, refilled with rate tokens per second
+    up to burst tokens
+    """
+
+    def __init__(self, rate, burst=None):
+        self._rate = float(rate)
+        self._burst = float(burst if burst is not None else max(rate, 1))
+        self._tokens = self._burst
+        self._last = time.time()
+        self._lock = threading.RLock()
+
+    def wait(self):
+        """
+        return 0 if a token is available, or seconds until next token
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._burst, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            if self._tokens >= 1:
+                return 0
+            return (1 - self._tokens) / self._rate
+
+    def take(self):
+        """
+        take one token, return 0 on success or seconds until next token
+        """
+        with self._lock:
+            wait = self.wait()
+            if not wait:
+                self._tokens -= 1
+            return wait
+
+
+class RateLimiter(object):
+    """
+    per tenant and per apikey limits of request rate and concurrent requests
+
+    limits are read from config, per apikey next to methods, per tenant
+    in the reserved entry _limits of the idkey
+
+        {
+            "<idkey>" : {
+                "_limits" : {"rate" : 100, "burst" : 200, "max_in_flight" : 8},
+                "<apikey>" : {"methods" : [...], "rate" : 20, "max_in_flight" : 4}
+            }
+        }
+
+    rate is in requests per second, burst defaults to rate,
+    missing limits are not enforced
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._in_flight = {}
+
+    def _limits(self, config, idkey, apikey):
+        """
+        return list of (scope, limits)
+        """
+        return [
+            ((idkey, ), config[idkey].get("_limits", {})),
+            ((idkey, apikey), config[idkey][apikey]),
+        ]
+
+    def acquire(self, config, idkey, apikey):
+        """
+        count request as in flight and return (None, scopes), or return
+        (seconds to wait, None) if some limit is exceeded
+
+        scopes are to be passed to release, which does not read config,
+        so changing config meanwhile does not confuse counters
+        """
+        limits = self._limits(config, idkey, apikey)
+        with self._lock:
+            for scope, limit in limits:
+                if "max_in_flight" in limit and self._in_flight.get(scope, 0) >= limit["max_in_flight"]:
+                    return 1, None
+            buckets = []
+            for scope, limit in limits:
+                if "rate" in limit:
+                    if scope not in self._buckets:
+                        self._buckets[scope] = TokenBucket(limit["rate"], limit.get("burst"))
+                    buckets.append(self._buckets[scope])
+            # tokens are taken only if every bucket has one
+            wait = max([bucket.wait() for bucket in buckets] + [0])
+            if wait:
+                return wait, None
+            for bucket in buckets:
+                bucket.take()
+            scopes = [scope for scope, limit in limits]
+            for scope in scopes:
+                self._in_flight[scope] = self._in_flight.get(scope, 0) + 1
+        return None, scopes
+
+    def reset(self):
+        """
+        forget token buckets, after limits changed
+        """
+        with self._lock:
+            self._buckets.clear()
+
+    def release(self, scopes):
+        """
+        request counted in scopes returned by acquire is finished
+        """
+        with self._lock:
+            for scope in scopes:
+                self._in_flight[scope] -= 1
+
+    def release_after(self, generator, scopes):
+        """
+        streamed responses are in flight until the generator is finished
+        """
+        try:
+            for item in generator:
+                yield item
+        finally:
+            self.release(scopes)
+
+LIMITER = RateLimiter()
+
+
+def check_limits(config):
+    """
+    raise ValueError if limits in config are not valid
+    """
+    for idkey, entries in config.items():
+        for name, limit in entries.items():
+            rate, burst, max_in_flight = limit.get("rate", 1), limit.get("burst", 1), limit.get("max_in_flight", 1)
+            if isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate <= 0:
+                raise ValueError("rate of %s in %s must be positive number" % (name, idkey))
+            if isinstance(burst, bool) or not isinstance(burst, (int, float)) or burst < 1:
+                raise ValueError("burst of %s in %s must be at least 1" % (name, idkey))
+            if isinstance(max_in_flight, bool) or not isinstance(max_in_flight, int) or max_in_flight < 1:
+                raise ValueError("max_in_flight of %s in %s must be integer of at least 1" % (name, idkey))
+
+check_limits(CONFIG)
+
+
+class Metrics(object):
+    """
+    in memory counters and histograms, exposed in prometheus text format
+
+    every sample has labels, samples with label idkey are only exposed
+    to this tenant and without the idkey label, so idkeys never show up
+    """
+
+    # upper bounds of histogram buckets
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000, 100000000)
+
+    # name : (type, help)
+    METRICS = {
+        "restnosql_request_duration_seconds" : ("histogram", "duration of requests, _count is the number of requests"),
+        "restnosql_request_size_bytes" : ("histogram", "size of request bodies"),
+        "restnosql_response_size_bytes" : ("histogram", "size of response bodies"),
+        "restnosql_sqlite_open_seconds" : ("histogram", "time to open sqlite databases"),
+        "restnosql_sqlite_query_seconds" : ("histogram", "time databases are leased by requests to run queries"),
+        "restnosql_auth_failures_total" : ("counter", "requests rejected by authentication"),
+        "restnosql_rate_limited_total" : ("counter", "requests rejected by rate limits"),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {} # (name, labels) : [count per bucket ..., sum, count]
+        self._counters = {} # (name, labels) : value
+        self._buckets = {}
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        """
+        add value to histogram, labels is tuple of (label, value)
+        """
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = [0] * (len(buckets) + 3)
+                self._buckets[name] = buckets
+            histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def increment(self, name, labels):
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + 1
+
+    def _visible(self, labels, idkey):
+        """
+        return labels without idkey, or None if sample belongs to another tenant
+        """
+        visible = tuple((label, value) for label, value in labels if label != "idkey")
+        if len(visible) != len(labels) and ("idkey", idkey) not in labels:
+            return None
+        return visible
+
+    def expose(self, idkey):
+        """
+        return metrics of tenant idkey in prometheus text format
+        """
+        def format_labels(labels):
+            if not labels:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (label, str(value).replace("\\", "\\\\").replace('"', '\\"')) for label, value in labels)
+        with self._lock:
+            histograms = [(key, list(values)) for key, values in self._histograms.items()]
+            counters = list(self._counters.items())
+        lines = []
+        for name in sorted(self.METRICS):
+            metric_type, help_text = self.METRICS[name]
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for (sample_name, labels), value in sorted(counters):
+                labels = self._visible(labels, idkey) if sample_name == name else None
+                if labels is not None:
+                    lines.append("%s%s %s" % (name, format_labels(labels), value))
+            for (sample_name, labels), values in sorted(histograms):
+                labels = self._visible(labels, idkey) if sample_name == name else None
+                if labels is None:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self._buckets[name] + ("+Inf", ), values):
+                    cumulative += count
+                    lines.append("%s_bucket%s %s" % (name, format_labels(labels + (("le", bound), )), cumulative))
+                lines.append("%s_sum%s %s" % (name, format_labels(labels), values[-2]))
+                lines.append("%s_count%s %s" % (name, format_labels(labels), values[-1]))
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
 
 
 def authenticator(config):
@@ -38,36 +306,56 @@ def authenticator(config):
             try:
                 if web.ctx.env.get("HTTP_X_IDKEY") is None:
                     log.error("X-IDKEY Header missing")
+                    METRICS.increment("restnosql_auth_failures_total", (("reason", "missing_idkey"), ))
                     web.ctx.status = "401 Unauthorized"
                     return
                 idkey = web.ctx.env.get("HTTP_X_IDKEY")
                 log.debug("idkey : %s", idkey)
                 if idkey not in config:
                     log.error("X-IDKEY %s is unknown", idkey)
+                    METRICS.increment("restnosql_auth_failures_total", (("reason", "unknown_idkey"), ))
                     web.ctx.status = "401 Unauthorized"
                     return
                 if web.ctx.env.get("HTTP_X_APIKEY") is None:
                     log.error("X-APIKEY Header missing")
+                    METRICS.increment("restnosql_auth_failures_total", (("reason", "missing_apikey"), ))
                     web.ctx.status = "401 Unauthorized"
                     return
                 apikey = web.ctx.env.get("HTTP_X_APIKEY")
                 log.debug("apikey : %s", apikey)
-                if apikey not in config[idkey]:
+                if apikey not in config[idkey] or apikey.startswith("_"):
                     log.error("X-APIKEY %s not found", apikey)
+                    METRICS.increment("restnosql_auth_failures_total", (("reason", "unknown_apikey"), ))
                     web.ctx.status = "401 Unauthorized"
                     return
                 method = web.ctx.env.get("REQUEST_METHOD")
                 log.debug("method : %s", method)
                 if method not in config[idkey][apikey]["methods"]:
                     log.error("X-APIKEY %s not allowed for method %s", apikey, method)
+                    METRICS.increment("restnosql_auth_failures_total", (("reason", "method_not_allowed"), ))
                     web.ctx.status = "401 Unauthorized"
                     return
                 log.debug("successfully authorized with APIKEY %s for method %s", apikey, method)
+                retry_after, scopes = LIMITER.acquire(config, idkey, apikey)
+                if retry_after is not None:
+                    log.error("X-APIKEY %s of X-IDKEY %s over limit", apikey, idkey)
+                    METRICS.increment("restnosql_rate_limited_total", (("idkey", idkey), ))
+                    web.ctx.status = "429 Too Many Requests"
+                    web.header("Retry-After", "%d" % math.ceil(retry_after))
+                    return
                 # injecting _x_apikey and _x_idkey
                 kwds["_x_idkey"] = web.ctx.env.get("HTTP_X_IDKEY")
                 kwds["_x_apikey"] = web.ctx.env.get("HTTP_X_APIKEY")
-                ret_val = func(*args, **kwds)
-                return ret_val
+                streaming = False
+                try:
+                    ret_val = func(*args, **kwds)
+                    if isinstance(ret_val, types.GeneratorType):
+                        ret_val = LIMITER.release_after(ret_val, scopes)
+                        streaming = True
+                    return ret_val
+                finally:
+                    if not streaming:
+                        LIMITER.release(scopes)
             except Exception as exc:
                 log.exception(exc)
                 log.error("call to %s caused Exception", call_str)
@@ -78,10 +366,29 @@ def authenticator(config):
         return inner
     return real_authenticator
 
+class RawJson(str):
+    """
+    already json encoded value, sent as it is
+    """
+    pass
+
+
+def dump_json(value):
+    """
+    json encode value, unless it is RawJson already
+    """
+    if isinstance(value, RawJson):
+        return value
+    return json.dumps(value)
+
+
 def encode_json(func):
     """
     to encode returned value to json string
-    and set Content-Type
+    and set Content-Type, RawJson is returned as it is
+
+    returned generators are streamed as newline delimited json,
+    one line per item
     """
     log = logging.getLogger(func.__name__)
     def inner(*args, **kwds):
@@ -91,53 +398,1636 @@ def encode_json(func):
         log.debug("function to call: %s", call_str)
         try:
             ret_val = func(*args, **kwds)
+            if web.ctx.status.startswith("304"):
+                return "" # not modified, no body
+            if isinstance(ret_val, types.GeneratorType):
+                web.header('Content-Type', 'application/x-ndjson')
+                return ("%s\n" % dump_json(item) for item in ret_val)
             web.header('Content-Type', 'application/json')
-            return json.dumps(ret_val)
+            return dump_json(ret_val)
+        except Exception as exc:
+            log.exception(exc)
+            log.error("call to %s caused Exception", call_str)
+            web.internalerror()
+    # set inner function __name__ and __doc__ to original ones
+    inner.__name__ = func.__name__
+    inner.__doc__ = func.__doc__
+    return inner
+
+# responses smaller than this are sent uncompressed
+COMPRESS_MIN_SIZE = 1024
+# gzip level, 6 is the default of gzip
+COMPRESS_LEVEL = 6
+# supported content encodings, in order of preference
+ENCODINGS = ("zstd", "gzip") if zstandard is not None else ("gzip", )
+
+
+def compressor(encoding):
+    """
+    return streaming compressor of encoding, with compress() and flush()
+    """
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def decompressor(encoding):
+    """
+    return streaming decompressor of encoding, with decompress(),
+    or None for identity
+    """
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj()
+    if encoding == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return None
+
+
+def accepted_encoding(header):
+    """
+    return preferred encoding of ENCODINGS accepted by Accept-Encoding header, or None
+    """
+    accepted = set()
+    for part in (header or "").split(","):
+        name, _, params = part.partition(";")
+        params = params.strip().replace(" ", "")
+        if params.startswith("q=") and params[2:].replace(".", "", 1).isdigit() and float(params[2:]) == 0:
+            continue
+        accepted.add(name.strip().lower())
+    for encoding in ENCODINGS:
+        if encoding in accepted:
+            return encoding
+    return None
+
+
+def request_data():
+    """
+    return request body like web.data(), decompressed
+    according to Content-Encoding
+    """
+    data = web.data()
+    decompress = decompressor(web.ctx.env.get("HTTP_CONTENT_ENCODING"))
+    if decompress is None or not data:
+        return data
+    return decompress.decompress(data)
+
+
+def int_param(params, name, minimum=1, maximum=None):
+    """
+    return query parameter name as int, None if not given, raise
+    ValueError if it is no integer between minimum and maximum
+    """
+    if params[name] is None:
+        return None
+    value = int(params[name])
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ValueError("%s must be between %s and %s" % (name, minimum, maximum))
+    return value
+
+
+def compress_stream(chunks, encoding):
+    """
+    yield chunks of str or bytes compressed
+    """
+    compress = compressor(encoding)
+    for chunk in chunks:
+        data = compress.compress(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compress.flush()
+
+
+def compress(func):
+    """
+    compress response negotiated by Accept-Encoding, with one of
+    ENCODINGS, if it is at least COMPRESS_MIN_SIZE long, streamed
+    responses are compressed on the fly
+
+    request bodies compressed with one of ENCODINGS are accepted,
+    see request_data() and iter_request_body(), other Content-Encoding
+    are rejected with 415, to be used inside stats
+    """
+    def inner(*args, **kwds):
+        content_encoding = web.ctx.env.get("HTTP_CONTENT_ENCODING")
+        if content_encoding not in (None, "", "identity") and content_encoding not in ENCODINGS:
+            logging.error("unsupported Content-Encoding %s", content_encoding)
+            web.ctx.status = "415 Unsupported Media Type"
+            return ""
+        ret_val = func(*args, **kwds)
+        if ret_val is None:
+            return "" # web.py would send None as body, breaking HEAD responses
+        web.header("Vary", "Accept-Encoding")
+        encoding = accepted_encoding(web.ctx.env.get("HTTP_ACCEPT_ENCODING"))
+        if encoding is None:
+            return ret_val
+        if isinstance(ret_val, types.GeneratorType):
+            web.header("Content-Encoding", encoding)
+            return compress_stream(ret_val, encoding)
+        if len(ret_val) < COMPRESS_MIN_SIZE:
+            return ret_val
+        web.header("Content-Encoding", encoding)
+        return b"".join(compress_stream((ret_val, ), encoding))
+    # set inner function __name__ and __doc__ to original ones
+    inner.__name__ = func.__name__
+    inner.__doc__ = func.__doc__
+    return inner
+
+
+# database label of metrics of requests to not existing databases
+UNKNOWN_DATABASE = "_unknown"
+
+
+def stats(func):
+    """
+    measure duration, request and response size of requests,
+    recorded in METRICS by handler, method, database and status,
+    to be used as outermost decorator
+
+    databases not existing before nor after the request are recorded
+    as UNKNOWN_DATABASE, so made up names do not add series
+    """
+    log = logging.getLogger(func.__name__)
+    def database_label(args):
+        database = args[1].split("/")[0] if len(args) > 1 else ""
+        idkey = web.ctx.env.get("HTTP_X_IDKEY")
+        if not database or (idkey in CONFIG and CATALOG.exists(idkey, database)):
+            return database
+        return UNKNOWN_DATABASE
+    def record(args, starttime, response_size, database):
+        duration = time.time() - starttime
+        idkey = web.ctx.env.get("HTTP_X_IDKEY")
+        if idkey not in CONFIG:
+            return # rejected by authenticator, counted there
+        if database == UNKNOWN_DATABASE:
+            database = database_label(args) # created by this request
+        labels = (
+            ("idkey", idkey),
+            ("handler", args[0].__class__.__name__),
+            ("method", web.ctx.env.get("REQUEST_METHOD")),
+            ("database", database),
+            ("status", web.ctx.status.split()[0]),
+        )
+        METRICS.observe("restnosql_request_duration_seconds", labels, duration)
+        METRICS.observe("restnosql_request_size_bytes", labels, int(web.ctx.env.get("CONTENT_LENGTH") or 0), Metrics.SIZE_BUCKETS)
+        METRICS.observe("restnosql_response_size_bytes", labels, response_size, Metrics.SIZE_BUCKETS)
+    def record_stream(generator, args, starttime, database):
+        response_size = 0
+        try:
+            for chunk in generator:
+                response_size += len(chunk)
+                yield chunk
+        finally:
+            record(args, starttime, response_size, database)
+    def inner(*args, **kwds):
+        call_str = "%s(%s, %s)" % (func.__name__, args[1:], kwds)
+        log.debug("args: %s", args[1:])
+        log.debug("kwds: %s", kwds)
+        starttime = time.time()
+        database = database_label(args) # before the request, to count deletes
+        try:
+            ret_val = func(*args, **kwds)
+            log.debug("function %s duration %s", call_str, (time.time() - starttime))
+            if isinstance(ret_val, types.GeneratorType):
+                return record_stream(ret_val, args, starttime, database)
+            record(args, starttime, len(ret_val) if isinstance(ret_val, (str, bytes)) else 0, database)
+            return ret_val
         except Exception as exc:
             log.exception(exc)
             log.error("call to %s caused Exception", call_str)
             web.internalerror()
+            record(args, starttime, 0, database)
     # set inner function __name__ and __doc__ to original ones
     inner.__name__ = func.__name__
     inner.__doc__ = func.__doc__
     return inner
 
-def stats(func):
+
+
+STORAGE_DIR = os.environ.get("RESTNOSQL_STORAGE_DIR", "/var/www/data")
+
+
+def init_storage():
+    """
+    create storage directory and subdirectories of every tenant
+    """
+    #logging.info("scanning existing databases")
+    if not os.path.isdir(STORAGE_DIR):
+        os.mkdir(STORAGE_DIR)
+    for idkey in CONFIG.keys():
+        id_dir = os.path.join(STORAGE_DIR, idkey)
+        if not os.path.isdir(id_dir):
+            logging.info("creating subdirectory for id %s", idkey)
+            os.mkdir(id_dir)
+    #logging.info("found %s", os.listdir(STORAGE_DIR))
+
+init_storage()
+
+
+def valid_database(database):
+    """
+    return True if database is a valid name of a database, names
+    starting with _ or . are reserved, no path separators allowed
+    """
+    return bool(database) and not database.startswith(("_", ".")) and not any(char in database for char in "/\\\0")
+
+
+class Catalog(object):
+    """
+    process wide catalog of the databases of every tenant
+
+    the directory of a tenant is listed once, afterwards the catalog is
+    kept up to date by creating and deleting databases, so listing and
+    existence checks do not touch the disk. databases created by another
+    process are found by one stat of their directory on a miss, databases
+    deleted by another process stay listed until reset()
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._databases = {} # idkey : set of databases
+
+    def _load(self, idkey):
+        """
+        return set of databases of tenant, must be called with self._lock held
+        """
+        if idkey not in self._databases:
+            id_dir = os.path.join(STORAGE_DIR, idkey)
+            self._databases[idkey] = set(name for name in os.listdir(id_dir) if valid_database(name) and os.path.isdir(os.path.join(id_dir, name))) if os.path.isdir(id_dir) else set()
+        return self._databases[idkey]
+
+    def list(self, idkey):
+        """
+        return sorted list of databases of tenant
+        """
+        with self._lock:
+            return sorted(self._load(idkey))
+
+    def exists(self, idkey, database):
+        """
+        return True if database of tenant exists, invalid names never exist
+        """
+        if not valid_database(database):
+            return False
+        with self._lock:
+            databases = self._load(idkey)
+            if database not in databases and os.path.isdir(os.path.join(STORAGE_DIR, idkey, database)):
+                databases.add(database)
+            return database in databases
+
+    def add(self, idkey, database):
+        with self._lock:
+            self._load(idkey).add(database)
+
+    def remove(self, idkey, database):
+        with self._lock:
+            self._load(idkey).discard(database)
+
+    def reset(self):
+        """
+        forget all tenants, directories are listed again on next use
+        """
+        with self._lock:
+            self._databases.clear()
+
+
+CATALOG = Catalog()
+
+# maximum number of SqliteDict handles kept open at the same time
+POOL_SIZE = 32
+
+# storage format of new databases
+# json   - values are stored as json text and sent without decoding
+# pickle - values are stored pickled, format of databases without meta.json
+DEFAULT_FORMAT = "json"
+# journal mode and synchronous level of new databases, in WAL mode
+# readers do not wait for the writer
+DEFAULT_JOURNAL_MODE = "WAL"
+DEFAULT_SYNCHRONOUS = "NORMAL"
+
+# maximum number of shard files of one database
+MAX_SHARDS = 64
+
+# changes older than this number of seconds, or more than this number
+# of changes per shard are trimmed from the change log, default settings
+CHANGES_MAX_AGE = 7 * 24 * 3600
+CHANGES_MAX_ENTRIES = 1000000
+# change log of a shard is trimmed after this number of transactions
+CHANGES_TRIM_INTERVAL = 1000
+
+# types of databases, set at creation
+# store - keys are kept until deleted
+# cache - keys expire after ttl given on write or default_ttl, least recently
+#         used keys are evicted if there are more than max_entries keys or
+#         their values are larger than max_bytes, see CacheSweeper
+DATABASE_TYPES = ("store", "cache")
+# seconds between sweeps of cache databases
+CACHE_SWEEP_INTERVAL = 10
+
+# fields of values which can be indexed, dot separated for nested objects
+INDEX_FIELD = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+# allowed values of settings in meta.json, shards is set at creation only,
+# indexes is a list of fields, see INDEX_FIELD, changes_max_age,
+# changes_max_entries and the budget of caches are positive integers
+SETTINGS = {
+    "format" : ("json", "pickle"),
+    "journal_mode" : ("DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"),
+    "synchronous" : ("OFF", "NORMAL", "FULL", "EXTRA"),
+}
+
+
+def check_settings(settings):
+    """
+    return error message if settings of database are not valid, or None
+    """
+    for name, value in settings.items():
+        if name == "indexes":
+            if not isinstance(value, list) or not all(isinstance(field, str) and INDEX_FIELD.match(field) for field in value):
+                return "indexes must be list of fields like name or name.subname"
+            continue
+        if name in ("changes_max_age", "changes_max_entries", "max_entries", "max_bytes", "default_ttl"):
+            if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+                return "%s must be positive integer" % name
+            continue
+        if name not in SETTINGS:
+            return "unknown setting %s" % name
+        if value not in SETTINGS[name]:
+            return "setting %s must be one of %s" % (name, ", ".join(SETTINGS[name]))
+    return None
+
+
+def read_meta(idkey, database):
+    """
+    return settings of database stored in meta.json, defaults
+    are the settings of databases created before meta.json
+    """
+    meta = {"format" : "pickle", "journal_mode" : "DELETE", "synchronous" : "OFF", "shards" : 1, "indexes" : [],
+            "changes_max_age" : CHANGES_MAX_AGE, "changes_max_entries" : CHANGES_MAX_ENTRIES,
+            "type" : "store", "max_entries" : None, "max_bytes" : None, "default_ttl" : None}
+    filename = os.path.join(STORAGE_DIR, idkey, database, "meta.json")
+    if os.path.isfile(filename):
+        with open(filename) as infile:
+            meta.update(json.load(infile))
+    return meta
+
+
+def write_meta(idkey, database, meta):
+    """
+    store settings of database in meta.json
+    """
+    filename = os.path.join(STORAGE_DIR, idkey, database, "meta.json")
+    with open(filename + ".tmp", "w") as outfile:
+        json.dump(meta, outfile)
+    os.replace(filename + ".tmp", filename)
+
+
+def encode_value(value):
+    """
+    store value as compact json text
+    """
+    return json.dumps(value, separators=(",", ":"))
+
+
+def decode_value(stored):
+    """
+    return stored value as RawJson, json text is returned as it is,
+    pickled values (blobs) are converted, so databases may contain both
+    """
+    if isinstance(stored, bytes):
+        return RawJson(json.dumps(pickle.loads(stored)))
+    return RawJson(stored)
+
+
+def load_value(raw):
+    """
+    return python object of RawJson value read from database
+    """
+    return json.loads(raw)
+
+
+# merge operators, see merge_value()
+MERGE_OPERATORS = ("append", "union", "increment", "max", "min")
+
+
+def merge_value(operator, current, argument, field=None):
+    """
+    return current value merged with argument, current is None if
+    the key does not exist, raise ValueError if types do not fit
+
+    append      append argument to list
+    union       append items of list argument not yet in list
+    increment   add number argument
+    max, min    keep greater or lower of current and argument,
+                comparing field of both, if field is given
+    """
+    if operator == "append":
+        if current is None:
+            current = []
+        if not isinstance(current, list):
+            raise ValueError("append needs list value")
+        return current + [argument]
+    if operator == "union":
+        if current is None:
+            current = []
+        if not isinstance(current, list) or not isinstance(argument, list):
+            raise ValueError("union needs list value and argument")
+        merged = list(current)
+        for item in argument:
+            if item not in merged:
+                merged.append(item)
+        return merged
+    if operator == "increment":
+        if current is None:
+            current = 0
+        for number in (current, argument):
+            if isinstance(number, bool) or not isinstance(number, (int, float)):
+                raise ValueError("increment needs numeric value and argument")
+        return current + argument
+    if current is None:
+        return argument
+    try:
+        if field is not None:
+            current_key, argument_key = current[field], argument[field]
+        else:
+            current_key, argument_key = current, argument
+        if operator == "max":
+            return argument if argument_key > current_key else current
+        return argument if argument_key < current_key else current
+    except (KeyError, TypeError) as exc:
+        raise ValueError("%s cannot compare %s" % (operator, exc))
+
+
+def merge(db, key, operator, argument, field=None):
+    """
+    merge argument into value of key in SqliteDict, has to be called
+    inside a transaction, return new value
+    """
+    try:
+        current = load_value(db[key])
+    except KeyError:
+        current = None
+    value = merge_value(operator, current, argument, field)
+    db[key] = value
+    return value
+
+
+def shard_filename(idkey, database, shard=0):
+    """
+    return filename of shard of database, the first shard
+    is data.sqlite, like databases without shards
+    """
+    if not valid_database(database):
+        raise ValueError("invalid name of database %r" % database)
+    if shard == 0:
+        return os.path.join(STORAGE_DIR, idkey, database, "data.sqlite")
+    return os.path.join(STORAGE_DIR, idkey, database, "data.%d.sqlite" % shard)
+
+
+def shard_of(key, shards):
+    """
+    return shard number of key, crc32 is stable across processes
+    """
+    if shards == 1:
+        return 0
+    return zlib.crc32(str(key).encode("utf-8")) % shards
+
+
+def open_sqlitedict(idkey, database, shard=0):
+    """
+    open SqliteDict of shard of database, values are read as RawJson
+    and written in the storage format of the database,
+    journal mode and synchronous level are set from meta.json
+    """
+    filename = shard_filename(idkey, database, shard)
+    meta = read_meta(idkey, database)
+    encode = encode_value if meta["format"] == "json" else sqlitedict.encode
+    db = SqliteDict(filename, encode=encode, decode=decode_value, journal_mode=meta["journal_mode"], outer_stack=False)
+    db.conn.execute("PRAGMA synchronous = %s" % meta["synchronous"])
+    init_versions(db)
+    init_count(db)
+    init_indexes(db, meta["indexes"])
+    if meta["type"] == "cache":
+        init_cache(db, meta)
+        SWEEPER.register(idkey, database)
+    return db
+
+
+def open_reader(db):
+    """
+    open second, read only SqliteDict of the file of db, which does
+    not see uncommitted changes of db
+    """
+    return SqliteDict(db.filename, flag="r", decode=decode_value, journal_mode=db.conn.journal_mode, outer_stack=False)
+
+
+def init_versions(db):
+    """
+    create version table, change log and triggers of SqliteDict, if not existing
+
+    every write of a key takes the next number of the sequence of the
+    table as version of the key, so versions of a key only grow, even
+    if the key is deleted and written again. deletes take the next number
+    too, every write and delete is recorded in the change log with its
+    number. triggers catch every write, including imports, batches and merges
+    """
+    table = db.tablename
+    db.conn.execute('CREATE TABLE IF NOT EXISTS "%s_versions" (key TEXT PRIMARY KEY, version INTEGER NOT NULL)' % table)
+    db.conn.execute('CREATE INDEX IF NOT EXISTS "%s_versions_version" ON "%s_versions" (version)' % (table, table))
+    db.conn.execute('CREATE TABLE IF NOT EXISTS "%s_sequence" (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER NOT NULL)' % table)
+    db.conn.execute('INSERT OR IGNORE INTO "%s_sequence" (id, value) VALUES (0, 0)' % table)
+    db.conn.execute('CREATE TABLE IF NOT EXISTS "%s_changes" (seq INTEGER PRIMARY KEY, key TEXT NOT NULL, deleted INTEGER NOT NULL, time REAL NOT NULL)' % table)
+    db.conn.execute('CREATE INDEX IF NOT EXISTS "%s_changes_key" ON "%s_changes" (key, seq)' % (table, table))
+    now = "(julianday('now') - 2440587.5) * 86400.0" # seconds since epoch
+    for event in ("INSERT", "UPDATE OF value"):
+        db.conn.execute('CREATE TRIGGER IF NOT EXISTS "%s_change_%s" AFTER %s ON "%s" BEGIN '
+                        'UPDATE "%s_sequence" SET value = value + 1; '
+                        'INSERT OR REPLACE INTO "%s_versions" (key, version) SELECT new.key, value FROM "%s_sequence"; '
+                        'INSERT INTO "%s_changes" (seq, key, deleted, time) SELECT value, new.key, 0, %s FROM "%s_sequence"; '
+                        'END' % (table, event.split()[0].lower(), event, table, table, table, table, table, now, table))
+    db.conn.execute('CREATE TRIGGER IF NOT EXISTS "%s_change_delete" AFTER DELETE ON "%s" BEGIN '
+                    'UPDATE "%s_sequence" SET value = value + 1; '
+                    'DELETE FROM "%s_versions" WHERE key = old.key; '
+                    'INSERT INTO "%s_changes" (seq, key, deleted, time) SELECT value, old.key, 1, %s FROM "%s_sequence"; '
+                    'END' % (table, table, table, table, table, now, table))
+    db.commit()
+
+
+def init_count(db):
+    """
+    create table holding the number of keys of SqliteDict and triggers
+    keeping it up to date, if not existing, existing keys are counted once
+
+    the insert trigger runs before the row is inserted, so replacing an
+    existing key is not counted
+    """
+    table = db.tablename
+    db.conn.execute('CREATE TABLE IF NOT EXISTS "%s_count" (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER NOT NULL)' % table)
+    db.conn.execute('INSERT OR IGNORE INTO "%s_count" (id, value) SELECT 0, COUNT(*) FROM "%s"' % (table, table))
+    db.conn.execute('CREATE TRIGGER IF NOT EXISTS "%s_count_insert" BEFORE INSERT ON "%s" '
+                    'WHEN NOT EXISTS (SELECT 1 FROM "%s" WHERE key = new.key) BEGIN '
+                    'UPDATE "%s_count" SET value = value + 1; '
+                    'END' % (table, table, table, table))
+    db.conn.execute('CREATE TRIGGER IF NOT EXISTS "%s_count_delete" AFTER DELETE ON "%s" BEGIN '
+                    'UPDATE "%s_count" SET value = value - 1; '
+                    'END' % (table, table, table))
+    db.commit()
+
+
+def read_count(db):
+    """
+    return number of keys of SqliteDict
+    """
+    return db.conn.select_one('SELECT value FROM "%s_count"' % db.tablename)[0]
+
+
+def index_expression(field):
+    """
+    return sql expression of field of value, NULL if the value has no such
+    field or is not stored as json text, queries have to use the same
+    expression as the index to use it
+    """
+    return "json_extract(CASE WHEN typeof(value) = 'text' THEN value END, '$.%s')" % field
+
+
+def init_indexes(db, fields):
+    """
+    create expression indexes on fields of values of SqliteDict, if not
+    existing, and drop indexes of fields not listed anymore. indexes are
+    maintained by sqlite on every write
+    """
+    prefix = "%s_index_" % db.tablename
+    existing = set(row[0] for row in db.conn.select("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (db.tablename, )) if row[0].startswith(prefix))
+    for field in fields:
+        if prefix + field not in existing:
+            logging.info("creating index on field %s of %s", field, db.filename)
+            db.conn.execute('CREATE INDEX "%s%s" ON "%s" (%s, key)' % (prefix, field, db.tablename, index_expression(field)))
+    for name in existing - set(prefix + field for field in fields):
+        logging.info("dropping index %s of %s", name, db.filename)
+        db.conn.execute('DROP INDEX "%s"' % name)
+    db.commit()
+
+
+def init_cache(db, meta):
+    """
+    create expiry table of cache SqliteDict and triggers keeping it up
+    to date, if not existing, and store default_ttl of meta
+
+    every write sets size, access time and expiry of the key, after
+    default_ttl seconds or never, the total size of values is kept
+    in the cache table
+    """
+    table = db.tablename
+    now = "(julianday('now') - 2440587.5) * 86400.0" # seconds since epoch
+    size = "length(CAST(%s.value AS BLOB))"
+    db.conn.execute('CREATE TABLE IF NOT EXISTS "%s_expiry" (key TEXT PRIMARY KEY, expires REAL, accessed REAL NOT NULL, size INTEGER NOT NULL)' % table)
+    db.conn.execute('CREATE INDEX IF NOT EXISTS "%s_expiry_expires" ON "%s_expiry" (expires)' % (table, table))
+    db.conn.execute('CREATE INDEX IF NOT EXISTS "%s_expiry_accessed" ON "%s_expiry" (accessed)' % (table, table))
+    db.conn.execute('CREATE TABLE IF NOT EXISTS "%s_cache" (id INTEGER PRIMARY KEY CHECK (id = 0), default_ttl REAL, bytes INTEGER NOT NULL)' % table)
+    db.conn.execute('INSERT OR IGNORE INTO "%s_cache" (id, default_ttl, bytes) VALUES (0, NULL, 0)' % table)
+    db.conn.execute('UPDATE "%s_cache" SET default_ttl = ?' % table, (meta["default_ttl"], ))
+    # replaced keys are deleted without delete trigger, so their size is subtracted before
+    db.conn.execute('CREATE TRIGGER IF NOT EXISTS "%s_cache_size" BEFORE INSERT ON "%s" BEGIN '
+                    'UPDATE "%s_cache" SET bytes = bytes + %s - COALESCE((SELECT %s FROM "%s" t WHERE t.key = new.key), 0); '
+                    'END' % (table, table, table, size % "new", size % "t", table))
+    db.conn.execute('CREATE TRIGGER IF NOT EXISTS "%s_cache_insert" AFTER INSERT ON "%s" BEGIN '
+                    'INSERT OR REPLACE INTO "%s_expiry" (key, expires, accessed, size) SELECT new.key, %s + default_ttl, %s, %s FROM "%s_cache"; '
+                    'END' % (table, table, table, now, now, size % "new", table))
+    db.conn.execute('CREATE TRIGGER IF NOT EXISTS "%s_cache_update" AFTER UPDATE OF value ON "%s" BEGIN '
+                    'UPDATE "%s_cache" SET bytes = bytes + %s - %s; '
+                    'UPDATE "%s_expiry" SET size = %s WHERE key = new.key; '
+                    'END' % (table, table, table, size % "new", size % "old", table, size % "new"))
+    db.conn.execute('CREATE TRIGGER IF NOT EXISTS "%s_cache_delete" AFTER DELETE ON "%s" BEGIN '
+                    'UPDATE "%s_cache" SET bytes = bytes - %s; '
+                    'DELETE FROM "%s_expiry" WHERE key = old.key; '
+                    'END' % (table, table, table, size % "old", table))
+    db.commit()
+
+
+def set_expiry(db, key, ttl):
+    """
+    let key of cache SqliteDict expire after ttl seconds, has to be
+    called after writing key, inside the same transaction
+    """
+    db.conn.execute('UPDATE "%s_expiry" SET expires = ? WHERE key = ?' % db.tablename, (time.time() + ttl, key))
+
+
+def cache_expired(db, key):
+    """
+    has key of cache SqliteDict expired, but was not removed yet
+    """
+    row = db.conn.select_one('SELECT expires FROM "%s_expiry" WHERE key = ?' % db.tablename, (key, ))
+    return row is not None and row[0] is not None and row[0] <= time.time()
+
+
+def sweep_cache(db, accessed, meta):
+    """
+    write access times of keys, dict of key : time, to cache SqliteDict,
+    delete expired keys and evict least recently accessed keys over the
+    budget of meta, every shard has its share of the budget. has to be
+    called inside a transaction, return number of keys removed
+    """
+    if meta["type"] != "cache":
+        return 0
+    table = db.tablename
+    for key, accessed_time in accessed.items():
+        db.conn.execute('UPDATE "%s_expiry" SET accessed = MAX(accessed, ?) WHERE key = ?' % table, (accessed_time, key))
+    before = read_count(db)
+    db.conn.execute('DELETE FROM "%s" WHERE key IN (SELECT key FROM "%s_expiry" WHERE expires <= ?)' % (table, table), (time.time(), ))
+    excess_entries = read_count(db) - math.ceil(meta["max_entries"] / meta["shards"]) if meta["max_entries"] else 0
+    excess_bytes = db.conn.select_one('SELECT bytes FROM "%s_cache"' % table)[0] - math.ceil(meta["max_bytes"] / meta["shards"]) if meta["max_bytes"] else 0
+    while excess_entries > 0 or excess_bytes > 0:
+        rows = list(db.conn.select('SELECT key, size FROM "%s_expiry" ORDER BY accessed LIMIT ?' % table, (PAGE_SIZE, )))
+        if not rows:
+            break
+        for key, size in rows:
+            if excess_entries <= 0 and excess_bytes <= 0:
+                break
+            db.conn.execute('DELETE FROM "%s" WHERE key = ?' % table, (key, ))
+            excess_entries -= 1
+            excess_bytes -= size
+    return before - read_count(db)
+
+
+def read_version(db, key):
+    """
+    return version of key, 0 for keys written before versions were
+    introduced, None if key does not exist
+    """
+    row = db.conn.select_one('SELECT version FROM "%s" LEFT JOIN "%s_versions" USING (key) WHERE key = ?' % (db.tablename, db.tablename), (key, ))
+    if row is None:
+        return None
+    return row[0] or 0
+
+
+def read_versioned(db, key):
+    """
+    return value as RawJson and version of key in one statement,
+    raise KeyError if key does not exist
+    """
+    row = db.conn.select_one('SELECT value, version FROM "%s" LEFT JOIN "%s_versions" USING (key) WHERE key = ?' % (db.tablename, db.tablename), (key, ))
+    if row is None:
+        raise KeyError(key)
+    return db.decode(row[0]), row[1] or 0
+
+
+def read_sequence(db):
+    """
+    return last version given to a key of SqliteDict
+    """
+    return db.conn.select_one('SELECT value FROM "%s_sequence"' % db.tablename)[0]
+
+
+def iter_written(db, since, limit=None):
+    """
+    yield (key, version) of keys written after version since,
+    in order of version, read from index of versions
+    """
+    query = 'SELECT key, version FROM "%s_versions" WHERE version > ? ORDER BY version' % db.tablename
+    if limit is not None:
+        query += " LIMIT %d" % limit
+    for row in db.conn.select(query, (since, )):
+        yield row
+
+
+def etag(version):
+    return '"%d"' % version
+
+
+def etag_matches(header, version):
+    """
+    does If-Match or If-None-Match header match version of key,
+    version is None if key does not exist
+    """
+    if version is None:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in header.split(",")]
+    return etag(version) in (tag[2:] if tag.startswith("W/") else tag for tag in tags)
+
+
+def check_preconditions(db, key):
+    """
+    return False if If-Match or If-None-Match header of request
+    does not fit the version of key, has to be called inside the
+    transaction which writes key
+    """
+    version = read_version(db, key)
+    if_match = web.ctx.env.get("HTTP_IF_MATCH")
+    if if_match is not None and not etag_matches(if_match, version):
+        return False
+    if_none_match = web.ctx.env.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None and etag_matches(if_none_match, version):
+        return False
+    return True
+
+
+class SqliteDictPool(object):
+    """
+    process wide pool of open SqliteDict handles, keyed by (idkey, database, shard)
+
+    opening a SqliteDict starts a background thread, opens the file and
+    creates the table if necessary, so handles are kept open and shared
+    between all request threads. SqliteDict serializes every statement
+    through its own thread, so sharing one handle is safe.
+
+    every handle has two connections, writes have to use transaction(),
+    which holds the write lock of the writing connection until the changes
+    are committed, so statements of different requests do not end up in
+    the same transaction. open() leases the second, read only connection,
+    which sees committed changes only, in WAL mode without waiting for
+    the writer.
+
+    least recently used handles are closed if more than maxsize are open,
+    handles still in use by some request are closed after the last one
+    released it.
+
+    databases created with shards are split into files by hash of key,
+    see shard_of(), point operations lease the shard of the key, ranges
+    lease all shards with open_all() and merge them, see iter_merged()
+    """
+
+    def __init__(self, maxsize=POOL_SIZE):
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._handles = collections.OrderedDict() # (idkey, database, shard) : (db, write_lock, reader)
+        self._meta = {} # (idkey, database) : settings of database
+        self._leases = {} # id(handle) : number of requests using handle
+        self._evicted = set() # id(handle) to close after last release
+        self._transactions = collections.Counter() # (idkey, database, shard) : number of transactions
+        self._opening = {} # (idkey, database, shard) : lock held while opening handle
+        self._generations = collections.Counter() # (idkey, database) : number of invalidations
+        self._closed = 0 # number of calls of close()
+
+    def _lease(self, poolkey):
+        """
+        return pooled handle leased, or None if not open
+        must be called with self._lock held
+        """
+        handle = self._handles.get(poolkey)
+        if handle is not None:
+            self._handles.move_to_end(poolkey)
+            self._leases[id(handle)] = self._leases.get(id(handle), 0) + 1
+        return handle
+
+    def _acquire(self, idkey, database, shard):
+        """
+        return leased handle, opening it if necessary
+
+        opening may create indexes and count keys of large tables, so it
+        holds only a lock of this handle, requests of other databases
+        go on meanwhile. a handle opened while the database was
+        invalidated is used by this request only
+        """
+        poolkey = (idkey, database, shard)
+        with self._lock:
+            handle = self._lease(poolkey)
+            if handle is not None:
+                return handle
+            opening = self._opening.setdefault(poolkey, threading.Lock())
+            generation = (self._closed, self._generations[(idkey, database)])
+        with opening:
+            with self._lock:
+                handle = self._lease(poolkey)
+                if handle is not None:
+                    return handle
+            try:
+                starttime = time.time()
+                db = open_sqlitedict(idkey, database, shard)
+                handle = (db, threading.RLock(), open_reader(db))
+                METRICS.observe("restnosql_sqlite_open_seconds", (("idkey", idkey), ("database", database)), time.time() - starttime)
+                logging.debug("opened pooled handle for %s/%s shard %d", idkey, database, shard)
+            finally:
+                with self._lock:
+                    self._opening.pop(poolkey, None)
+            with self._lock:
+                self._leases[id(handle)] = 1
+                if generation != (self._closed, self._generations[(idkey, database)]):
+                    self._evicted.add(id(handle))
+                    return handle
+                self._handles[poolkey] = handle
+                while len(self._handles) > self._maxsize:
+                    self._discard(self._handles.popitem(last=False)[1])
+                return handle
+
+    def _release(self, handle, idkey, database, starttime):
+        METRICS.observe("restnosql_sqlite_query_seconds", (("idkey", idkey), ("database", database)), time.time() - starttime)
+        with self._lock:
+            self._leases[id(handle)] -= 1
+            if self._leases[id(handle)] == 0:
+                del self._leases[id(handle)]
+                if id(handle) in self._evicted:
+                    self._evicted.remove(id(handle))
+                    self._close(handle)
+
+    def _discard(self, handle):
+        """
+        close handle, or mark it to be closed after last release
+        must be called with self._lock held
+        """
+        if id(handle) in self._leases:
+            self._evicted.add(id(handle))
+        else:
+            self._close(handle)
+
+    def _close(self, handle):
+        db, _, reader = handle
+        reader.close()
+        db.close()
+
+    def meta(self, idkey, database):
+        """
+        return settings of database, read once until invalidate()
+        """
+        with self._lock:
+            if (idkey, database) not in self._meta:
+                self._meta[(idkey, database)] = read_meta(idkey, database)
+            return self._meta[(idkey, database)]
+
+    def shards(self, idkey, database):
+        """
+        return number of shards of database
+        """
+        return self.meta(idkey, database)["shards"]
+
+    def shard_of(self, idkey, database, key):
+        """
+        return shard of database storing key
+        """
+        return shard_of(key, self.shards(idkey, database))
+
+    @contextlib.contextmanager
+    def open(self, idkey, database, shard=0):
+        """
+        lease the read only SqliteDict of this database for reading
+        """
+        handle = self._acquire(idkey, database, shard)
+        starttime = time.time()
+        try:
+            yield handle[2]
+        finally:
+            self._release(handle, idkey, database, starttime)
+
+    @contextlib.contextmanager
+    def transaction(self, idkey, database, shard=0):
+        """
+        lease the open SqliteDict of this database for writing,
+        changes are committed at the end of the block, or rolled back on error
+
+        every CHANGES_TRIM_INTERVAL transactions the change log is trimmed,
+        waiting long polls of changes are notified after commit
+        """
+        handle = self._acquire(idkey, database, shard)
+        db, write_lock, _ = handle
+        starttime = time.time()
+        try:
+            with write_lock:
+                try:
+                    yield db
+                    self._transactions[(idkey, database, shard)] += 1
+                    if self._transactions[(idkey, database, shard)] % CHANGES_TRIM_INTERVAL == 0:
+                        meta = self.meta(idkey, database)
+                        trim_changes(db, meta["changes_max_age"], meta["changes_max_entries"])
+                    db.commit()
+                except Exception:
+                    rollback(db)
+                    raise
+            notify_changes(idkey, database)
+        finally:
+            self._release(handle, idkey, database, starttime)
+
+    @contextlib.contextmanager
+    def open_all(self, idkey, database):
+        """
+        lease SqliteDict of every shard for reading, yield list of them
+        """
+        with contextlib.ExitStack() as stack:
+            yield [stack.enter_context(self.open(idkey, database, shard)) for shard in range(self.shards(idkey, database))]
+
+    @contextlib.contextmanager
+    def transaction_all(self, idkey, database, shards=None):
+        """
+        lease SqliteDict of shards, default all, for writing, yield dict
+        of shard : SqliteDict. write locks are taken in order of shards,
+        so there are no deadlocks. every shard is committed at the end
+        of the block, or all are rolled back on error, a crash while
+        committing may leave some shards committed
+        """
+        if shards is None:
+            shards = range(self.shards(idkey, database))
+        with contextlib.ExitStack() as stack:
+            yield dict((shard, stack.enter_context(self.transaction(idkey, database, shard))) for shard in sorted(shards))
+
+    def invalidate(self, idkey, database):
+        """
+        close handles of database, called before database is dropped
+        or created
+        """
+        with self._lock:
+            self._meta.pop((idkey, database), None)
+            self._generations[(idkey, database)] += 1
+            for poolkey in [poolkey for poolkey in self._handles if poolkey[:2] == (idkey, database)]:
+                self._discard(self._handles.pop(poolkey))
+
+    def close(self):
+        """
+        close all handles
+        """
+        with self._lock:
+            self._meta.clear()
+            self._closed += 1
+            while self._handles:
+                self._discard(self._handles.popitem()[1])
+
+
+# number of keys read with one query while paging thru keys
+PAGE_SIZE = 1000
+
+
+def prefix_end(prefix):
+    """
+    return the smallest string greater than all strings starting with prefix,
+    or None if there is no such string
+    """
+    while prefix:
+        codepoint = ord(prefix[-1]) + 1
+        if 0xd800 <= codepoint < 0xe000: # skip surrogates, not valid in utf-8
+            codepoint = 0xe000
+        if codepoint <= sys.maxunicode:
+            return prefix[:-1] + chr(codepoint)
+        prefix = prefix[:-1]
+    return None
+
+
+def key_range(start=None, end=None, after=None, prefix=None, before=None):
+    """
+    return sql condition and parameters to select keys
+    start <= key < end, after < key < before and starting with prefix,
+    as range on primary key index
+    """
+    conditions = []
+    params = []
+    if before is not None:
+        conditions.append("key < ?")
+        params.append(before)
+    if start is not None:
+        conditions.append("key >= ?")
+        params.append(start)
+    if end is not None:
+        conditions.append("key < ?")
+        params.append(end)
+    if after is not None:
+        conditions.append("key > ?")
+        params.append(after)
+    if prefix:
+        conditions.append("key >= ?")
+        params.append(prefix)
+        end = prefix_end(prefix)
+        if end is not None:
+            conditions.append("key < ?")
+            params.append(end)
+    if not conditions:
+        return "", params
+    return "WHERE %s" % " AND ".join(conditions), params
+
+
+def iter_range(db, with_values=False, start=None, end=None, after=None, prefix=None, limit=None, page_size=PAGE_SIZE, reverse=False, before=None):
+    """
+    yield keys, or (key, value) with_values, of SqliteDict in key order,
+    or descending with reverse, reading page_size rows per query
+    """
+    columns = "key, value" if with_values else "key"
+    order = "DESC" if reverse else "ASC"
+    while limit is None or limit > 0:
+        size = page_size if limit is None else min(page_size, limit)
+        where, params = key_range(start, end, after, prefix, before)
+        query = 'SELECT %s FROM "%s" %s ORDER BY key %s LIMIT ?' % (columns, db.tablename, where, order)
+        rows = list(db.conn.select(query, params + [size]))
+        for row in rows:
+            if with_values:
+                yield row[0], db.decode(row[1])
+            else:
+                yield row[0]
+        if len(rows) < size:
+            break
+        if reverse:
+            before = rows[-1][0]
+        else:
+            after = rows[-1][0]
+        if limit is not None:
+            limit -= len(rows)
+
+
+def iter_merged(dbs, with_values=False, limit=None, reverse=False, **bounds):
+    """
+    iter_range() of every shard merged in key order, or descending
+    with reverse, every shard reads at most limit rows
+    """
+    if len(dbs) == 1:
+        return iter_range(dbs[0], with_values, limit=limit, reverse=reverse, **bounds)
+    iterators = [iter_range(db, with_values, limit=limit, reverse=reverse, **bounds) for db in dbs]
+    merged = heapq.merge(*iterators, key=(lambda item: item[0]) if with_values else None, reverse=reverse)
+    return itertools.islice(merged, limit)
+
+
+def count_keys(dbs, start=None, end=None, prefix=None):
+    """
+    return number of keys start <= key < end starting with prefix in all shards
+    """
+    where, params = key_range(start, end, prefix=prefix)
+    return sum(db.conn.select_one('SELECT COUNT(*) FROM "%s" %s' % (db.tablename, where), params)[0] for db in dbs)
+
+
+def iter_query(db, field, with_values=False, eq=None, start=None, end=None, limit=None, page_size=PAGE_SIZE, reverse=False):
+    """
+    yield (field value, key) or (field value, key, value) with_values of
+    keys whose value has field equal to eq, or start <= field < end, in
+    order of field value and key, or descending with reverse, read from
+    the expression index of field, page_size rows per query
+    """
+    expression = index_expression(field)
+    conditions, params = ["%s IS NOT NULL" % expression], []
+    for operator, bound in (("=", eq), (">=", start), ("<", end)):
+        if bound is not None:
+            conditions.append("%s %s ?" % (expression, operator))
+            params.append(bound)
+    columns = "%s, key, value" % expression if with_values else "%s, key" % expression
+    order = "DESC" if reverse else "ASC"
+    # equal field values are ordered by key alone, otherwise sqlite sorts them again
+    ordering = "key %s" % order if eq is not None else "%s %s, key %s" % (expression, order, order)
+    operator = "<" if reverse else ">"
+    last = None
+    while limit is None or limit > 0:
+        size = page_size if limit is None else min(page_size, limit)
+        where, page_params = list(conditions), list(params)
+        if last is not None: # continue after last row, in a form sqlite seeks in the index
+            if eq is not None:
+                where.append("key %s ?" % operator)
+                page_params.append(last[1])
+            else:
+                where.append("%s %s= ? AND (%s %s ? OR key %s ?)" % (expression, operator, expression, operator, operator))
+                page_params.extend((last[0], last[0], last[1]))
+        query = 'SELECT %s FROM "%s" WHERE %s ORDER BY %s LIMIT ?' % (columns, db.tablename, " AND ".join(where), ordering)
+        rows = list(db.conn.select(query, page_params + [size]))
+        for row in rows:
+            if with_values:
+                yield row[0], row[1], db.decode(row[2])
+            else:
+                yield row[0], row[1]
+        if len(rows) < size:
+            break
+        last = rows[-1][:2]
+        if limit is not None:
+            limit -= len(rows)
+
+
+def query_order(row):
+    """
+    sort key of rows of iter_query() like sqlite orders them,
+    numbers before text
+    """
+    return isinstance(row[0], str), row[0], row[1]
+
+
+def iter_query_merged(dbs, field, with_values=False, limit=None, reverse=False, **bounds):
+    """
+    iter_query() of every shard merged in order of field value and key
+    """
+    iterators = [iter_query(db, field, with_values, limit=limit, reverse=reverse, **bounds) for db in dbs]
+    return itertools.islice(heapq.merge(*iterators, key=query_order, reverse=reverse), limit)
+
+
+def iter_changes(db, since, limit=None, page_size=PAGE_SIZE):
+    """
+    yield (seq, key, RawJson value, or None if deleted) of changes of
+    SqliteDict after sequence number since, in order of seq. changes
+    followed by a later change of the same key are skipped, the later
+    change is returned instead, so every value is the current one
+    """
+    query = ('SELECT c.seq, c.key, c.deleted, t.value FROM "%s_changes" c LEFT JOIN "%s" t ON t.key = c.key '
+             'WHERE c.seq > ? AND NOT EXISTS (SELECT 1 FROM "%s_changes" l WHERE l.key = c.key AND l.seq > c.seq) '
+             'ORDER BY c.seq LIMIT ?' % (db.tablename, db.tablename, db.tablename))
+    while limit is None or limit > 0:
+        size = page_size if limit is None else min(page_size, limit)
+        rows = list(db.conn.select(query, (since, size)))
+        for seq, key, deleted, stored in rows:
+            yield seq, key, None if deleted else db.decode(stored)
+        if len(rows) < size:
+            break
+        since = rows[-1][0]
+        if limit is not None:
+            limit -= len(rows)
+
+
+def changes_complete(db, since):
+    """
+    does the change log of SqliteDict hold every change after since,
+    False if they were trimmed or since is not a sequence number of it
+    """
+    sequence = read_sequence(db)
+    if since >= sequence:
+        return since == sequence
+    first = db.conn.select_one('SELECT MIN(seq) FROM "%s_changes"' % db.tablename)[0]
+    return first is not None and first <= since + 1
+
+
+def trim_changes(db, max_age, max_entries):
+    """
+    delete changes older than max_age seconds and all but the last
+    max_entries from change log of SqliteDict, has to be called inside
+    a transaction
+    """
+    sequence = read_sequence(db)
+    db.conn.execute('DELETE FROM "%s_changes" WHERE seq <= ?' % db.tablename, (sequence - max_entries, ))
+    # changes are logged in order of time, so the old ones are at the start
+    db.conn.execute('DELETE FROM "%s_changes" WHERE seq < COALESCE((SELECT seq FROM "%s_changes" WHERE time >= ? ORDER BY seq LIMIT 1), ?)' % (db.tablename, db.tablename), (time.time() - max_age, sequence + 1))
+
+
+# notified after every transaction, waited for by long polls of changes
+CHANGES = threading.Condition()
+CHANGE_COUNTERS = collections.Counter() # (idkey, database) : number of transactions
+
+
+def notify_changes(idkey, database):
+    with CHANGES:
+        CHANGE_COUNTERS[(idkey, database)] += 1
+        CHANGES.notify_all()
+
+
+def wait_changes(idkey, database, counter, timeout):
+    """
+    wait until a transaction of database was committed after
+    CHANGE_COUNTERS was counter, or timeout, return if there was one
+    """
+    with CHANGES:
+        return CHANGES.wait_for(lambda: CHANGE_COUNTERS[(idkey, database)] != counter, timeout)
+
+
+def rollback(db):
+    """
+    roll back uncommitted changes of SqliteDict
+    """
+    try:
+        db.conn.execute("ROLLBACK")
+        db.conn.select_one("SELECT 1")
+    except sqlite3.OperationalError:
+        pass # there was no open transaction
+
+POOL = SqliteDictPool()
+atexit.register(POOL.close)
+
+# bytes read at once from request bodies
+CHUNK_SIZE = 64 * 1024
+# page cache of sqlite while importing, negative values are KiB
+BULK_CACHE_SIZE = -64 * 1024
+# default table of SqliteDict
+TABLENAME = "unnamed"
+
+
+def iter_request_body(chunk_size=CHUNK_SIZE):
+    """
+    yield request body in chunks of bytes, without reading it all,
+    decompressed according to Content-Encoding
+    """
+    stream = web.ctx.env["wsgi.input"]
+    remaining = web.ctx.env.get("CONTENT_LENGTH")
+    remaining = int(remaining) if remaining else None
+    decompress = decompressor(web.ctx.env.get("HTTP_CONTENT_ENCODING"))
+    while remaining is None or remaining > 0:
+        chunk = stream.read(chunk_size if remaining is None else min(chunk_size, remaining))
+        if not chunk:
+            break
+        if remaining is not None:
+            remaining -= len(chunk)
+        yield decompress.decompress(chunk) if decompress is not None else chunk
+
+
+def iter_ndjson(chunks):
+    """
+    yield decoded lines of newline delimited json read from chunks of bytes
+    """
+    buffer = b""
+    for chunk in chunks:
+        lines = (buffer + chunk).split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield json.loads(line.decode("utf-8"))
+    if buffer.strip():
+        yield json.loads(buffer.decode("utf-8"))
+
+
+def iter_json_object(chunks):
+    """
+    yield (key, value) of one json object read from chunks of bytes,
+    only the current value has to fit into memory
+    """
+    chunks = iter(chunks)
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    state = {"buffer" : "", "position" : 0}
+
+    def fill():
+        chunk = next(chunks, None)
+        if chunk is None:
+            return False
+        state["buffer"] = state["buffer"][state["position"]:] + utf8.decode(chunk)
+        state["position"] = 0
+        return True
+
+    def peek():
+        while True:
+            buffer = state["buffer"]
+            position = state["position"]
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            state["position"] = position
+            if position < len(buffer):
+                return buffer[position]
+            if not fill():
+                return None
+
+    def expect(char):
+        if peek() != char:
+            raise ValueError("expected %s at position %d" % (char, state["position"]))
+        state["position"] += 1
+
+    def decode():
+        while True:
+            peek()
+            try:
+                value, end = decoder.raw_decode(state["buffer"], state["position"])
+                # a number at the end of buffer may continue in the next chunk
+                if end < len(state["buffer"]) or not fill():
+                    state["position"] = end
+                    return value
+            except json.JSONDecodeError:
+                if not fill():
+                    raise
+
+    expect("{")
+    if peek() == "}":
+        return
+    while True:
+        key = decode()
+        expect(":")
+        yield key, decode()
+        if peek() == "}":
+            return
+        expect(",")
+
+
+def database_size(filename):
+    """
+    return size of sqlite database file including its WAL
+    """
+    size = os.path.getsize(filename)
+    if os.path.isfile(filename + "-wal"):
+        size += os.path.getsize(filename + "-wal")
+    return size
+
+
+def database_stats(idkey, database):
+    """
+    return number of keys, size in bytes and time of last modification
+    of database, and its settings, keys are read from the count tables,
+    size and time from the shard files, without leasing handles of the pool
+    """
+    meta = read_meta(idkey, database)
+    filenames = [shard_filename(idkey, database, shard) for shard in range(meta["shards"])]
+    keys = sum(read_count_file(filename) for filename in filenames)
+    modified = max(os.path.getmtime(filename) for filename in filenames + [filename + "-wal" for filename in filenames] if os.path.isfile(filename))
+    return {
+        "keys" : keys,
+        "size" : sum(database_size(filename) for filename in filenames),
+        "modified" : modified,
+        "created" : meta.get("created"),
+        "shards" : meta["shards"],
+        "format" : meta["format"],
+    }
+
+
+def read_count_file(filename):
+    """
+    return number of keys of shard file, read on a short lived read only
+    connection, keys are counted if the file was not opened since the
+    count table was introduced
+    """
+    if not os.path.isfile(filename):
+        return 0
+    conn = sqlite3.connect("file:%s?mode=ro" % urllib.parse.quote(filename), uri=True)
+    try:
+        try:
+            return conn.execute('SELECT value FROM "%s_count"' % TABLENAME).fetchone()[0]
+        except sqlite3.OperationalError:
+            return conn.execute('SELECT COUNT(*) FROM "%s"' % TABLENAME).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def iter_export(idkey, database):
+    """
+    yield all (key, RawJson) of database in key order, every shard is
+    read in one statement on a separate connection, so the export of
+    every shard is consistent
+
+    the read transaction lasts until the client read the whole export,
+    in WAL mode writers go on meanwhile, in the other journal modes,
+    like DELETE of databases created before meta.json, the shared lock
+    blocks every commit until then, so migrate them to WAL first
+    """
+    shards = read_meta(idkey, database)["shards"]
+    return heapq.merge(*(iter_export_shard(idkey, database, shard) for shard in range(shards)), key=lambda item: item[0])
+
+
+def iter_export_shard(idkey, database, shard):
+    """
+    yield all (key, RawJson) of shard in key order
+    """
+    conn = sqlite3.connect(shard_filename(idkey, database, shard))
+    try:
+        cursor = conn.execute('SELECT key, value FROM "%s" ORDER BY key' % TABLENAME)
+        while True:
+            rows = cursor.fetchmany(PAGE_SIZE)
+            if not rows:
+                break
+            for key, stored in rows:
+                yield key, decode_value(stored)
+    finally:
+        conn.close()
+
+
+class MaintenanceJob(threading.Thread):
+    """
+    run maintenance operations on database in background thread,
+    status is a dict to be polled while running
+
+    checkpoint          - write WAL back to database file and truncate it
+    analyze             - update statistics of query planner
+    incremental_vacuum  - free unused pages, if auto_vacuum is incremental
+    vacuum              - rebuild database file and switch auto_vacuum to
+                          incremental, so later incremental_vacuum works
+    trim                - trim change log by changes_max_age and
+                          changes_max_entries of database
+    sweep               - sweep cache database now, see CacheSweeper
+
+    operations run on one shard after the other, the write lock of
+    the shard is held for every operation, readers are served in between
+    """
+
+    OPERATIONS = ("vacuum", "incremental_vacuum", "analyze", "checkpoint", "trim", "sweep")
+    # trim and sweep run regularly anyway
+    DEFAULT_OPERATIONS = ("vacuum", "incremental_vacuum", "analyze", "checkpoint")
+
+    def __init__(self, idkey, database, operations):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._idkey = idkey
+        self._database = database
+        self._meta = read_meta(idkey, database)
+        self._shards = self._meta["shards"]
+        self.status = {
+            "state" : "running",
+            "operations" : list(operations),
+            "done" : [],
+            "started" : time.time(),
+            "finished" : None,
+            "size_before" : self._size(),
+            "size_after" : None,
+            "error" : None,
+        }
+
+    def _size(self):
+        return sum(database_size(shard_filename(self._idkey, self._database, shard)) for shard in range(self._shards))
+
+    def run(self):
+        try:
+            for operation in self.status["operations"]:
+                for shard in range(self._shards):
+                    with POOL.transaction(self._idkey, self._database, shard) as db:
+                        if operation == "vacuum":
+                            db.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                            db.conn.execute("VACUUM")
+                        elif operation == "incremental_vacuum":
+                            db.conn.execute("PRAGMA incremental_vacuum")
+                        elif operation == "analyze":
+                            db.conn.execute("ANALYZE")
+                        elif operation == "trim":
+                            trim_changes(db, self._meta["changes_max_age"], self._meta["changes_max_entries"])
+                        elif operation == "sweep":
+                            sweep_cache(db, SWEEPER.pop_accessed(self._idkey, self._database, shard), self._meta)
+                        elif operation == "checkpoint":
+                            db.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                        db.conn.select_one("SELECT 1") # wait for completion
+                self.status["done"].append(operation)
+                logging.info("maintenance %s of database %s done", operation, self._database)
+            self.status["state"] = "done"
+        except Exception as exc:
+            logging.exception(exc)
+            self.status["state"] = "failed"
+            self.status["error"] = str(exc)
+        self.status["size_after"] = self._size()
+        self.status["finished"] = time.time()
+
+
+# (idkey, database) : last MaintenanceJob started
+MAINTENANCE = {}
+MAINTENANCE_LOCK = threading.Lock()
+
+
+class CacheSweeper(threading.Thread):
+    """
+    background thread sweeping cache databases every interval seconds,
+    see sweep_cache(), started when the first cache database is opened
+
+    reads record access times in memory only, they are written to the
+    expiry table by the next sweep, in one transaction per shard, so
+    reads do not write. eviction is in approximate LRU order, and the
+    budget may be exceeded until the next sweep
+    """
+
+    def __init__(self, interval=CACHE_SWEEP_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._databases = set() # (idkey, database) of cache databases
+        self._accessed = {} # (idkey, database, shard) : {key : time}
+
+    def register(self, idkey, database):
+        with self._lock:
+            self._databases.add((idkey, database))
+            if not self.is_alive():
+                self.start()
+
+    def forget(self, idkey, database):
+        """
+        stop sweeping database, called before it is dropped
+        """
+        with self._lock:
+            self._databases.discard((idkey, database))
+            for accesskey in [accesskey for accesskey in self._accessed if accesskey[:2] == (idkey, database)]:
+                del self._accessed[accesskey]
+
+    def touch(self, idkey, database, shard, key):
+        """
+        record access of key
+        """
+        with self._lock:
+            self._accessed.setdefault((idkey, database, shard), {})[key] = time.time()
+
+    def pop_accessed(self, idkey, database, shard):
+        """
+        return and forget access times of keys of shard recorded since last sweep
+        """
+        with self._lock:
+            return self._accessed.pop((idkey, database, shard), {})
+
+    def sweep(self, idkey, database):
+        """
+        sweep every shard of database, return number of keys removed
+        """
+        meta = POOL.meta(idkey, database)
+        removed = 0
+        for shard in range(meta["shards"]):
+            with POOL.transaction(idkey, database, shard) as db:
+                removed += sweep_cache(db, self.pop_accessed(idkey, database, shard), meta)
+        return removed
+
+    def run(self):
+        while True:
+            time.sleep(self._interval)
+            with self._lock:
+                databases = list(self._databases)
+            for idkey, database in databases:
+                try:
+                    removed = self.sweep(idkey, database)
+                    if removed:
+                        logging.info("sweep of cache %s removed %d keys", database, removed)
+                except Exception as exc:
+                    logging.exception(exc)
+
+
+SWEEPER = CacheSweeper()
+
+
+# false positive rate of bloom filters
+BLOOM_ERROR_RATE = 0.01
+# minimum number of keys a bloom filter is sized for
+BLOOM_MIN_CAPACITY = 1024
+# more keys written since are answered with the whole filter
+BLOOM_MAX_DELTA = 10000
+
+
+class BloomFilter(object):
+    """
+    bloom filter of keys, bit positions are derived by double hashing
+    of blake2b of the key, RestNoSqlClient.BloomFilter is the same
+    """
+
+    def __init__(self, capacity, error_rate=BLOOM_ERROR_RATE):
+        bits = int(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.bits = max(64, (bits + 7) // 8 * 8)
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+        self.capacity = capacity
+        self.count = 0
+        self.filter = bytearray(self.bits // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(str(key).encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return ((first + index * second) % self.bits for index in range(self.hashes))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.filter[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.filter[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+# (idkey, database) : (BloomFilter, list of last version seen of every shard)
+BLOOM = {}
+BLOOM_LOCK = threading.Lock()
+BLOOM_LOCKS = collections.defaultdict(threading.Lock) # (idkey, database) : lock
+
+
+def bloom_filter(idkey, database):
     """
-    to encode returned value to json string
-    and set Content-Type
+    return bloom filter and sequences of shards of database, the filter
+    is built on first use and then updated with keys written since.
+    it is rebuilt when more keys were added than it was sized for,
+    which also drops deleted keys
     """
-    log = logging.getLogger(func.__name__)
-    def inner(*args, **kwds):
-        call_str = "%s(%s, %s)" % (func.__name__, args[1:], kwds)
-        log.debug("args: %s", args[1:])
-        log.debug("kwds: %s", kwds)
-        starttime = time.time()
-        try:
-            ret_val = func(*args, **kwds)
-            log.debug("function %s duration %s", call_str, (time.time() - starttime))
-            return ret_val
-        except Exception as exc:
-            log.exception(exc)
-            log.error("call to %s caused Exception", call_str)
-            web.internalerror()
-    # set inner function __name__ and __doc__ to original ones
-    inner.__name__ = func.__name__
-    inner.__doc__ = func.__doc__
-    return inner
+    with BLOOM_LOCK:
+        lock = BLOOM_LOCKS[(idkey, database)]
+    with lock:
+        entry = BLOOM.get((idkey, database))
+        with POOL.open_all(idkey, database) as dbs:
+            if entry is not None and len(entry[1]) == len(dbs):
+                bloom, sequences = entry
+                for shard, db in enumerate(dbs):
+                    for key, version in iter_written(db, sequences[shard]):
+                        bloom.add(key)
+                        sequences[shard] = version
+                if bloom.count <= bloom.capacity:
+                    return bloom, list(sequences)
+            sequences = [read_sequence(db) for db in dbs] # before reading keys, so no write is missed
+            bloom = BloomFilter(max(BLOOM_MIN_CAPACITY, 2 * count_keys(dbs)))
+            for db in dbs:
+                for key in iter_range(db):
+                    bloom.add(key)
+            BLOOM[(idkey, database)] = (bloom, sequences)
+            logging.info("bloom filter of %s/%s built, %d bits", idkey, database, bloom.bits)
+            return bloom, list(sequences)
 
 
-
-#logging.info("scanning existing databases")
-STORAGE_DIR = "/var/www/data"
-if not os.path.isdir(STORAGE_DIR):
-    os.mkdir(STORAGE_DIR)
-for idkey in CONFIG.keys():
-    id_dir = os.path.join(STORAGE_DIR, idkey)
-    if not os.path.isdir(id_dir):
-        logging.info("creating subdirectory for id %s", idkey)
-        os.mkdir(id_dir)
-#logging.info("found %s", os.listdir(STORAGE_DIR))
+def drop_bloom_filter(idkey, database):
+    with BLOOM_LOCK:
+        BLOOM.pop((idkey, database), None)
+        BLOOM_LOCKS.pop((idkey, database), None)
 
 
 class RestNoSqlManager(object):
@@ -155,82 +2045,311 @@ class RestNoSqlManager(object):
     key must be string with maximum length of 100
 
     HEAD   /<database>  exists databases
-    GET    /            return all databases
-    PUT    /<database>  create database
+    GET    /            return all databases, with stats=1 their statistics
+    GET    /<database>  export database
+    POST   /<database>  create database
+    PUT    /<database>  import data into database
     DELETE /<database>  delete database
+    PATCH  /<database>  change settings, migrate database to json storage format
     """
 
+    @stats
+    @compress
     @authenticator(CONFIG)
-    @encode_json
     def GET(self, *args, **kwds):
         """
-        LIST available Databases
+        LIST available Databases, or EXPORT database if given
+
+        with query parameter stats=1 the list is a json object of
+        database : {"keys", "size", "modified", "created", "shards", "format"}
+
+        export is streamed as newline delimited json, one [key, value]
+        per line, or as one json object with query parameter format=json,
+        see iter_export(), in journal_mode other than WAL writers wait
+        until the export is read completely
         """
-        id_dir = os.path.join(STORAGE_DIR, kwds["_x_idkey"])
-        return os.listdir(id_dir)
+        database = args[0].split("/")[0]
+        idkey = kwds["_x_idkey"]
+        params = web.input(_method="get", format="ndjson", stats=None)
+        if not database:
+            web.header('Content-Type', 'application/json')
+            if params.stats == "1":
+                return json.dumps(dict((database, database_stats(idkey, database)) for database in CATALOG.list(idkey)))
+            return json.dumps(CATALOG.list(idkey))
+        if not CATALOG.exists(idkey, database):
+            web.notfound()
+            return
+        if params.format == "json":
+            web.header('Content-Type', 'application/json')
+            return self._export_object(idkey, database)
+        web.header('Content-Type', 'application/x-ndjson')
+        return self._export_ndjson(idkey, database)
 
-    @authenticator(CONFIG)
-    def POST(self, *args, **kwds):
+    def _export_ndjson(self, idkey, database):
+        for key, value in iter_export(idkey, database):
+            yield "[%s,%s]\n" % (json.dumps(key), value)
+
+    def _export_object(self, idkey, database):
+        separator = "{"
+        for key, value in iter_export(idkey, database):
+            yield "%s%s:%s" % (separator, json.dumps(key), value)
+            separator = ","
+        yield "}" if separator == "," else "{}"
+
+    def _create(self, idkey, database, settings=None):
         """
-        CREATE empty DB
+        create database if not existing, settings are stored in meta.json,
+        return True if database was created
         """
-        database = args[0].split("/")[0]
-        id_dir = os.path.join(STORAGE_DIR, kwds["_x_idkey"])
+        if not valid_database(database):
+            raise ValueError("invalid name of database %r" % database)
+        if CATALOG.exists(idkey, database):
+            return False
+        meta = {
+            "format" : DEFAULT_FORMAT,
+            "journal_mode" : DEFAULT_JOURNAL_MODE,
+            "synchronous" : DEFAULT_SYNCHRONOUS,
+        }
+        meta.update(settings or {})
+        id_dir = os.path.join(STORAGE_DIR, idkey)
         if not os.path.isdir(id_dir):
             os.mkdir(id_dir)
         db_dir = os.path.join(id_dir, database)
         if not os.path.isdir(db_dir):
             os.mkdir(db_dir)
-        filename = os.path.join(db_dir, "data.sqlite")
-        # if file already exists, nothing special happens !
-        with SqliteDict(filename) as db:
-            logging.info("POST database %s in file %s created", database, filename)
+            meta["created"] = time.time()
+            write_meta(idkey, database, meta)
+            POOL.invalidate(idkey, database)
+            drop_bloom_filter(idkey, database)
+        meta = read_meta(idkey, database)
+        for shard in range(meta["shards"]):
+            filename = shard_filename(idkey, database, shard)
+            # if file already exists, nothing special happens !
+            with SqliteDict(filename, journal_mode=meta["journal_mode"]) as db:
+                logging.info("POST database %s in file %s created", database, filename)
+        CATALOG.add(idkey, database)
+        return True
+
+    @stats
+    @compress
+    @authenticator(CONFIG)
+    def POST(self, *args, **kwds):
+        """
+        CREATE empty DB, if not existing, 201 if created, 200 otherwise
+
+        query parameters format (json or pickle), journal_mode and
+        synchronous select the settings, see SETTINGS and defaults,
+        shards splits the database into up to MAX_SHARDS files,
+        to write into them in parallel, default 1, indexes is a comma
+        separated list of fields of values to index, see RestNoSqlQuery
+
+        type=cache creates a cache, see DATABASE_TYPES, with budget
+        max_entries and max_bytes and default_ttl in seconds
+        """
+        database = args[0].split("/")[0]
+        params = web.input(_method="get")
+        settings = dict((name, params[name]) for name in ("format", "journal_mode", "synchronous") if name in params)
+        error = check_settings(settings)
+        if error is None and not valid_database(database):
+            error = "invalid name of database %r" % database
+        if error is None and "shards" in params:
+            if not params.shards.isdigit() or not 0 < int(params.shards) <= MAX_SHARDS:
+                error = "shards must be between 1 and %d" % MAX_SHARDS
+            else:
+                settings["shards"] = int(params.shards)
+        if error is None and params.get("indexes"):
+            settings["indexes"] = params.indexes.split(",")
+            error = check_settings({"indexes" : settings["indexes"]})
+        if error is None and "type" in params:
+            if params.type not in DATABASE_TYPES:
+                error = "type must be one of %s" % ", ".join(DATABASE_TYPES)
+            else:
+                settings["type"] = params.type
+        for name in ("max_entries", "max_bytes", "default_ttl"):
+            if error is None and name in params:
+                settings[name] = int(params[name]) if params[name].isdigit() else None
+                error = check_settings({name : settings[name]})
+        if error is not None:
+            logging.error(error)
+            web.badrequest()
+            return
+        if self._create(kwds["_x_idkey"], database, settings):
+            web.ctx.status = "201 Created"
         return database
 
+    @stats
+    @compress
     @authenticator(CONFIG)
+    @encode_json
     def PUT(self, *args, **kwds):
         """
-        TODO: IMPORT from provided Data
+        IMPORT data streamed in request body, database is created if necessary
+
+        body is newline delimited json, one [key, value] per line, if
+        Content-Type is application/x-ndjson, otherwise one json object.
+        all keys are written in one transaction per shard, existing keys are
+        replaced, with query parameter truncate=1 the database is emptied first,
+        the change log is trimmed afterwards. any invalid line or key rolls
+        back every shard and returns 400
+
+        returns {"loaded": number of keys}
+        """
+        database = args[0].split("/")[0]
+        idkey = kwds["_x_idkey"]
+        params = web.input(_method="get", truncate=None)
+        if not valid_database(database):
+            logging.error("invalid name of database %r", database)
+            web.badrequest()
+            return
+        self._create(idkey, database)
+        if web.ctx.env.get("CONTENT_TYPE", "").startswith("application/x-ndjson"):
+            items = (self._import_item(item) for item in iter_ndjson(iter_request_body()))
+        else:
+            items = iter_json_object(iter_request_body())
+        loaded = 0
+        shards = POOL.shards(idkey, database)
+        try:
+            with POOL.transaction_all(idkey, database) as dbs:
+                for db in dbs.values():
+                    db.conn.execute("PRAGMA cache_size = %d" % BULK_CACHE_SIZE)
+                try:
+                    if params.truncate == "1":
+                        for db in dbs.values():
+                            db.conn.execute('DELETE FROM "%s"' % db.tablename)
+                    for key, value in items:
+                        dbs[shard_of(key, shards)][key] = value
+                        loaded += 1
+                finally:
+                    for db in dbs.values():
+                        db.conn.execute("PRAGMA cache_size = -2000") # sqlite default
+        except ValueError as exc:
+            logging.error("import into %s failed, %s", database, exc)
+            web.badrequest()
+            return
+        # one transaction per shard does not reach the trim in transaction()
+        meta = POOL.meta(idkey, database)
+        with POOL.transaction_all(idkey, database) as dbs:
+            for db in dbs.values():
+                trim_changes(db, meta["changes_max_age"], meta["changes_max_entries"])
+        logging.info("PUT database %s imported %d keys", database, loaded)
+        return {"loaded" : loaded}
+
+    def _import_item(self, item):
+        """
+        return (key, value) of line of import, ValueError if it is no
+        [key, value] with string key, which rolls back the whole import
         """
-        return
-        #database = args[0].split("/")[0]
-        #os.mkdir(os.path.join(STORAGE_DIR, database))
-        #with dbm.open(os.path.join(STORAGE_DIR, database, "data.dbm"), "c") as db:
-        #    for key, value in json.loads(web.data.decode("utf-8")):
-        #        db[key] = json.dumps(value)
-        #logging.info("PUT database %s imported", database)
+        if not isinstance(item, list) or len(item) != 2 or not isinstance(item[0], str):
+            raise ValueError("lines of import must be [key, value] with string key")
+        return tuple(item)
 
+    @stats
+    @compress
     @authenticator(CONFIG)
     def HEAD(self, *args, **kwds):
         """
         does database exist
         """
         database = args[0].split("/")[0]
-        id_dir = os.path.join(STORAGE_DIR, kwds["_x_idkey"])
-        if database not in os.listdir(id_dir):
+        if not CATALOG.exists(kwds["_x_idkey"], database):
             web.notfound()
 
+    @stats
+    @compress
     @authenticator(CONFIG)
     def DELETE(self, *args, **kwds):
         """
         delete database
         """
         database = args[0].split("/")[0]
-        id_dir = os.path.join(STORAGE_DIR, kwds["_x_idkey"])
-        if database not in os.listdir(id_dir):
+        idkey = kwds["_x_idkey"]
+        if not CATALOG.exists(idkey, database):
             web.notfound()
         else:
-            db_filename = os.path.join(id_dir, database, "data.sqlite")
-            if os.path.isfile(db_filename):
-                os.unlink(db_filename)
-            os.rmdir(os.path.join(id_dir, database))
+            CATALOG.remove(idkey, database)
+            SWEEPER.forget(idkey, database)
+            POOL.invalidate(idkey, database)
+            drop_bloom_filter(idkey, database)
+            shutil.rmtree(os.path.join(STORAGE_DIR, idkey, database))
             logging.info("database %s deleted", database)
 
+    @stats
+    @compress
+    @authenticator(CONFIG)
+    @encode_json
+    def PATCH(self, *args, **kwds):
+        """
+        change settings of database, body is json object of settings,
+        see SETTINGS, without body the database is migrated to json format
+
+        journal_mode and synchronous take effect at once, changing format
+        from pickle to json, or a request without body, converts existing
+        pickled values in transactions of PAGE_SIZE keys, new values are
+        written as json at once, values of both formats can be read meanwhile. indexes are created or dropped before the
+        response, pickled values are indexed after they are converted
+
+        returns settings and number of values converted
+        """
+        database = args[0].split("/")[0]
+        idkey = kwds["_x_idkey"]
+        if not CATALOG.exists(idkey, database):
+            web.notfound()
+            return
+        body = request_data()
+        try:
+            settings = json.loads(body.decode("utf-8")) if body else {"format" : "json"}
+        except ValueError as exc:
+            logging.error("settings are no valid json, %s", exc)
+            web.badrequest()
+            return
+        error = check_settings(settings) if isinstance(settings, dict) else "settings must be json object"
+        if error is not None:
+            logging.error(error)
+            web.badrequest()
+            return
+        meta = read_meta(idkey, database)
+        # without body migration is asked for, to finish an interrupted one
+        migrate = settings.get("format") == "json" and (meta["format"] == "pickle" or not body)
+        meta.update(settings)
+        write_meta(idkey, database, meta)
+        POOL.invalidate(idkey, database)
+        if "indexes" in settings:
+            with POOL.open_all(idkey, database): # build indexes now, not on first use
+                pass
+        converted = 0
+        if migrate:
+            converted = self._migrate(idkey, database)
+            logging.info("database %s migrated to json format, %d values converted", database, converted)
+        meta["converted"] = converted
+        return meta
+
+    def _migrate(self, idkey, database):
+        """
+        convert pickled values to json, return number of converted values
+        """
+        converted = 0
+        for shard in range(POOL.shards(idkey, database)):
+            after = None
+            while True:
+                with POOL.transaction(idkey, database, shard) as db:
+                    where, params = key_range(after=after)
+                    query = 'SELECT key, value FROM "%s" %s ORDER BY key LIMIT ?' % (db.tablename, where)
+                    rows = list(db.conn.select(query, params + [PAGE_SIZE]))
+                    for key, stored in rows:
+                        if isinstance(stored, bytes):
+                            db.conn.execute('UPDATE "%s" SET value = ? WHERE key = ?' % db.tablename, (encode_value(pickle.loads(stored)), key))
+                            converted += 1
+                if len(rows) < PAGE_SIZE:
+                    break
+                after = rows[-1][0]
+        return converted
+
+    @stats
+    @compress
     @authenticator(CONFIG)
     @encode_json
     def OPTIONS(self, *args, **kwds):
-        id_dir = os.path.join(STORAGE_DIR, kwds["_x_idkey"])
-        return os.listdir(id_dir)
+        return CATALOG.list(kwds["_x_idkey"])
 
 
 class RestNoSql(object):
@@ -247,57 +2366,114 @@ class RestNoSql(object):
 
     key must be string with maximum length of 100 character TODO
 
-    OPTIONS     /<database>/     return list of keys
-    GET         /<database>/key  return value of key or 404
-    PUT         /<database>/     replace existing data with provided data, json formatteddata must be dict
+    OPTIONS     /<database>/     return list of keys, see OPTIONS for paging
+    HEAD        /<database>/?key=key  does key exist, 200 or 404
+    GET         /<database>/key  return value of key or 404, with version as ETag
+    PUT         /<database>/     add list of values to list of key, values will be unique
     POST        /<database>/key  existing value will be replaced
     DELETE      /<database>/key  delete key/value pair
-    """
+    PATCH       /<database>/     start maintenance in background
+
+    in cache databases POST takes query parameter ttl, expired keys
+    are not found anymore, reads are recorded for LRU eviction
 
-    def _db(self, database, x_idkey):
-        db_filename = os.path.join(STORAGE_DIR, x_idkey, database, "data.sqlite")
-        return db_filename
+    every write takes a new version of the key, see init_versions(),
+    POST and DELETE with If-Match header only change the key if its
+    version matches, POST with If-None-Match: * only creates new keys,
+    otherwise 412 is returned
 
+    see RestNoSqlBatch for multiple operations in one request,
+    RestNoSqlScan to read key/value pairs, RestNoSqlMerge for
+    atomic updates of values and RestNoSqlBloom for a bloom filter of keys
+    """
+
+    @stats
+    @compress
     @authenticator(CONFIG)
     @encode_json
-    @stats
     def GET(self, *args, **kwds):
         """
         key data
         data should be string or None
+
+        version of key is returned as ETag, with If-None-Match
+        header of the same version 304 without body is returned
         """
         database = args[0].split("/")[0]
-        key = json.loads(web.data().decode("utf-8"))
+        idkey = kwds["_x_idkey"]
+        key = json.loads(request_data().decode("utf-8"))
+        shard = POOL.shard_of(idkey, database, key)
         try:
-            with SqliteDict(self._db(database, kwds["_x_idkey"])) as db:
-                return db[key]
+            with POOL.open(idkey, database, shard) as db:
+                value, version = read_versioned(db, key)
+                if POOL.meta(idkey, database)["type"] == "cache":
+                    if cache_expired(db, key):
+                        raise KeyError(key)
+                    SWEEPER.touch(idkey, database, shard, key)
         except KeyError:
             web.notfound()
+            return
+        web.header("ETag", etag(version))
+        if_none_match = web.ctx.env.get("HTTP_IF_NONE_MATCH")
+        if if_none_match is not None and etag_matches(if_none_match, version):
+            web.notmodified()
+            return
+        return value
 
+    @stats
+    @compress
     @authenticator(CONFIG)
+    def HEAD(self, *args, **kwds):
+        """
+        does key, given as query parameter key, exist, answered from the
+        primary key index without reading the value, version is ETag
+        """
+        database = args[0].split("/")[0]
+        params = web.input(_method="get", key=None)
+        if params.key is None:
+            web.badrequest()
+            return
+        idkey = kwds["_x_idkey"]
+        shard = POOL.shard_of(idkey, database, params.key)
+        with POOL.open(idkey, database, shard) as db:
+            version = read_version(db, params.key)
+            if version is not None and POOL.meta(idkey, database)["type"] == "cache":
+                if cache_expired(db, params.key):
+                    version = None
+                else:
+                    SWEEPER.touch(idkey, database, shard, params.key)
+        if version is None:
+            web.notfound()
+            return
+        web.header("ETag", etag(version))
+
     @stats
+    @compress
+    @authenticator(CONFIG)
     def PUT(self, *args, **kwds):
         """
         append data to existing data of key, value will be unique
         
-        value has to be of type list
+        value has to be of type list, items already in data[key] are
+        not added again, 400 if value or data[key] is not a list
 
         if key in data:
-            data[key] = list(set(data[key] + value))
+            data[key] = data[key] + [item for item in value if item not in data[key]]
         else:
             data[key] = value
         """
         database = args[0].split("/")[0]
-        key, value = json.loads(web.data().decode("utf-8"))
-        with SqliteDict(self._db(database, kwds["_x_idkey"]), autocommit=True) as db:
-            if key in db:
-                if db[key] != value:
-                    db[key] = value
-            else:
-                db[key] = value
+        key, value = json.loads(request_data().decode("utf-8"))
+        try:
+            with POOL.transaction(kwds["_x_idkey"], database, POOL.shard_of(kwds["_x_idkey"], database, key)) as db:
+                merge(db, key, "union", value)
+        except ValueError as exc:
+            logging.error("PUT of key %s failed, %s", key, exc)
+            web.badrequest()
 
-    @authenticator(CONFIG)
     @stats
+    @compress
+    @authenticator(CONFIG)
     def POST(self, *args, **kwds):
         """
         set key to value, if key already exists, the old value will be destroyed
@@ -305,56 +2481,671 @@ class RestNoSql(object):
 
         assert isinstance(value, list)
         data[key] = value
+
+        new version of key is returned as ETag, in cache databases
+        query parameter ttl sets the seconds until key expires
         """
         database = args[0].split("/")[0]
-        key, value = json.loads(web.data().decode("utf-8"))
-        with SqliteDict(self._db(database, kwds["_x_idkey"]), autocommit=True) as db:
+        idkey = kwds["_x_idkey"]
+        key, value = json.loads(request_data().decode("utf-8"))
+        params = web.input(_method="get", ttl=None)
+        if params.ttl is not None and (POOL.meta(idkey, database)["type"] != "cache" or not params.ttl.replace(".", "", 1).isdigit()):
+            logging.error("invalid ttl of key %s in database %s, or no cache", key, database)
+            web.badrequest()
+            return
+        with POOL.transaction(idkey, database, POOL.shard_of(idkey, database, key)) as db:
+            if not check_preconditions(db, key):
+                web.preconditionfailed()
+                return
             db[key] = value
+            if params.ttl is not None:
+                set_expiry(db, key, float(params.ttl))
+            web.header("ETag", etag(read_version(db, key)))
 
+    @stats
+    @compress
     @authenticator(CONFIG)
     @encode_json
-    @stats
     def OPTIONS(self, *args, **kwds):
         """
         return list of keys in database
+
+        query parameters, all optional
+            prefix  only keys starting with prefix
+            start   only keys greater or equal start
+            end     only keys lower than end
+            reverse 1 to return keys in descending order
+            after   only keys greater than after, for paging
+            before  only keys lower than before, for paging in reverse
+            limit   return at most limit keys as {"keys": [...], "next": key},
+                    next is the after (or before in reverse) parameter of the
+                    next page or null on the last page
+            format  ndjson to stream keys in order, one json encoded key per line
+                    count to return number of keys only
+
+        with any parameter keys are ordered by key, ranges are read from the
+        primary key index of every shard and merged
         """
         database = args[0].split("/")[0]
-        keys = []
-        with SqliteDict(self._db(database, kwds["_x_idkey"])) as db:
-            return list(db.keys())
+        params = web.input(_method="get", prefix=None, start=None, end=None, reverse=None, after=None, before=None, limit=None, format=None)
+        try:
+            limit = int_param(params, "limit")
+        except ValueError as exc:
+            logging.error(exc)
+            web.badrequest()
+            return
+        bounds = {
+            "start" : params.start,
+            "end" : params.end,
+            "after" : params.after,
+            "before" : params.before,
+            "prefix" : params.prefix,
+            "reverse" : params.reverse == "1",
+        }
+        if params.format == "ndjson":
+            return self._stream_keys(kwds["_x_idkey"], database, limit, bounds)
+        with POOL.open_all(kwds["_x_idkey"], database) as dbs:
+            if params.format == "count":
+                return count_keys(dbs, params.start, params.end, params.prefix)
+            if limit is not None:
+                keys = list(iter_merged(dbs, limit=limit, **bounds))
+                return {
+                    "keys" : keys,
+                    "next" : keys[-1] if keys and len(keys) == limit else None
+                }
+            if any(bounds.values()):
+                return list(iter_merged(dbs, **bounds))
+            return [key for db in dbs for key in db.keys()]
+
+    def _stream_keys(self, idkey, database, limit, bounds):
+        """
+        generator of keys, keeps database leased until exhausted
+        """
+        with POOL.open_all(idkey, database) as dbs:
+            for key in iter_merged(dbs, limit=limit, **bounds):
+                yield key
 
-    @authenticator(CONFIG)
     @stats
+    @compress
+    @authenticator(CONFIG)
     def DELETE(self, *args, **kwds):
         """
         delete key in database or 404 if key not found
         """
         database = args[0].split("/")[0]
-        key = json.loads(web.data().decode("utf-8"))
+        key = json.loads(request_data().decode("utf-8"))
         try:
-            with SqliteDict(self._db(database, kwds["_x_idkey"]), autocommit=True) as db:
+            with POOL.transaction(kwds["_x_idkey"], database, POOL.shard_of(kwds["_x_idkey"], database, key)) as db:
+                if not check_preconditions(db, key):
+                    web.preconditionfailed()
+                    return
                 del db[key]
         except KeyError:
             web.notfound()
 
-    @authenticator(CONFIG)
     @stats
+    @compress
+    @authenticator(CONFIG)
+    @encode_json
     def PATCH(self, *args, **kwds):
         """
-        delete one key if key given or delete all keys if no key is given
+        start maintenance of database in background, returns 202 and
+        status of the maintenance, poll status at /<database>/_maintenance
 
-        TODO: theres a slight chance, the database is not ready,
-            so i will try 2 times, and wait for 1 s in between
+        body is optional json list of operations, see MaintenanceJob,
+        default are all but trim. 409 if maintenance of database is still running
         """
-        return
-        #database = args[0].split("/")[0]
-        #with dbm.open(self._db(database), "w") as db:
-        #    db.reorganize()
+        database = args[0].split("/")[0]
+        idkey = kwds["_x_idkey"]
+        if not CATALOG.exists(idkey, database):
+            web.notfound()
+            return
+        body = request_data()
+        operations = json.loads(body.decode("utf-8")) if body else None
+        if operations is None:
+            operations = MaintenanceJob.DEFAULT_OPERATIONS
+        if any(operation not in MaintenanceJob.OPERATIONS for operation in operations):
+            web.badrequest()
+            return
+        with MAINTENANCE_LOCK:
+            job = MAINTENANCE.get((idkey, database))
+            if job is not None and job.is_alive():
+                web.ctx.status = "409 Conflict"
+                return job.status
+            job = MaintenanceJob(idkey, database, operations)
+            MAINTENANCE[(idkey, database)] = job
+            job.start()
+        web.ctx.status = "202 Accepted"
+        return job.status
+
+
+class RestNoSqlBatch(object):
+    """
+    run multiple get/set/delete operations in one request and one transaction
+
+    GET         /<database>/_batch  json list of keys, returns list of results
+    POST        /<database>/_batch  list of operations, returns list of results
+
+    GET reads the values of keys and needs GET permission only,
+    like a batch of get operations without transaction
+
+    every operation is a list
+        ["get", key]
+        ["set", key, value] or
+        ["set", key, value, ttl], ttl in seconds in cache databases
+        ["delete", key]
+        ["merge", key, operator, argument] or
+        ["merge", key, operator, argument, field], see RestNoSqlMerge
+
+    every result is a list [status, value] in order of the operations,
+    status is 200 or 404 for not existing keys, value is only set for get
+    and merge, which returns the new value. if any merge fails, nothing
+    is changed and 400 is returned
+
+    in databases with shards there is one transaction per shard involved,
+    see SqliteDictPool.transaction_all()
+
+    the caller needs permission for the HTTP method matching
+    each operation, GET, POST or DELETE
+    """
+
+    # operation : (HTTP method needed, minimum and maximum number of arguments)
+    OPERATIONS = {
+        "get" : ("GET", 1, 1),
+        "set" : ("POST", 2, 3),
+        "delete" : ("DELETE", 1, 1),
+        "merge" : ("POST", 3, 4),
+    }
+
+    @stats
+    @compress
+    @authenticator(CONFIG)
+    @encode_json
+    def GET(self, *args, **kwds):
+        """
+        read values of keys, leasing every shard involved once
+        """
+        database = args[0]
+        idkey = kwds["_x_idkey"]
+        keys = json.loads(request_data().decode("utf-8"))
+        if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+            logging.error("keys of batch must be a list of strings")
+            web.badrequest()
+            return
+        meta = POOL.meta(idkey, database)
+        results = []
+        with contextlib.ExitStack() as stack:
+            dbs = {}
+            for key in keys:
+                shard = shard_of(key, meta["shards"])
+                if shard not in dbs:
+                    dbs[shard] = stack.enter_context(POOL.open(idkey, database, shard))
+                try:
+                    results.append([200, self._get(dbs[shard], idkey, database, shard, meta, key)])
+                except KeyError:
+                    results.append([404, None])
+        return RawJson("[%s]" % ",".join("[%d,%s]" % (status, dump_json(value)) for status, value in results))
+
+    def _get(self, db, idkey, database, shard, meta, key):
+        """
+        return value of key, KeyError if not existing or expired
+        """
+        value = db[key]
+        if meta["type"] == "cache":
+            if cache_expired(db, key):
+                raise KeyError(key)
+            SWEEPER.touch(idkey, database, shard, key)
+        return value
+
+    def _valid(self, operation):
+        """
+        True if operation is a list of known operation, string key
+        and the number of arguments of this operation
+        """
+        if not isinstance(operation, list) or not operation or not isinstance(operation[0], str) or operation[0] not in self.OPERATIONS:
+            return False
+        _, minimum, maximum = self.OPERATIONS[operation[0]]
+        if not minimum < len(operation) <= maximum + 1 or not isinstance(operation[1], str):
+            return False
+        return operation[0] != "merge" or (isinstance(operation[2], str) and operation[2] in MERGE_OPERATORS)
+
+    @stats
+    @compress
+    @authenticator(CONFIG)
+    @encode_json
+    def POST(self, *args, **kwds):
+        """
+        run operations and commit once
+        """
+        database = args[0]
+        operations = json.loads(request_data().decode("utf-8"))
+        methods = CONFIG[kwds["_x_idkey"]][kwds["_x_apikey"]]["methods"]
+        if not isinstance(operations, list):
+            logging.error("operations of batch must be a list")
+            web.badrequest()
+            return
+        for operation in operations:
+            if not self._valid(operation):
+                logging.error("invalid batch operation %s", operation)
+                web.badrequest()
+                return
+            if self.OPERATIONS[operation[0]][0] not in methods:
+                logging.error("X-APIKEY %s not allowed for batch operation %s", kwds["_x_apikey"], operation[0])
+                web.ctx.status = "401 Unauthorized"
+                return
+        results = []
+        meta = POOL.meta(kwds["_x_idkey"], database)
+        shards = meta["shards"]
+        ttls = [operation[3] for operation in operations if operation[0] == "set" and len(operation) == 4]
+        if ttls and (meta["type"] != "cache" or not all(ttl is None or isinstance(ttl, (int, float)) for ttl in ttls)):
+            logging.error("invalid ttl in batch of database %s, or no cache", database)
+            web.badrequest()
+            return
+        try:
+            with POOL.transaction_all(kwds["_x_idkey"], database, set(shard_of(operation[1], shards) for operation in operations)) as dbs:
+                for operation in operations:
+                    db = dbs[shard_of(operation[1], shards)]
+                    try:
+                        if operation[0] == "get":
+                            results.append([200, self._get(db, kwds["_x_idkey"], database, shard_of(operation[1], shards), meta, operation[1])])
+                        elif operation[0] == "set":
+                            db[operation[1]] = operation[2]
+                            if len(operation) == 4 and operation[3] is not None:
+                                set_expiry(db, operation[1], operation[3])
+                            results.append([200, None])
+                        elif operation[0] == "delete":
+                            del db[operation[1]]
+                            results.append([200, None])
+                        elif operation[0] == "merge":
+                            results.append([200, merge(db, *operation[1:])])
+                    except KeyError:
+                        results.append([404, None])
+        except ValueError as exc:
+            logging.error("batch failed, %s", exc)
+            web.badrequest()
+            return
+        return RawJson("[%s]" % ",".join("[%d,%s]" % (status, dump_json(value)) for status, value in results))
+
+
+class RestNoSqlMerge(object):
+    """
+    atomic update of value, read and written in one transaction
+
+    POST        /<database>/_merge  [key, operator, argument] or
+                                    [key, operator, argument, field]
+
+    operator is one of MERGE_OPERATORS, see merge_value(), returns
+    the new value, 400 if operator is unknown or types do not fit
+    """
+
+    @stats
+    @compress
+    @authenticator(CONFIG)
+    @encode_json
+    def POST(self, *args, **kwds):
+        """
+        merge argument into value of key
+        """
+        database = args[0]
+        operation = json.loads(request_data().decode("utf-8"))
+        if not 3 <= len(operation) <= 4 or operation[1] not in MERGE_OPERATORS:
+            logging.error("invalid merge operation %s", operation)
+            web.badrequest()
+            return
+        idkey = kwds["_x_idkey"]
+        try:
+            with POOL.transaction(idkey, database, POOL.shard_of(idkey, database, operation[0])) as db:
+                return merge(db, *operation)
+        except ValueError as exc:
+            logging.error("merge of key %s failed, %s", operation[0], exc)
+            web.badrequest()
+
+
+class RestNoSqlScan(object):
+    """
+    stream key/value pairs in key order
+
+    GET         /<database>/_scan  newline delimited json, one [key, value] per line
+
+    query parameters, all optional
+        prefix  only keys starting with prefix
+        start   only keys greater or equal start
+        end     only keys lower than end
+        reverse 1 to stream in descending key order
+        limit   stream at most limit pairs
+        after   only keys greater than after, to resume a scan
+        before  only keys lower than before, to resume a reverse scan
+        batch   number of rows read per query, 1 to 10 * PAGE_SIZE, default PAGE_SIZE
+    """
+
+    @stats
+    @compress
+    @authenticator(CONFIG)
+    @encode_json
+    def GET(self, *args, **kwds):
+        """
+        return generator of [key, value]
+        """
+        database = args[0]
+        if not CATALOG.exists(kwds["_x_idkey"], database):
+            web.notfound()
+            return
+        params = web.input(_method="get", prefix=None, start=None, end=None, reverse=None, limit=None, after=None, before=None, batch=None)
+        try:
+            limit = int_param(params, "limit")
+            page_size = int_param(params, "batch", maximum=10 * PAGE_SIZE)
+        except ValueError as exc:
+            logging.error(exc)
+            web.badrequest()
+            return
+        bounds = {
+            "start" : params.start,
+            "end" : params.end,
+            "after" : params.after,
+            "before" : params.before,
+            "prefix" : params.prefix,
+            "reverse" : params.reverse == "1",
+            "limit" : limit,
+            "page_size" : page_size if page_size is not None else PAGE_SIZE,
+        }
+        return self._stream_items(kwds["_x_idkey"], database, bounds)
+
+    def _stream_items(self, idkey, database, bounds):
+        """
+        generator of [key, value], keeps database leased until exhausted
+        """
+        with POOL.open_all(idkey, database) as dbs:
+            for key, value in iter_merged(dbs, True, **bounds):
+                yield RawJson("[%s,%s]" % (json.dumps(key), value))
+
+
+class RestNoSqlQuery(object):
+    """
+    stream key/value pairs by indexed field of value, answered
+    by the expression index of field, never by a full scan
+
+    GET         /<database>/_query?field=name  newline delimited json, one [key, value] per line
+
+    query parameters, values of eq, start and end are json
+        field     indexed field, see PATCH of RestNoSqlManager, 400 if not indexed
+        eq        only values with field equal eq
+        start     only values with field greater or equal start
+        end       only values with field lower than end
+        reverse   1 to stream in descending order
+        limit     stream at most limit pairs
+        keys_only 1 to stream keys only, one per line
+
+    values without field are never returned, pairs are streamed in order
+    of field value, numbers before strings, and key
+    """
+
+    @stats
+    @compress
+    @authenticator(CONFIG)
+    @encode_json
+    def GET(self, *args, **kwds):
+        """
+        return generator of [key, value], or keys
+        """
+        database = args[0]
+        idkey = kwds["_x_idkey"]
+        if not CATALOG.exists(idkey, database):
+            web.notfound()
+            return
+        params = web.input(_method="get", field=None, eq=None, start=None, end=None, reverse=None, limit=None, keys_only=None)
+        if params.field not in read_meta(idkey, database)["indexes"]:
+            logging.error("field %s of database %s is not indexed", params.field, database)
+            web.badrequest()
+            return
+        bounds = {}
+        for name in ("eq", "start", "end"):
+            if params[name] is not None:
+                try:
+                    bound = json.loads(params[name])
+                except ValueError:
+                    bound = None
+                if isinstance(bound, bool): # stored as 1 and 0 in sqlite
+                    bound = int(bound)
+                if not isinstance(bound, (str, int, float)):
+                    logging.error("%s must be json string or number", name)
+                    web.badrequest()
+                    return
+                bounds[name] = bound
+        bounds["reverse"] = params.reverse == "1"
+        try:
+            bounds["limit"] = int_param(params, "limit")
+        except ValueError as exc:
+            logging.error(exc)
+            web.badrequest()
+            return
+        return self._stream(idkey, database, params.field, params.keys_only != "1", bounds)
+
+    def _stream(self, idkey, database, field, with_values, bounds):
+        """
+        generator of [key, value] or keys, keeps database leased until exhausted
+        """
+        with POOL.open_all(idkey, database) as dbs:
+            for row in iter_query_merged(dbs, field, with_values, **bounds):
+                if with_values:
+                    yield RawJson("[%s,%s]" % (json.dumps(row[1]), row[2]))
+                else:
+                    yield row[1]
+
+
+class RestNoSqlChanges(object):
+    """
+    change feed of database, for incremental sync of copies
+
+    GET         /<database>/_changes  newline delimited json, one change per line,
+                {"shard", "seq", "key", "value"} or {"shard", "seq", "key", "deleted" : true}
+
+    every write and delete of a shard has a sequence number, growing by one,
+    changes are streamed in order of seq per shard, with the current value
+    of the key. a change followed by a later change of the same key is
+    skipped, the later one is streamed instead
+
+    query parameters
+        since   json list of last seq of every shard seen by the client,
+                default the current ones, so only new changes are returned
+        created json creation time of database seen by the client
+        limit   stream at most limit changes
+        wait    seconds to wait for changes if there are none yet,
+                at most CHANGES_MAX_WAIT
+
+    header X-Changes-Since is since as json list, X-Changes-Created the
+    creation time of database, to pass as since and created, updated with
+    seq of every change read. 410 if created does not fit the database,
+    or the changes were trimmed from the change log meanwhile, the client
+    has to copy the whole database again. 400 if since is no list of
+    integers, one per shard
+    """
+
+    # maximum number of seconds a request waits for changes
+    CHANGES_MAX_WAIT = 30
+    # seconds between reads while waiting, writes of other worker processes are not notified
+    CHANGES_POLL_INTERVAL = 1
+
+    @stats
+    @compress
+    @authenticator(CONFIG)
+    @encode_json
+    def GET(self, *args, **kwds):
+        """
+        return generator of changes
+        """
+        database = args[0]
+        idkey = kwds["_x_idkey"]
+        params = web.input(_method="get", since=None, created=None, limit=None, wait=None)
+        try:
+            limit = int_param(params, "limit", minimum=0) # 0 for cursor only
+            wait = min(max(float(params.wait), 0), self.CHANGES_MAX_WAIT) if params.wait is not None else 0
+            since = json.loads(params.since) if params.since is not None else None
+            if since is not None and (not isinstance(since, list) or not all(isinstance(seq, int) and not isinstance(seq, bool) for seq in since)):
+                raise ValueError("since must be list of integers")
+        except ValueError as exc:
+            logging.error(exc)
+            web.badrequest()
+            return
+        created = read_meta(idkey, database).get("created")
+        counter = CHANGE_COUNTERS[(idkey, database)] # before reading, to miss no notification
+        with POOL.open_all(idkey, database) as dbs:
+            if since is None:
+                since = [read_sequence(db) for db in dbs]
+            elif params.created == json.dumps(created) and len(since) != len(dbs):
+                logging.error("since %s needs one seq per shard of database %s", since, database)
+                web.badrequest()
+                return
+            elif params.created != json.dumps(created) or not all(changes_complete(db, seq) for db, seq in zip(dbs, since)):
+                logging.info("changes of database %s since %s are not complete", database, since)
+                web.ctx.status = "410 Gone"
+                return
+        web.header("X-Changes-Since", json.dumps(since))
+        web.header("X-Changes-Created", json.dumps(created))
+        return self._stream(idkey, database, since, limit, time.time() + wait, counter)
+
+    def _stream(self, idkey, database, since, limit, deadline, counter):
+        """
+        generator of changes, waits until deadline for the first change,
+        keeps database leased while reading only
+        """
+        while True:
+            found = False
+            with POOL.open_all(idkey, database) as dbs:
+                for shard, db in enumerate(dbs):
+                    for seq, key, value in iter_changes(db, since[shard], limit):
+                        found = True
+                        if value is None:
+                            yield RawJson('{"shard":%d,"seq":%d,"key":%s,"deleted":true}' % (shard, seq, json.dumps(key)))
+                        else:
+                            yield RawJson('{"shard":%d,"seq":%d,"key":%s,"value":%s}' % (shard, seq, json.dumps(key), value))
+                        if limit is not None:
+                            limit -= 1
+                    if limit == 0:
+                        return
+            timeout = deadline - time.time()
+            if found or timeout <= 0:
+                return
+            wait_changes(idkey, database, counter, min(timeout, self.CHANGES_POLL_INTERVAL))
+            counter = CHANGE_COUNTERS[(idkey, database)]
+
+
+class RestNoSqlMaintenance(object):
+    """
+    status of last maintenance started by PATCH /<database>/
+
+    GET         /<database>/_maintenance  status of maintenance or 404
+    """
+
+    @stats
+    @compress
+    @authenticator(CONFIG)
+    @encode_json
+    def GET(self, *args, **kwds):
+        """
+        return status of last maintenance
+        """
+        with MAINTENANCE_LOCK:
+            job = MAINTENANCE.get((kwds["_x_idkey"], args[0]))
+        if job is None:
+            web.notfound()
+            return
+        return job.status
+
+
+class RestNoSqlBloom(object):
+    """
+    bloom filter of keys in database, to answer most lookups of not
+    existing keys on client side, see bloom_filter()
+
+    GET         /<database>/_bloom  {"created", "bits", "hashes", "sequence", "filter"}
+
+    filter is base64 encoded, sequence and created, json encoded, are the
+    query parameters since and created of the next request, which returns
+    {"bits", "created", "sequence", "keys"} with keys written since,
+    to be added to the filter. if there are more than
+    BLOOM_MAX_DELTA, or the database was created again meanwhile, the
+    whole filter is returned again. if bits differ from the filter of the
+    client, the server rebuilt its filter, and it should be downloaded again
+
+    every response has the creation time of the database as created
+    """
+
+    @stats
+    @compress
+    @authenticator(CONFIG)
+    @encode_json
+    def GET(self, *args, **kwds):
+        """
+        return bloom filter, or keys written since
+        """
+        idkey = kwds["_x_idkey"]
+        database = args[0]
+        if not CATALOG.exists(idkey, database):
+            web.notfound()
+            return
+        params = web.input(_method="get", since=None, created=None)
+        bloom, sequences = bloom_filter(idkey, database)
+        created = read_meta(idkey, database).get("created")
+        if params.since is not None:
+            since = json.loads(params.since)
+            if len(since) == len(sequences) and params.created == json.dumps(created):
+                keys = []
+                delta_sequences = list(sequences)
+                with POOL.open_all(idkey, database) as dbs:
+                    for shard, db in enumerate(dbs):
+                        for key, version in iter_written(db, since[shard], BLOOM_MAX_DELTA + 1):
+                            keys.append(key)
+                            delta_sequences[shard] = max(delta_sequences[shard], version)
+                if len(keys) <= BLOOM_MAX_DELTA:
+                    return {"bits" : bloom.bits, "created" : created, "sequence" : delta_sequences, "keys" : keys}
+        return {
+            "created" : created,
+            "bits" : bloom.bits,
+            "hashes" : bloom.hashes,
+            "sequence" : sequences,
+            "filter" : base64.b64encode(bytes(bloom.filter)).decode("ascii"),
+        }
+
+
+class RestNoSqlMetrics(object):
+    """
+    metrics of requests and databases of tenant
+
+    GET         /metrics  prometheus text format, see Metrics
+    """
+
+    @stats
+    @compress
+    @authenticator(CONFIG)
+    def GET(self, *args, **kwds):
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+        return METRICS.expose(kwds["_x_idkey"])
+
+
+def configure(config=None, storage_dir=None):
+    """
+    replace config and storage directory of running application,
+    open databases are closed, config is changed in place, because
+    the authenticator holds a reference to it
+    """
+    global STORAGE_DIR
+    if config is not None:
+        check_limits(config)
+    POOL.close()
+    CATALOG.reset()
+    if config is not None:
+        CONFIG.clear()
+        CONFIG.update(config)
+        LIMITER.reset()
+    if storage_dir is not None:
+        STORAGE_DIR = storage_dir
+    init_storage()
 
 
 if __name__ == "__main__":
+    # development server, python3 RestNoSqlWebApp.py [port]
+    # use bin/restnosql_server.py to serve with several workers
     app = web.application(urls, globals())
-    # app.run()
-    app.request("/info")
+    app.run()
 else:
     application = web.application(urls, globals()).wsgifunc()
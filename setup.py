@@ -1,4 +1,4 @@
-from distutils.core import setup, Extension
+from setuptools import setup
 #from Cython.Build import cythonize
 import sys, string, os
 import shutil
@@ -20,7 +20,9 @@ args = {"name": "RestNoSql",
         # Make extensions in root dir appear in pywbem module
         #"ext_package": "webstorage",
         # "ext_modules" : cythonize("*.pyx"),
-        "requires" : ["requests", ],
+        "install_requires" : ["requests", ],
+        # AsyncRestNoSqlClient, pip install RestNoSql[async]
+        "extras_require" : {"async" : ["aiohttp", ]},
         "version" : "0.1.0",
         }
 setup(**args)
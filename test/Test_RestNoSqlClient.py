@@ -3,10 +3,21 @@
 """
 RestFUL Webclient to use BlockStorage WebApps
 """
+import io
+import os
+import time
+import tempfile
+import asyncio
+import threading
 import json
+import sys
+import collections
 import unittest
+import http.client
+from urllib.parse import urlsplit
 import logging
-from client import RestNoSqlClient, RestNoSqlDatabase
+import requests
+from client import RestNoSqlClient, RestNoSqlDatabase, AsyncRestNoSqlClient, PreconditionFailed, ChangesIncomplete
 
 
 class Test(unittest.TestCase):
@@ -61,3 +72,597 @@ class Test(unittest.TestCase):
             except KeyError:
                 pass
         rnsc.delete("testdatabase")
+
+    def test_batch(self):
+        print("bulk set, get and delete in batch requests")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        with rnsc.open("testdatabase") as db:
+            db.set_many({"testkey%d" % index: index for index in range(2500)})
+            self.assertEqual(db.get_many(["testkey1", "notexistingkey", "testkey2499"]), [1, None, 2499])
+            results = db.batch([["set", "testkey1", "one"], ["get", "testkey1"], ["delete", "notexistingkey"]])
+            self.assertEqual(results, [[200, None], [200, "one"], [404, None]])
+            headers = {"X-IDKEY" : self.config["idkey"], "X-APIKEY" : self.config["apikey"]}
+            for operations in ([5], [["set", ["a"], 1]], [["drop", "testkey1"]], [["merge", "testkey1", ["append"], 1]], {"set" : 1}):
+                res = requests.post(self.config["url"] + "/database/testdatabase/_batch", json=operations, headers=headers, proxies=self.config["proxies"])
+                self.assertEqual(res.status_code, 400)
+            self.assertEqual(db["testkey1"], "one")
+            db.delete_many("testkey%d" % index for index in range(2500))
+            self.assertTrue(len(db.keys()) == 0)
+        rnsc.delete("testdatabase")
+
+    def test_buffered(self):
+        print("buffered writes are sent in batches")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        with rnsc.open("testdatabase", buffered=True, max_pending=100) as db:
+            for index in range(150):
+                db["testkey%d" % index] = index
+            db["testkey149"] = "last"
+            self.assertEqual(db["testkey149"], "last") # served from buffer
+            del db["testkey0"]
+            self.assertFalse("testkey0" in db)
+        with rnsc.open("testdatabase") as db:
+            self.assertTrue(len(db.keys()) == 149)
+            self.assertEqual(db["testkey149"], "last")
+        rnsc.delete("testdatabase")
+
+    def test_cache(self):
+        print("values read are cached, own writes invalidate cache")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"], cache_entries=2)
+        with rnsc.open("testdatabase") as db:
+            db.set_many({"testkey1": 1, "testkey2": 2, "testkey3": 3})
+            self.assertEqual(db["testkey1"], 1)
+            self.assertEqual(db["testkey1"], 1)
+            self.assertEqual(rnsc.cache_stats()["hits"], 1)
+            db["testkey1"] = "one"
+            self.assertEqual(db["testkey1"], "one")
+            self.assertEqual(db.get_many(["testkey1", "testkey2", "testkey3"]), ["one", 2, 3])
+            self.assertEqual(rnsc.cache_stats()["entries"], 2)
+            self.assertTrue(rnsc.cache_stats()["evictions"] > 0)
+        rnsc.delete("testdatabase")
+
+    def test_keys(self):
+        print("keys are read in pages, filtered by prefix or streamed")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        with rnsc.open("testdatabase") as db:
+            db.set_many(("/host%d/file%04d" % (index % 2, index), index) for index in range(2500))
+            self.assertEqual(len(db.keys()), 2500)
+            self.assertEqual(len(list(db.keys())), 2500)
+            keys = list(db.keys(prefix="/host1/"))
+            self.assertEqual(len(keys), 1250)
+            self.assertEqual(keys, sorted(keys))
+            self.assertEqual(keys, list(db.keys(prefix="/host1/", stream=True)))
+            self.assertEqual(len(db.keys(prefix="/host0/")), 1250)
+            self.assertTrue("/host1/file0001" in db)
+            self.assertFalse("/host1/file000" in db)
+        rnsc.delete("testdatabase")
+
+    def test_scan(self):
+        print("items and values are streamed in one request")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        with rnsc.open("testdatabase") as db:
+            db.set_many(("testkey%04d" % index, {"index": index}) for index in range(2500))
+            items = list(db.items())
+            self.assertEqual(len(items), 2500)
+            self.assertEqual(items[0], ("testkey0000", {"index": 0}))
+            self.assertEqual(list(db.values(prefix="testkey249")), [{"index": 2490 + index} for index in range(10)])
+            self.assertEqual([key for key, value in db.scan(start="testkey0010", end="testkey0013", batch=2)], ["testkey0010", "testkey0011", "testkey0012"])
+            for batch in (0, -1, 10001, "abc"):
+                self.assertRaises(KeyError, list, db.scan(batch=batch))
+            self.assertRaises(KeyError, list, db.scan(limit=0))
+            self.assertRaises(KeyError, lambda: [key for key in db.keys(stream=True, limit=-1)])
+        rnsc.delete("testdatabase")
+        headers = {"X-IDKEY" : self.config["idkey"], "X-APIKEY" : self.config["apikey"]}
+        res = requests.get(self.config["url"] + "/database/testdatabase/_scan", headers=headers, proxies=self.config["proxies"])
+        self.assertEqual(res.status_code, 404)
+
+    def test_range(self):
+        print("range queries on ordered keys")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        with rnsc.open("testdatabase") as db:
+            db.set_many(("testkey%04d" % index, index) for index in range(2500))
+            self.assertEqual([value for key, value in db.range("testkey0100", "testkey0103")], [100, 101, 102])
+            self.assertEqual(list(db.range(prefix="testkey24", reverse=True, limit=2, keys_only=True)), ["testkey2499", "testkey2498"])
+            keys = list(db.keys(reverse=True, limit=1500))
+            self.assertEqual(len(keys), 1500)
+            self.assertEqual(keys[-1], "testkey1000")
+            self.assertEqual(len(db.keys(start="testkey1000", end="testkey2000")), 1000)
+        rnsc.delete("testdatabase")
+
+    def test_migrate(self):
+        print("pickle databases are readable and can be migrated to json format")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        rnsc.create("testdatabase", format="pickle")
+        with rnsc.open("testdatabase") as db:
+            db.set_many(("testkey%04d" % index, {"index": index}) for index in range(1500))
+            self.assertEqual(rnsc.migrate("testdatabase"), 1500)
+            db["testkey1500"] = [1500]
+            self.assertEqual(db["testkey0001"], {"index": 1})
+            self.assertEqual(len(list(db.items())), 1501)
+            self.assertEqual(rnsc.migrate("testdatabase"), 0)
+        rnsc.create("testdatabase2", format="pickle")
+        with rnsc.open("testdatabase2") as db:
+            db["testkey"] = {"index": 1}
+            self.assertEqual(rnsc.configure("testdatabase2", journal_mode="WAL")["converted"], 0) # settings only
+            self.assertEqual(rnsc.configure("testdatabase2", format="json")["converted"], 1)
+            headers = {"X-IDKEY" : self.config["idkey"], "X-APIKEY" : self.config["apikey"]}
+            for body in (b"[1]", b"not json", b"\xff"):
+                res = requests.patch(self.config["url"] + "/manager/testdatabase2", data=body, headers=headers, proxies=self.config["proxies"])
+                self.assertEqual(res.status_code, 400)
+            self.assertEqual(db["testkey"], {"index": 1})
+        rnsc.delete("testdatabase")
+        rnsc.delete("testdatabase2")
+
+    def test_import_export(self):
+        print("bulk import and export of whole databases")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        loaded = rnsc.import_data("testdatabase", (("testkey%04d" % index, [index]) for index in range(2500)))
+        self.assertEqual(loaded, 2500)
+        exported = list(rnsc.export_data("testdatabase"))
+        self.assertEqual(len(exported), 2500)
+        self.assertEqual(exported[0], ("testkey0000", [0]))
+        source = io.BytesIO(json.dumps({"testkey1": 1, "testkey2": [2, 2.5]}).encode("utf-8"))
+        self.assertEqual(rnsc.import_data("testdatabase", source, format="json", truncate=True), 2)
+        outfile = io.BytesIO()
+        rnsc.export_data("testdatabase", outfile)
+        self.assertEqual(outfile.getvalue(), b'["testkey1",1]\n["testkey2",[2,2.5]]\n')
+        # change log is trimmed after import
+        rnsc.configure("testdatabase", changes_max_entries=100)
+        db = rnsc.open("testdatabase")
+        cursor, _ = db.changes(limit=0)
+        rnsc.import_data("testdatabase", (("testkey%04d" % index, index) for index in range(500)))
+        self.assertRaises(ChangesIncomplete, db.changes, cursor)
+        # invalid lines roll back the whole import
+        count = len(list(rnsc.export_data("testdatabase")))
+        for source in (b'["newkey", 1]\n[1, 2]\n', b'["newkey", 1]\n[[1], 2]\n', b'["newkey", 1]\n"ab"\n', b'["newkey", 1]\n[1\n'):
+            self.assertRaises(Exception, rnsc.import_data, "testdatabase", io.BytesIO(source))
+        self.assertEqual(len(list(rnsc.export_data("testdatabase"))), count)
+        self.assertFalse("newkey" in db)
+        rnsc.delete("testdatabase")
+
+    def test_maintenance(self):
+        print("settings of database and maintenance in background")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        with rnsc.open("testdatabase") as db:
+            db.set_many(("testkey%04d" % index, "x" * 100) for index in range(2000))
+            db.delete_many("testkey%04d" % index for index in range(2000))
+            status = db.maintenance(wait=True, interval=0.1)
+            self.assertEqual(status["state"], "done")
+            self.assertTrue(status["size_after"] < status["size_before"])
+            self.assertEqual(db.maintenance_status()["done"], ["vacuum", "incremental_vacuum", "analyze", "checkpoint"])
+            settings = rnsc.configure("testdatabase", synchronous="FULL")
+            self.assertEqual(settings["synchronous"], "FULL")
+            self.assertEqual(settings["journal_mode"], "WAL")
+            db["testkey"] = "testvalue"
+            self.assertEqual(db["testkey"], "testvalue")
+        rnsc.delete("testdatabase")
+
+    def test_metrics(self):
+        print("metrics of tenant in prometheus text format")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        with rnsc.open("testdatabase") as db:
+            db["testkey"] = "testvalue"
+        text = rnsc.metrics()
+        self.assertTrue('restnosql_request_duration_seconds_count{handler="RestNoSql",method="POST",database="testdatabase",status="200"}' in text)
+        self.assertFalse(self.config["idkey"] in text)
+        rnsc.delete("testdatabase")
+        # requests to not existing databases do not add series
+        for name in ("nosuchdatabase1", "nosuchdatabase2"):
+            db = rnsc.open(name, mode="r")
+            with self.assertRaises(Exception):
+                db["testkey"]
+        series = len(rnsc.metrics().splitlines())
+        for name in ("nosuchdatabase3", "nosuchdatabase4"):
+            db = rnsc.open(name, mode="r")
+            with self.assertRaises(Exception):
+                db["testkey"]
+        text = rnsc.metrics()
+        self.assertEqual(len(text.splitlines()), series)
+        self.assertFalse("nosuchdatabase" in text)
+
+    def test_async(self):
+        print("asyncio client with many requests in flight")
+
+        async def run():
+            async with AsyncRestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"], concurrency=8) as rnsc:
+                db = await rnsc.open("testdatabase")
+                await asyncio.gather(*(db.set("testkey%04d" % index, [index]) for index in range(50)))
+                self.assertEqual(await db.get("testkey0007"), [7])
+                self.assertTrue(await db.contains("testkey0007"))
+                await db.delete("testkey0007")
+                with self.assertRaises(KeyError):
+                    await db.get("testkey0007")
+                await db.set_many(("testkey%04d" % index, index) for index in range(2500))
+                self.assertEqual(await db.get_many(["testkey0001", "testkey2499", "missing"], default=-1), [1, 2499, -1])
+                self.assertEqual(len([key async for key in db.keys(prefix="testkey")]), 2500)
+                self.assertEqual([item async for item in db.scan(start="testkey0010", limit=2)], [("testkey0010", 10), ("testkey0011", 11)])
+                await db.delete_many("testkey%04d" % index for index in range(2500))
+                self.assertEqual([key async for key in db.keys()], [])
+                await rnsc.delete("testdatabase")
+                self.assertFalse(await rnsc.exists("testdatabase"))
+
+        asyncio.run(run())
+
+    def test_shards(self):
+        print("database split into shard files")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        rnsc.create("testdatabase", shards=4)
+        with rnsc.open("testdatabase") as db:
+            db.set_many(("testkey%04d" % index, index) for index in range(2500))
+            db["testkey"] = "testvalue"
+            self.assertEqual(db["testkey"], "testvalue")
+            del db["testkey"]
+            self.assertEqual(list(db.keys(prefix="testkey00", limit=3)), ["testkey0000", "testkey0001", "testkey0002"])
+            self.assertEqual(list(db.keys(reverse=True, limit=2)), ["testkey2499", "testkey2498"])
+            self.assertEqual(list(db.keys()), ["testkey%04d" % index for index in range(2500)])
+            self.assertEqual(len(db.keys(prefix="testkey1")), 1000)
+            self.assertEqual(list(db.scan(start="testkey0998", limit=3)), [("testkey0998", 998), ("testkey0999", 999), ("testkey1000", 1000)])
+            self.assertEqual(db.get_many(["testkey0001", "testkey2000", "missing"]), [1, 2000, None])
+            self.assertEqual(next(rnsc.export_data("testdatabase")), ("testkey0000", 0))
+            self.assertEqual(db.maintenance(["analyze"], wait=True, interval=0.1)["state"], "done")
+        rnsc.delete("testdatabase")
+
+    def test_merge(self):
+        print("atomic merge of values on server")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        with rnsc.open("testdatabase") as db:
+            self.assertEqual(db.merge("testlist", "append", "a"), ["a"])
+            self.assertEqual(db.merge("testlist", "append", "a"), ["a", "a"])
+            self.assertEqual(db.merge("testlist", "union", ["a", "b"]), ["a", "a", "b"])
+            self.assertEqual(db.merge("testcounter", "increment", 2), 2)
+            self.assertEqual(db.merge("testcounter", "increment", 0.5), 2.5)
+            self.assertEqual(db.merge("testnewest", "max", {"datetime" : "2020-01-02"}, "datetime"), {"datetime" : "2020-01-02"})
+            self.assertEqual(db.merge("testnewest", "max", {"datetime" : "2020-01-01"}, "datetime"), {"datetime" : "2020-01-02"})
+            self.assertEqual(db.merge("testnewest", "min", {"datetime" : "2020-01-01"}, "datetime"), {"datetime" : "2020-01-01"})
+            with self.assertRaises(KeyError): # 400, counter is no list
+                db.merge("testcounter", "append", 1)
+            self.assertEqual(db["testcounter"], 2.5)
+            results = db.batch([["merge", "testcounter", "increment", 1], ["merge", "testset", "union", [1, 2]], ["get", "testset"]])
+            self.assertEqual(results, [[200, 3.5], [200, [1, 2]], [200, [1, 2]]])
+            with self.assertRaises(KeyError): # whole batch fails
+                db.batch([["merge", "testcounter", "increment", 1], ["merge", "testset", "increment", 1]])
+            self.assertEqual(db["testcounter"], 3.5)
+            db._request("PUT", data=["testset", [2, 3]]) # union of lists
+            self.assertEqual(db["testset"], [1, 2, 3])
+        rnsc.delete("testdatabase")
+
+    def test_versions(self):
+        print("versions of keys and conditional writes")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        with rnsc.open("testdatabase") as db:
+            version = db.set_if("testkey", "testvalue", None)
+            with self.assertRaises(PreconditionFailed): # exists already
+                db.set_if("testkey", "othervalue", None)
+            self.assertEqual(db.get_version("testkey"), ("testvalue", version))
+            newversion = db.set_if("testkey", "newvalue", version)
+            self.assertNotEqual(newversion, version)
+            with self.assertRaises(PreconditionFailed):
+                db.set_if("testkey", "othervalue", version)
+            with self.assertRaises(PreconditionFailed):
+                db.delete_if("testkey", version)
+            self.assertEqual(db._request("GET", data="testkey", headers={"if-none-match" : newversion}).status_code, 304)
+            db.delete_if("testkey", newversion)
+            self.assertFalse("testkey" in db)
+            self.assertEqual(db.update("testcounter", lambda value: value + 1, default=0), 1)
+            threads = [threading.Thread(target=db.update, args=("testcounter", lambda value: value + 1)) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(db["testcounter"], 5)
+        rnsc.delete("testdatabase")
+
+    def test_revalidate(self):
+        print("expired cached values are revalidated with etag")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"], cache_ttl=0)
+        with rnsc.open("testdatabase") as db:
+            db["testkey"] = "testvalue"
+            self.assertEqual(db["testkey"], "testvalue")
+            self.assertEqual(db["testkey"], "testvalue") # 304 from server
+            other = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"], cache=False)
+            other.open("testdatabase")["testkey"] = "othervalue"
+            self.assertEqual(db["testkey"], "othervalue")
+        rnsc.delete("testdatabase")
+
+    def test_compression(self):
+        print("compressed requests and responses")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        with rnsc.open("testdatabase") as db:
+            value = ["/home/user/some/long/path/file%04d.txt" % index for index in range(100)]
+            db["testkey"] = value # sent compressed
+            self.assertEqual(db["testkey"], value)
+            headers = dict(db._headers, **{"accept-encoding" : "gzip"})
+            res = db._session.get(db._url + "/", data=json.dumps("testkey"), headers=headers)
+            self.assertEqual(res.headers["content-encoding"], "gzip")
+            self.assertEqual(res.json(), value)
+            db["smallkey"] = "smallvalue"
+            res = db._session.get(db._url + "/", data=json.dumps("smallkey"), headers=headers)
+            self.assertFalse("content-encoding" in res.headers)
+            res = db._session.get(db._url + "/_scan", headers=headers)
+            self.assertEqual(res.headers["content-encoding"], "gzip")
+            self.assertEqual(len(res.text.splitlines()), 2)
+            res = db._session.post(db._url + "/", data=b"xxx", headers=dict(headers, **{"content-encoding" : "br"}))
+            self.assertEqual(res.status_code, 415)
+        source = io.BytesIO(json.dumps(dict(("testkey%04d" % index, value) for index in range(100))).encode("utf-8"))
+        self.assertEqual(rnsc.import_data("testdatabase", source, format="json", truncate=True), 100)
+        self.assertEqual(rnsc.open("testdatabase")["testkey0099"], value)
+        rnsc.delete("testdatabase")
+
+    def test_bloom(self):
+        print("existence of keys by HEAD and bloom filter")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        rnsc.create("testdatabase", shards=2)
+        with rnsc.open("testdatabase") as db:
+            db.set_many(("testkey%04d" % index, index) for index in range(2000))
+            self.assertTrue("testkey0001" in db)
+            self.assertFalse("missing" in db)
+        db = rnsc.open("testdatabase", bloom_ttl=60)
+        requests_sent = []
+        request = db._request
+        def counting_request(method, *args, **kwds):
+            requests_sent.append(method)
+            return request(method, *args, **kwds)
+        db._request = counting_request
+        self.assertTrue("testkey0001" in db)
+        self.assertEqual(requests_sent, ["GET", "HEAD"]) # filter downloaded once
+        self.assertTrue(sum("missing%04d" % index in db for index in range(1000)) == 0)
+        self.assertTrue(len(requests_sent) < 50) # most answered by filter
+        db["newkey"] = "newvalue"
+        self.assertTrue("newkey" in db)
+        rnsc.open("testdatabase")["otherkey"] = "othervalue"
+        bloom = db._bloom
+        db.refresh_bloom() # only keys written since
+        self.assertTrue(db._bloom is bloom)
+        self.assertTrue("otherkey" in db._bloom)
+        rnsc.delete("testdatabase")
+        headers = {"X-IDKEY" : self.config["idkey"], "X-APIKEY" : self.config["apikey"]}
+        res = requests.get(self.config["url"] + "/database/testdatabase/_bloom", headers=headers, proxies=self.config["proxies"])
+        self.assertEqual(res.status_code, 404)
+
+    def test_query(self):
+        print("queries by indexed fields of values")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        rnsc.create("testdatabase", shards=2, indexes=["basename"])
+        with rnsc.open("testdatabase") as db:
+            db.set_many(("checksum%04d" % index, {"basename" : "backupset%d" % (index % 3), "info" : {"datetime" : "2020-01-%02d" % (index % 28 + 1)}}) for index in range(300))
+            db["nofield"] = {"other" : 1}
+            db["scalar"] = "backupset1"
+            found = list(db.query("basename", eq="backupset1"))
+            self.assertEqual([key for key, value in found], ["checksum%04d" % index for index in range(300) if index % 3 == 1])
+            self.assertEqual(found[0][1]["basename"], "backupset1")
+            self.assertEqual(list(db.query("basename", start="backupset1", keys_only=True, reverse=True, limit=2)), ["checksum0299", "checksum0296"])
+            with self.assertRaises(KeyError): # not indexed
+                list(db.query("info.datetime", start="2020-01-27"))
+            rnsc.configure("testdatabase", indexes=["info.datetime"])
+            self.assertEqual(len(list(db.query("info.datetime", start="2020-01-27", end="2020-01-28", keys_only=True))), 10)
+            db["checksum0000"] = {"info" : {"datetime" : "2020-01-27"}}
+            self.assertEqual(len(list(db.query("info.datetime", eq="2020-01-27"))), 11)
+        rnsc.delete("testdatabase")
+        headers = {"X-IDKEY" : self.config["idkey"], "X-APIKEY" : self.config["apikey"]}
+        res = requests.get(self.config["url"] + "/database/testdatabase/_query", params={"field" : "basename"}, headers=headers, proxies=self.config["proxies"])
+        self.assertEqual(res.status_code, 404)
+
+    def test_changes(self):
+        print("change feed and local mirror of database")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        rnsc.create("testdatabase", shards=2)
+        with rnsc.open("testdatabase") as db:
+            db.set_many(("testkey%04d" % index, index) for index in range(100))
+            cursor, changes = db.changes()
+            self.assertEqual(list(changes), [])
+            db["testkey0001"] = "changed"
+            db["testkey0001"] = "changed again"
+            del db["testkey0002"]
+            db.merge("testkey0003", "increment", 10)
+            cursor, changes = db.changes(cursor)
+            changes = list(changes)
+            self.assertEqual(sorted((change["key"], change.get("value"), change.get("deleted")) for change in changes), [("testkey0001", "changed again", None), ("testkey0002", None, True), ("testkey0003", 13, None)])
+            self.assertEqual(list(db.changes(cursor)[1]), []) # cursor updated while iterating
+            url = self.config["url"] + "/database/testdatabase/_changes"
+            headers = {"X-IDKEY" : self.config["idkey"], "X-APIKEY" : self.config["apikey"]}
+            created = requests.get(url, headers=headers, proxies=self.config["proxies"]).headers["X-Changes-Created"]
+            for since in ("5", "[1]", '["a", "b"]', "[true, 1]", "not json"):
+                res = requests.get(url, params={"since" : since, "created" : created}, headers=headers, proxies=self.config["proxies"])
+                self.assertEqual(res.status_code, 400)
+            filename = os.path.join(tempfile.mkdtemp(), "mirror.sqlite")
+            with db.mirror(filename) as mirror:
+                self.assertEqual(mirror.sync(), 99) # copied
+                self.assertEqual(mirror["testkey0001"], "changed again")
+                self.assertFalse("testkey0002" in mirror)
+                db["newkey"] = {"new" : True}
+                del db["testkey0004"]
+                self.assertEqual(mirror.sync(), 2)
+                self.assertEqual(len(mirror), 99)
+                self.assertEqual(mirror["newkey"], {"new" : True})
+                writer = threading.Timer(0.5, db.__setitem__, ("waitedkey", 1))
+                writer.start()
+                starttime = time.time()
+                self.assertEqual(mirror.sync(wait=10), 1) # long poll
+                self.assertTrue(time.time() - starttime < 5)
+                writer.join()
+                rnsc.configure("testdatabase", changes_max_entries=1)
+                db["testkey0005"] = "trimmed"
+                db["testkey0006"] = "trimmed"
+                db.maintenance(["trim"], wait=True, interval=0.1)
+                with self.assertRaises(ChangesIncomplete):
+                    list(db.changes(cursor)[1])
+                self.assertEqual(mirror.sync(), 100) # copied again
+                self.assertEqual(mirror["testkey0006"], "trimmed")
+        rnsc.delete("testdatabase")
+
+    def test_cache_database(self):
+        print("cache database with ttl and LRU eviction")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"], cache=False)
+        rnsc.create("testdatabase", shards=2, type="cache", max_entries=100, default_ttl=3600)
+        with rnsc.open("testdatabase") as db:
+            db.set("shortlived", "value", ttl=0.5)
+            db.batch([["set", "shortlived_batch", "value", 0.5]])
+            self.assertEqual(db["shortlived"], "value")
+            time.sleep(0.6)
+            self.assertFalse("shortlived" in db) # expired, before sweep
+            self.assertEqual(db.get_many(["shortlived", "shortlived_batch"]), [None, None])
+            with self.assertRaises(KeyError):
+                db["shortlived"]
+            db.set_many(("testkey%04d" % index, "x" * 100) for index in range(150))
+            time.sleep(0.01)
+            for index in range(10): # recently used, kept
+                db["testkey%04d" % index]
+            db.maintenance(["sweep"], wait=True, interval=0.1)
+            keys = list(db.keys())
+            self.assertTrue(90 <= len(keys) <= 100)
+            self.assertFalse("shortlived" in keys)
+            self.assertTrue(all("testkey%04d" % index in keys for index in range(10)))
+            self.assertFalse("testkey0010" in keys) # least recently used
+        with self.assertRaises(KeyError): # no cache
+            rnsc.open("testdatabase_store").set("testkey", "value", ttl=1)
+        rnsc.delete("testdatabase_store")
+        rnsc.delete("testdatabase")
+
+    def test_catalog(self):
+        print("catalog of databases and their statistics")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        self.assertFalse(rnsc.exists("testdatabase"))
+        self.assertTrue(rnsc.create("testdatabase", shards=2))
+        self.assertFalse(rnsc.create("testdatabase")) # idempotent
+        self.assertTrue(rnsc.exists("testdatabase"))
+        with rnsc.open("testdatabase") as db:
+            db.set_many(("testkey%04d" % index, index) for index in range(100))
+            db["testkey0001"] = "replaced"
+            del db["testkey0002"]
+            db.batch([["set", "newkey", 1], ["delete", "testkey0003"], ["merge", "testkey0004", "increment", 1]])
+        stats = rnsc.stats()["testdatabase"]
+        self.assertEqual(stats["keys"], 99)
+        self.assertEqual(stats["shards"], 2)
+        self.assertTrue(stats["size"] > 0)
+        self.assertTrue(stats["modified"] >= stats["created"])
+        rnsc.import_data("testdatabase", [("importkey", 1)], truncate=True)
+        self.assertEqual(rnsc.stats()["testdatabase"]["keys"], 1)
+        rnsc.delete("testdatabase")
+        self.assertFalse(rnsc.exists("testdatabase"))
+        self.assertFalse("testdatabase" in rnsc.list())
+
+    def test_database_names(self):
+        print("reserved names and path segments are no databases")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        rnsc.create("testdatabase")
+        for name in ("_private", ".hidden", "a\\b"):
+            self.assertFalse(rnsc.exists(name))
+            self.assertRaises(KeyError, rnsc.create, name)
+        # without normalization of dot segments by the http library
+        url = urlsplit(self.config["url"])
+        for name in (".", ".."):
+            for method in ("HEAD", "DELETE", "PATCH"):
+                conn = http.client.HTTPConnection(url.netloc)
+                conn.request(method, "%s/manager/%s" % (url.path, name), headers={"X-IDKEY" : self.config["idkey"], "X-APIKEY" : self.config["apikey"]})
+                self.assertEqual(conn.getresponse().status, 404)
+                conn.close()
+        self.assertTrue(rnsc.exists("testdatabase"))
+        rnsc.delete("testdatabase")
+
+    def test_readonly_batch(self):
+        print("multi get with an apikey allowed to GET only")
+        if self.config.get("readonly_apikey") is None:
+            self.skipTest("no readonly_apikey in Test_RestNoSqlClient.json")
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"])
+        rnsc.create("testdatabase", shards=2)
+        with rnsc.open("testdatabase") as db:
+            db.set_many(("testkey%04d" % index, index) for index in range(1500))
+        readonly = RestNoSqlClient(url=self.config["url"], apikey=self.config["readonly_apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"], cache=False)
+        db = readonly.open("testdatabase") # existing database, no POST
+        self.assertEqual(db.get_many(["testkey0001", "missing", "testkey1499"]), [1, None, 1499])
+        self.assertEqual(len(db.get_many("testkey%04d" % index for index in range(1500))), 1500)
+        self.assertRaises(KeyError, db.set_many, {"testkey0001" : 2})
+
+        async def run_async():
+            async with AsyncRestNoSqlClient(url=self.config["url"], apikey=self.config["readonly_apikey"], idkey=self.config["idkey"]) as client:
+                db = await client.open("testdatabase")
+                return await db.get_many(["testkey0002", "missing"], default=-1)
+        self.assertEqual(asyncio.run(run_async()), [2, -1])
+        rnsc.delete("testdatabase")
+
+    def test_rate_limit(self):
+        print("requests over rate limit are answered with 429 and retried by the client")
+        if self.config.get("limited_apikey") is None:
+            self.skipTest("no limited_apikey with rate limit in Test_RestNoSqlClient.json")
+        headers = {"X-IDKEY" : self.config["idkey"], "X-APIKEY" : self.config["limited_apikey"]}
+        session = requests.Session()
+        statuses = [session.options(self.config["url"] + "/manager/", headers=headers, proxies=self.config["proxies"]) for _ in range(50)]
+        limited = [res for res in statuses if res.status_code == 429]
+        self.assertTrue(limited)
+        self.assertTrue(int(limited[0].headers["Retry-After"]) >= 1)
+        time.sleep(1)
+        # without retries 429 is raised, with retries the client waits as told by Retry-After
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["limited_apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"], retries=0)
+        self.assertRaises(KeyError, lambda: [rnsc.list() for _ in range(50)])
+        time.sleep(1)
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["limited_apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"], retries=5)
+        starttime = time.time()
+        for _ in range(20):
+            self.assertTrue(isinstance(rnsc.list(), list))
+        self.assertTrue(time.time() - starttime >= 1)
+
+    def test_webstorage_index(self):
+        print("indexing of backupsets is resumed where an interrupted run stopped")
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+        import webstorage_nosql
+
+        class Archive(object):
+            """
+            backupsets of 20 files each, checksums shared between files and backupsets
+            """
+            backupsets = [{"basename" : "host_tag_2020-01-0%dT00:00:00" % day, "date" : "2020-01-0%d" % day, "time" : "00:00:00", "datetime" : "2020-01-0%dT00:00:00" % day} for day in (1, 2)]
+
+            def get_backupsets(self, hostname):
+                return self.backupsets
+
+            def get(self, basename):
+                return {"filedata" : dict(("/%s/file%02d" % (basename, index), {"checksum" : "checksum%d" % (index % 7)}) for index in range(20))}
+
+        class CountingDatabase(object):
+            """
+            counts merges per key, the batch merging key interrupt_at fails
+            """
+            def __init__(self, db, interrupt_at=None):
+                self._db = db
+                self._interrupt_at = interrupt_at
+                self._lock = threading.Lock()
+                self.batches = 0
+                self.merges = collections.Counter()
+
+            def batch(self, operations):
+                operations = list(operations)
+                with self._lock:
+                    self.batches += 1
+                    if any(operation[1] == self._interrupt_at for operation in operations):
+                        raise IOError("interrupted")
+                    for operation in operations:
+                        self.merges[operation[1]] += 1
+                return self._db.batch(operations)
+
+        rnsc = RestNoSqlClient(url=self.config["url"], apikey=self.config["apikey"], idkey=self.config["idkey"], proxies=self.config["proxies"], cache=False)
+        with rnsc.open("testbackupsets_log") as db_backupsets, rnsc.open("testabsfilename_checksums") as db_absfilename, rnsc.open("testchecksum_backupset") as db_checksum:
+            webstorage_nosql.db_backupsets = db_backupsets
+            webstorage_nosql.db_absfilename = CountingDatabase(db_absfilename, interrupt_at="/host_tag_2020-01-01T00:00:00/file10")
+            webstorage_nosql.db_checksum = CountingDatabase(db_checksum)
+            webstorage_nosql.create_nosql(Archive(), num_workers=2, batch_size=3)
+            self.assertEqual(db_backupsets["host_tag_2020-01-01T00:00:00"], {"offset" : 9}) # batches of 3 files
+            self.assertTrue(isinstance(db_backupsets["host_tag_2020-01-02T00:00:00"], str))
+            first_absfile, first_checksum = webstorage_nosql.db_absfilename, webstorage_nosql.db_checksum
+            webstorage_nosql.db_absfilename = CountingDatabase(db_absfilename)
+            webstorage_nosql.db_checksum = CountingDatabase(db_checksum)
+            webstorage_nosql.create_nosql(Archive(), num_workers=2, batch_size=3)
+            self.assertFalse(any(isinstance(state, dict) for state in db_backupsets.values()))
+            # every absfile merged exactly once over both runs, none skipped
+            merges = first_absfile.merges + webstorage_nosql.db_absfilename.merges
+            self.assertEqual(len(merges), 40)
+            self.assertEqual(set(merges.values()), {1})
+            self.assertEqual(db_absfilename["/host_tag_2020-01-01T00:00:00/file08"], ["checksum1"])
+            # newest backupset of checksum once per backupset
+            merges = first_checksum.merges + webstorage_nosql.db_checksum.merges
+            self.assertEqual(merges, collections.Counter(dict(("checksum%d" % index, 2) for index in range(7))))
+            self.assertEqual(db_checksum["checksum3"]["datetime"], "2020-01-02T00:00:00")
+            # finished backupsets are skipped
+            webstorage_nosql.db_absfilename = CountingDatabase(db_absfilename)
+            webstorage_nosql.create_nosql(Archive(), num_workers=2, batch_size=3)
+            self.assertEqual(webstorage_nosql.db_absfilename.batches, 0)
+        for database in ("testbackupsets_log", "testabsfilename_checksums", "testchecksum_backupset"):
+            rnsc.delete(database)